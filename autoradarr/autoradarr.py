@@ -15,52 +15,791 @@ radarralice.py
 
 '''
 import time
+import argparse
+import array
+import atexit
 import datetime
 # from pprint import pprint
+import codecs
+import bisect
+import cProfile
+import functools
+import hashlib
+import heapq
+import json
+import linecache
 import locale
+import logging
+import logging.handlers
+import math
+import mmap
 import os
+import queue
+import random
 import re
 import sys
+import threading
+import tracemalloc
 import unicodedata
-from typing import Any, Optional, Union, Dict, List, Set
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from types import FrameType
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from typing import (Any, Optional, Union, Dict, FrozenSet, Iterable, Iterator, List, Set,
+                    Tuple)
+from urllib.parse import urlsplit
 
 import pymongo
+from pymongo import monitoring
 # from pymongo.common import VALIDATORS
-import requests
 from pymongo.database import Database
 from pymongo.mongo_client import MongoClient
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
 from requests.models import Response
 from requests.sessions import Session
+from urllib3.util.retry import Retry
 
 # import json
 
+# Film in Radarr API format, genres (list) route it to Radarr instances
+RadarrFilm = Dict[str, Union[str, int, List[str]]]
+
+# Per host semaphores, limit of concurrent requests to one host
+host_slots: Dict[str, threading.BoundedSemaphore] = {}
+host_slots_lock: threading.Lock = threading.Lock()
+
+# Cache name -> {'hit': count, 'miss': count} since start of process
+cache_stats: Dict[str, Dict[str, int]] = {}
+cache_stats_lock: threading.Lock = threading.Lock()
+
+# Only these fields of imdb-api.com Title are used and cached
+DETAIL_CACHE_FIELDS: List[str] = ['genres']
+
+# Radarr library index shared by runs, refreshed by 'radarr_library' job:
+# index - films persisting in all instances, instances - name -> index of instance
+radarr_library: Dict[str, Any] = {'index': None, 'loaded': 0.0, 'instances': {}}
+radarr_library_lock: threading.Lock = threading.Lock()
+
+
+# Loggers by area, levels can be set for every one (AUTORADARR_LOG_LEVELS)
+log: logging.Logger = logging.getLogger('autoradarr')
+db_log: logging.Logger = logging.getLogger('autoradarr.db')
+http_log: logging.Logger = logging.getLogger('autoradarr.http')
+imdb_log: logging.Logger = logging.getLogger('autoradarr.imdb')
+radarr_log: logging.Logger = logging.getLogger('autoradarr.radarr')
+tmdb_log: logging.Logger = logging.getLogger('autoradarr.tmdb')
+scheduler_log: logging.Logger = logging.getLogger('autoradarr.scheduler')
+
+# Listener writing queued logs, started by setup_logging
+log_listener: Optional[logging.handlers.QueueListener] = None
+
+# Attributes of every LogRecord, the rest come from extra={...}
+LOG_RECORD_FIELDS: FrozenSet[str] = frozenset(vars(logging.LogRecord(
+    '', 0, '', 0, '', (), None)).keys()) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    ''' One JSON object per line: time, level, logger, message and
+        fields passed by extra={...} '''
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            'time': datetime.datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field, value in vars(record).items():
+            if field not in LOG_RECORD_FIELDS:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def parse_log_levels(levels: str) -> 'Dict[str, int]':
+    ''' Parse 'autoradarr.imdb=DEBUG,autoradarr.db=WARNING' into logger -> level,
+        incorrect items are skipped '''
+
+    parsed: Dict[str, int] = {}
+    for item in levels.split(','):
+        name, _, level = item.partition('=')
+        value: Any = logging.getLevelName(level.strip().upper())
+        if name.strip() and isinstance(value, int):
+            parsed[name.strip()] = value
+    return parsed
+
+
+def setup_logging(stream: Any = None) -> logging.handlers.QueueListener:
+    ''' Send 'autoradarr' logs through queue to stream (stdout) in
+        background thread, so log I/O does not block pipeline.
+
+        env AUTORADARR_LOG_LEVEL - level of 'autoradarr' loggers (INFO),
+        AUTORADARR_LOG_LEVELS - levels by logger,
+        e.g. 'autoradarr.imdb=DEBUG,autoradarr.db=WARNING',
+        AUTORADARR_LOG_FORMAT - 'json' (default) or 'text'.
+        Returns started listener, stop_logging() writes queued logs.
+
+    '''
+
+    handler: 'logging.StreamHandler[Any]' = logging.StreamHandler(stream or sys.stdout)
+    if os.environ.get('AUTORADARR_LOG_FORMAT') == 'text':
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+    else:
+        handler.setFormatter(JsonFormatter())
+
+    global log_listener
+    stop_logging()
+    for old in list(log.handlers):
+        if isinstance(old, logging.handlers.QueueHandler):
+            log.removeHandler(old)
+
+    log_queue: 'queue.Queue[logging.LogRecord]' = queue.Queue(-1)
+    listener: logging.handlers.QueueListener = logging.handlers.QueueListener(
+        log_queue, handler, respect_handler_level=True)
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.propagate = False
+
+    level: Any = logging.getLevelName((os.environ.get('AUTORADARR_LOG_LEVEL') or 'INFO').upper())
+    log.setLevel(level if isinstance(level, int) else logging.INFO)
+    for name, logger_level in parse_log_levels(
+            os.environ.get('AUTORADARR_LOG_LEVELS') or '').items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    listener.start()
+    log_listener = listener
+    return listener
+
+
+@atexit.register
+def stop_logging() -> None:
+    ''' Write queued logs and stop listener of setup_logging '''
+
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+
+def get_env_int(name: str, default: int) -> int:
+    ''' Return int env variable or default if not set or incorrect '''
+
+    value: Optional[str] = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        log.warning('Incorrect env %s - using default %s', name, default)
+        return default
+
+
+def get_env_float(name: str, default: float) -> float:
+    ''' Return float env variable or default if not set or incorrect '''
+
+    value: Optional[str] = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        log.warning('Incorrect env %s - using default %s', name, default)
+        return default
+
+
+def count_cache(name: str, hit: bool) -> None:
+    ''' Count cache hit or miss in cache_stats '''
+
+    with cache_stats_lock:
+        stats: Dict[str, int] = cache_stats.setdefault(name, {'hit': 0, 'miss': 0})
+        stats['hit' if hit else 'miss'] += 1
+
+
+def host_slot(url: str) -> threading.BoundedSemaphore:
+    ''' Return semaphore of url's host.
+
+        Limit from env AUTORADARR_HOST_CONCURRENCY (default 4).
+
+    '''
+
+    host: str = urlsplit(url).netloc
+    with host_slots_lock:
+        if host not in host_slots:
+            limit: int = max(1, get_env_int('AUTORADARR_HOST_CONCURRENCY', 4))
+            host_slots[host] = threading.BoundedSemaphore(limit)
+        return host_slots[host]
+
+
+# Upper bounds of latency histogram buckets, seconds
+LATENCY_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                                      1, 2.5, 5, 10, 30, 60, 300)
+
+# Metric name -> (type, help) of Prometheus exposition
+METRICS_HELP: Dict[str, Tuple[str, str]] = {
+    'autoradarr_stage_seconds': ('histogram', 'Duration of pipeline stage'),
+    'autoradarr_stage_calls_total': ('counter', 'Calls of pipeline stage'),
+    'autoradarr_stage_errors_total': ('counter', 'Pipeline stage calls failed with error'),
+    'autoradarr_stage_films_total': ('counter', 'Films in and out of pipeline stage'),
+    'autoradarr_http_request_seconds': ('histogram', 'Duration of HTTP request'),
+    'autoradarr_http_requests_total': ('counter', 'HTTP requests by status code'),
+    'autoradarr_http_errors_total': ('counter', 'HTTP requests failed without answer'),
+    'autoradarr_mongo_command_seconds': ('histogram', 'Duration of Mongo command'),
+    'autoradarr_mongo_errors_total': ('counter', 'Failed Mongo commands'),
+    'autoradarr_job_seconds': ('histogram', 'Duration of scheduled job run'),
+    'autoradarr_job_errors_total': ('counter', 'Scheduled job runs failed with error'),
+    'autoradarr_cache_requests_total': ('counter', 'Cache lookups by result'),
+    'autoradarr_cache_hit_ratio': ('gauge', 'Part of cache lookups answered by cache'),
+    'autoradarr_budget_calls_total': ('counter', 'API calls allowed or denied by budget'),
+    'autoradarr_snapshot_films_total': ('counter', 'Provider films sent or skipped by snapshot'),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, value.replace('\\', '\\\\')
+                                             .replace('"', '\\"').replace('\n', '\\n'))
+                          for name, value in labels) + '}'
+
+
+class Metrics(object):
+    ''' Thread-safe registry of counters and latency histograms.
+
+        Series are keyed by metric name and sorted labels, render() returns
+        them with cache_stats in Prometheus text format.
+
+    '''
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets: Tuple[float, ...] = buckets
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        # Histogram series -> counts by bucket, then sum and count
+        self.histograms: Dict[Tuple[str, Labels], List[float]] = {}
+        self.lock: threading.Lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        key: Tuple[str, Labels] = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key: Tuple[str, Labels] = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            series: Optional[List[float]] = self.histograms.get(key)
+            if series is None:
+                series = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def get(self, name: str, **labels: Any) -> float:
+        ''' Return counter value or count of histogram observations '''
+
+        key: Tuple[str, Labels] = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            if key in self.histograms:
+                return self.histograms[key][-1]
+            return self.counters.get(key, 0)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self) -> str:
+        with self.lock:
+            counters: Dict[Tuple[str, Labels], float] = dict(self.counters)
+            histograms: Dict[Tuple[str, Labels], List[float]] = {
+                key: list(series) for key, series in self.histograms.items()}
+        with cache_stats_lock:
+            for cache, stats in cache_stats.items():
+                for result in ('hit', 'miss'):
+                    counters[('autoradarr_cache_requests_total',
+                              (('cache', cache), ('result', result)))] = stats[result]
+                total: int = stats['hit'] + stats['miss']
+                counters[('autoradarr_cache_hit_ratio', (('cache', cache),))] = \
+                    stats['hit'] / total if total else 0
+
+        lines: List[str] = []
+        names: List[str] = sorted({name for name, _ in counters} |
+                                  {name for name, _ in histograms})
+        for name in names:
+            kind, text = METRICS_HELP.get(name, ('untyped', name))
+            lines.append('# HELP {0} {1}'.format(name, text))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for (series_name, labels), value in sorted(counters.items()):
+                if series_name == name:
+                    lines.append('{0}{1} {2}'.format(name, format_labels(labels), value))
+            for (series_name, labels), series in sorted(histograms.items()):
+                if series_name != name:
+                    continue
+                cumulative: float = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        name, format_labels(labels + (('le', repr(float(bound))),)), cumulative))
+                lines.append('{0}_bucket{1} {2}'.format(
+                    name, format_labels(labels + (('le', '+Inf'),)), series[-1]))
+                lines.append('{0}_sum{1} {2}'.format(name, format_labels(labels), series[-2]))
+                lines.append('{0}_count{1} {2}'.format(name, format_labels(labels), series[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+metrics: Metrics = Metrics()
+
+
+class StageTimer(object):
+    ''' Context manager - duration, calls, errors and films in/out of stage.
+
+        with StageTimer('filter_in_db', films) as stage:
+            films = stage.out(filter_in_db(db, films, 'id'))
+
+    '''
+
+    def __init__(self, stage: str, films_in: Optional[Any] = None) -> None:
+        self.stage: str = stage
+        self.films_in: Optional[Any] = films_in
+        self.start: float = 0
+
+    def __enter__(self) -> 'StageTimer':
+        metrics.inc('autoradarr_stage_calls_total', stage=self.stage)
+        if self.films_in is not None:
+            metrics.inc('autoradarr_stage_films_total', len(self.films_in),
+                        stage=self.stage, direction='in')
+        self.start = time.perf_counter()
+        return self
+
+    def out(self, films: Any) -> Any:
+        ''' Count films passed stage and return them '''
+
+        metrics.inc('autoradarr_stage_films_total', len(films or []),
+                    stage=self.stage, direction='out')
+        return films
+
+    def __exit__(self, exc_type: Any, exc: Any, traceback: Any) -> None:
+        metrics.observe('autoradarr_stage_seconds', time.perf_counter() - self.start,
+                        stage=self.stage)
+        if exc_type is not None:
+            metrics.inc('autoradarr_stage_errors_total', stage=self.stage)
+
+
+class MongoMetrics(monitoring.CommandListener):
+    ''' Duration and failures of Mongo commands '''
+
+    def started(self, event: Any) -> None:
+        pass
+
+    def succeeded(self, event: Any) -> None:
+        metrics.observe('autoradarr_mongo_command_seconds', event.duration_micros / 1e6,
+                        command=event.command_name)
+
+    def failed(self, event: Any) -> None:
+        metrics.observe('autoradarr_mongo_command_seconds', event.duration_micros / 1e6,
+                        command=event.command_name)
+        metrics.inc('autoradarr_mongo_errors_total', command=event.command_name)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    ''' GET /metrics - metrics in Prometheus text format '''
+
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        payload: bytes = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+
+def start_metrics_server(port: int = -1) -> Optional[MetricsServer]:
+    ''' Serve /metrics in background thread.
+
+        port - default from env AUTORADARR_METRICS_PORT, not served if 0.
+        Address from env AUTORADARR_METRICS_ADDR (default 0.0.0.0).
+
+    '''
+
+    if port < 0:
+        port = get_env_int('AUTORADARR_METRICS_PORT', 0)
+    if not port:
+        return None
+    try:
+        server: MetricsServer = MetricsServer(
+            (os.environ.get('AUTORADARR_METRICS_ADDR') or '0.0.0.0', port), MetricsHandler)
+    except OSError as err:
+        log.error('Could not serve metrics on port %s with error: %s', port, err)
+        return None
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+class JitterRetry(Retry):
+    ''' Retry with exponential backoff and full jitter,
+        so retries of concurrent requests don't hit server at once '''
+
+    def get_backoff_time(self) -> float:
+        backoff: float = super().get_backoff_time()
+        if backoff <= 0:
+            return 0
+        return random.uniform(0, backoff)
+
+
+class HttpClient(Session):
+    ''' Session with default timeouts and conditional GETs.
+
+        Responses with ETag or Last-Modified are remembered (cache_size last
+        urls), next GET of url sends If-None-Match / If-Modified-Since and
+        on 304 Not Modified remembered response is returned.
+
+    '''
+
+    def __init__(self, timeout: Tuple[float, float], cache_size: int = 64) -> None:
+        super().__init__()
+        self.timeout: Tuple[float, float] = timeout
+        self.cache_size: int = cache_size
+        self.conditional: 'OrderedDict[str, Response]' = OrderedDict()
+        self.conditional_lock: threading.Lock = threading.Lock()
+        # Requests failed in a row without answer (connection errors, timeouts)
+        self.failures: int = 0
+
+    def request(self,
+                method: str,
+                url: Union[str, bytes],
+                *args: Any,
+                **kwargs: Any) -> Response:
+        if isinstance(url, bytes):
+            url = url.decode()
+        kwargs.setdefault('timeout', self.timeout)
+        if method.upper() != 'GET' or kwargs.get('stream') or self.cache_size <= 0:
+            return self.send_timed(method, url, *args, **kwargs)
+
+        with self.conditional_lock:
+            cached: Optional[Response] = self.conditional.get(url)
+        if cached is not None:
+            headers: Dict[str, str] = dict(kwargs.get('headers') or {})
+            if cached.headers.get('ETag'):
+                headers['If-None-Match'] = cached.headers['ETag']
+            if cached.headers.get('Last-Modified'):
+                headers['If-Modified-Since'] = cached.headers['Last-Modified']
+            kwargs['headers'] = headers
+
+        r: Response = self.send_timed(method, url, *args, **kwargs)
+        if r.status_code == 304 and cached is not None:
+            return cached
+        if r.status_code == 200 and (r.headers.get('ETag') or r.headers.get('Last-Modified')):
+            with self.conditional_lock:
+                self.conditional[url] = r
+                self.conditional.move_to_end(url)
+                while len(self.conditional) > self.cache_size:
+                    self.conditional.popitem(last=False)
+        return r
+
+    def send_timed(self, method: str, url: str, *args: Any, **kwargs: Any) -> Response:
+        ''' Session.request with duration and status code in metrics '''
+
+        labels: Dict[str, Any] = {'host': urlsplit(url).netloc, 'method': method.upper()}
+        start: float = time.perf_counter()
+        try:
+            r: Response = super().request(method, url, *args, **kwargs)
+        except Exception:
+            metrics.inc('autoradarr_http_errors_total', **labels)
+            self.failures += 1
+            raise
+        finally:
+            metrics.observe('autoradarr_http_request_seconds',
+                            time.perf_counter() - start, **labels)
+        metrics.inc('autoradarr_http_requests_total', code=r.status_code, **labels)
+        self.failures = 0
+        return r
+
+
+def make_http_client() -> HttpClient:
+    ''' Return HTTP client with connection pools, timeouts and retries.
+
+        env AUTORADARR_HTTP_CONNECT_TIMEOUT (5 sec), AUTORADARR_HTTP_READ_TIMEOUT
+        (60 sec), AUTORADARR_HTTP_RETRIES (3), AUTORADARR_HTTP_BACKOFF (0.5 sec),
+        AUTORADARR_HTTP_CACHE_SIZE - urls remembered for conditional GETs (64).
+        Pool of every host keeps AUTORADARR_HOST_CONCURRENCY connections.
+
+    '''
+
+    retries: int = get_env_int('AUTORADARR_HTTP_RETRIES', 3)
+    retry: JitterRetry = JitterRetry(total=retries,
+                                     backoff_factor=get_env_float('AUTORADARR_HTTP_BACKOFF', 0.5),
+                                     status_forcelist=(429, 500, 502, 503, 504),
+                                     raise_on_status=False)
+    adapter: HTTPAdapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=max(1, get_env_int('AUTORADARR_HOST_CONCURRENCY', 4)),
+        max_retries=retry)
+
+    client: HttpClient = HttpClient((get_env_float('AUTORADARR_HTTP_CONNECT_TIMEOUT', 5),
+                                     get_env_float('AUTORADARR_HTTP_READ_TIMEOUT', 60)),
+                                    get_env_int('AUTORADARR_HTTP_CACHE_SIZE', 64))
+    client.mount('https://', adapter)
+    client.mount('http://', adapter)
+    return client
+
+
+def iter_chunks(items: 'Iterable[Any]', size: int) -> 'Iterator[List[Any]]':
+    ''' Yield lists of size items (last one could be shorter) '''
+
+    chunk: List[Any] = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
 
 def get_db(host: str, dbname: str, user: str, passw: str) -> Optional[Database]:
     ''' Connect to mongo and return client db object '''
 
+    db_client: MongoClient = pymongo.MongoClient(
+        host,
+        username=user,
+        password=passw,
+        authSource=dbname,
+        maxPoolSize=get_env_int('AUTORADARR_DB_POOL_SIZE', 16),
+        event_listeners=[MongoMetrics()])
     try:
-        db_client: MongoClient = pymongo.MongoClient(host,
-                                                     username=user,
-                                                     password=passw,
-                                                     authSource=dbname)
-    # Force connection on a request as the connect=True parameter of MongoClient
-    # seems to be useless here
+        # Force connection on a request as the connect=True parameter of MongoClient
+        # seems to be useless here
         db_client.server_info()
 
+    # Client keeps monitor threads and pool - close it, caller connects again later
     except pymongo.errors.ServerSelectionTimeoutError as err:
-        print("Could not connect to server '",
-              host, "' with error: ",
-              err, file=sys.stderr)
+        db_log.error("Could not connect to server '%s' with error: %s", host, err)
+        db_client.close()
         return None
     except pymongo.errors.OperationFailure as err:
-        print("Could not get database '",
-              dbname, "' to server '",
-              host, "' with error: ",
-              err, file=sys.stderr)
+        db_log.error("Could not get database '%s' to server '%s' with error: %s",
+                     dbname, host, err)
+        db_client.close()
         return None
     return db_client[dbname]
 
 
+def parse_number(value: Any, kind: Any) -> Any:
+    ''' Return kind(value) (int or float), 0 if value is empty or incorrect '''
+
+    if not value:
+        return kind(0)
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return kind(0)
+
+
+class Film(object):
+    ''' Film passed through filters, built once at ingest from provider's item.
+
+        Rating, votes and year are parsed into numbers once (0 if empty or
+        incorrect). Fields are readable and writable by imdb-api.com and
+        Radarr names too (film['imDbRating'], film['folderName']), so stages
+        work with records and raw dicts alike.
+
+    '''
+
+    __slots__ = ('id', 'title', 'full_title', 'year', 'rating', 'rating_count',
+                 'root_folder', 'folder_name', 'genres')
+
+    # imdb-api.com and Radarr field -> slot
+    FIELDS: Dict[str, str] = {
+        'id': 'id', 'imdbId': 'id',
+        'title': 'title', 'originalTitle': 'title',
+        'fullTitle': 'full_title',
+        'year': 'year',
+        'imDbRating': 'rating',
+        'imDbRatingCount': 'rating_count',
+        'rootFolderPath': 'root_folder',
+        'folderName': 'folder_name',
+        'genres': 'genres',
+    }
+
+    def __init__(self,
+                 id: str,
+                 title: str,
+                 full_title: str = '',
+                 year: int = 0,
+                 rating: float = 0,
+                 rating_count: int = 0) -> None:
+        self.id: str = id
+        self.title: str = title
+        self.full_title: str = full_title
+        self.year: int = year
+        self.rating: float = rating
+        self.rating_count: int = rating_count
+        self.root_folder: str = ''
+        self.folder_name: str = ''
+        self.genres: List[str] = []
+
+    @classmethod
+    def from_imdb(cls, item: 'Dict[str, Any]') -> 'Film':
+        ''' Build film of imdb-api.com list item (MostPopularMovies, Top250) '''
+
+        return cls(str(item.get('id') or ''),
+                   str(item.get('title') or ''),
+                   str(item.get('fullTitle') or ''),
+                   parse_number(item.get('year'), int),
+                   parse_number(item.get('imDbRating'), float),
+                   parse_number(item.get('imDbRatingCount'), int))
+
+    def __getitem__(self, field: str) -> Any:
+        return getattr(self, self.FIELDS[field])
+
+    def __setitem__(self, field: str, value: Any) -> None:
+        setattr(self, self.FIELDS[field], value)
+
+    def __contains__(self, field: str) -> bool:
+        return field in self.FIELDS
+
+    def get(self, field: str, default: Any = None) -> Any:
+        slot: Optional[str] = self.FIELDS.get(field)
+        if slot is None:
+            return default
+        return getattr(self, slot)
+
+    def astuple(self) -> 'Tuple[Any, ...]':
+        ''' Values of all fields, e.g. for payload fingerprint '''
+
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __repr__(self) -> str:
+        return 'Film({0!r}, {1!r})'.format(self.id, self.title)
+
+
+class RegularFilter(object):
+    ''' Compiled filter of regular list - field names and thresholds are
+        bound once, films are checked by batches.
+
+        Film records are checked by their parsed numbers (several times faster
+        than the old per-film loop). Raw dicts are kept for old callers, they
+        go one by one with ratings and years parsed once per batch for every
+        distinct value, which is about as fast as the old loop.
+        Film without rating, rating count or year (or with empty one) or with
+        incorrect year is removed. Incorrect rating or rating count raise
+        ValueError as float()/int().
+
+    '''
+
+    def __init__(self,
+                 rating_field: str,
+                 rating_count_field: str,
+                 year_field: str,
+                 min_rating: float,
+                 min_rating_count: int,
+                 min_year: int) -> None:
+        self.rating_field: str = rating_field
+        self.rating_count_field: str = rating_count_field
+        self.year_field: str = year_field
+        self.min_rating: float = min_rating
+        self.min_rating_count: int = min_rating_count
+        self.min_year: int = min_year
+
+    def __call__(self, newfilms: 'List[Any]') -> 'List[Any]':
+        return [item for item, passed in zip(newfilms, self.mask(newfilms)) if passed]
+
+    def year_passed(self, year: Any) -> bool:
+        try:
+            return int(year) >= self.min_year
+        # Year format incorrect - remove film
+        except ValueError:
+            return False
+
+    def mask(self, newfilms: 'List[Any]') -> 'List[bool]':
+        ''' Return True for every film to add '''
+
+        # Ratings and years repeat a lot - every value is parsed once per batch
+        ratings: Dict[Any, bool] = {}
+        years: Dict[Any, bool] = {}
+        rating_field: str = self.rating_field
+        rating_count_field: str = self.rating_count_field
+        year_field: str = self.year_field
+        min_rating: float = self.min_rating
+        min_rating_count: int = self.min_rating_count
+
+        mask: List[bool] = []
+        for item in newfilms:
+            if type(item) is Film:
+                mask.append(bool(item.rating and item.rating >= min_rating and
+                                 item.rating_count and
+                                 item.rating_count >= min_rating_count and
+                                 item.year and item.year >= self.min_year))
+                continue
+            rating: Any = item.get(rating_field)
+            count: Any = item.get(rating_count_field)
+            year: Any = item.get(year_field)
+            passed: bool = True
+            if not rating:
+                passed = False
+            else:
+                if rating not in ratings:
+                    ratings[rating] = not float(rating) < min_rating
+                passed = ratings[rating]
+            if not count or int(count) < min_rating_count:
+                passed = False
+            if not year:
+                passed = False
+            elif passed:
+                if year not in years:
+                    years[year] = self.year_passed(year)
+                passed = years[year]
+            mask.append(passed)
+        return mask
+
+
+@functools.lru_cache(maxsize=32)
+def compile_regular_filter(rating_field: str,
+                           rating_count_field: str,
+                           year_field: str,
+                           min_rating: float,
+                           min_rating_count: int,
+                           min_year: int) -> RegularFilter:
+    return RegularFilter(rating_field, rating_count_field, year_field,
+                         min_rating, min_rating_count, min_year)
+
+
+def get_regular_filter(rating_field: str,
+                       rating_count_field: str,
+                       year_field: str,
+                       current_year: int = 0) -> RegularFilter:
+    ''' Return RegularFilter compiled from configuration.
+
+        env AUTORADARR_MIN_RATING (6.5), AUTORADARR_MIN_RATING_COUNT (5000),
+        AUTORADARR_MAX_AGE - years before current_year (1).
+
+    '''
+
+    year: int = current_year
+    if not year:
+        year = datetime.datetime.utcnow().year
+    return compile_regular_filter(rating_field, rating_count_field, year_field,
+                                  get_env_float('AUTORADARR_MIN_RATING', 6.5),
+                                  get_env_int('AUTORADARR_MIN_RATING_COUNT', 5000),
+                                  year - get_env_int('AUTORADARR_MAX_AGE', 1))
+
+
 def filter_regular_result(newfilms: Any,
                           rating_field: str,
                           rating_count_field: str,
@@ -69,33 +808,185 @@ def filter_regular_result(newfilms: Any,
     ''' Filter regular list (MostPopularMovies, news, daily or other) of
         new films and return json to add '''
 
-    year: int = current_year
-    if not year:
-        year = datetime.datetime.utcnow().year
+    return get_regular_filter(rating_field, rating_count_field, year_field,
+                              current_year)(list(newfilms))
 
-    notfiltred_films: Any = []
-    for item in newfilms:
-        removeflag: bool = False
-        if (rating_field not in item) or \
-           (not item[rating_field]) or \
-           (float(item[rating_field]) < 6.5):
-            removeflag = True
-        if (rating_count_field not in item) or \
-           (not item[rating_count_field]) or \
-           (int(item[rating_count_field]) < 5000):
-            removeflag = True
+
+def iter_regular_result(newfilms: Any,
+                        rating_field: str,
+                        rating_count_field: str,
+                        year_field: str,
+                        current_year: int = 0,
+                        batch_size: int = 256) -> 'Iterator[Any]':
+    ''' Lazy filter_regular_result - check films by batches of batch_size '''
+
+    regular_filter: RegularFilter = get_regular_filter(rating_field, rating_count_field,
+                                                       year_field, current_year)
+    for batch in iter_chunks(newfilms, batch_size):
+        with StageTimer('filter_regular_result', batch) as stage:
+            passed: Any = stage.out(regular_filter(batch))
+        yield from passed
+
+
+def create_db_index(collection: Any, keys: Any, **kwargs: Any) -> bool:
+    ''' Create index of collection, return False if could not create.
+
+        If unique index fails (duplicates already persist in DB) - non-unique
+        index is created instead, so lookups stay indexed.
+
+    '''
+
+    try:
+        collection.create_index(keys, **kwargs)
+    except pymongo.errors.OperationFailure as err:
+        db_log.error('Could not create index %s of %s with error: %s', keys,
+                     collection.name, err)
+        if not kwargs.pop('unique', False):
+            return False
         try:
-            if (year_field not in item) or \
-               (not item[year_field]) or \
-               (int(item[year_field]) < year - 1):
-                removeflag = True
-        # Year format incorrect - next film
-        except ValueError:
-            continue
-        if not removeflag:
-            notfiltred_films.append(item)
+            collection.create_index(keys, **kwargs)
+        except pymongo.errors.OperationFailure as err:
+            db_log.error('Could not create non-unique index %s of %s with error: %s', keys,
+                         collection.name, err)
+        return False
+    return True
 
-    return notfiltred_films
+
+def ensure_db_indexes(db: Database) -> bool:
+    ''' Create indexes used by scanner. Return False if could not create any.
+
+        films.imdbId is unique, so dedup lookups and upserts stay indexed.
+        Every index is created on its own - failed one doesn't stop others.
+
+    '''
+
+    results: List[bool] = [
+        create_db_index(db.get_collection('films'), 'imdbId', unique=True),
+        # Runtime.get_seen - marks added since seen index has been saved
+        create_db_index(db.get_collection('films'), 'added'),
+        create_db_index(db.get_collection('tmdb_ids'), 'imdbId', unique=True),
+        create_db_index(db.get_collection('tmdb_pending'), 'imdbId', unique=True),
+        create_db_index(db.get_collection('tmdb_pending'), 'queued',
+                        expireAfterSeconds=get_env_int('AUTORADARR_TMDB_PENDING_TTL',
+                                                       30 * 24 * 60 * 60)),
+        create_db_index(db.get_collection('rating_history'),
+                        [('imdbId', pymongo.ASCENDING), ('month', pymongo.ASCENDING)],
+                        unique=True),
+        # films_near_thresholds - recent buckets by latest votes
+        create_db_index(db.get_collection('rating_history'),
+                        [('month', pymongo.ASCENDING), ('last.c', pymongo.ASCENDING)]),
+        ensure_detail_cache_indexes(db),
+    ]
+    return all(results)
+
+
+def ensure_detail_cache_indexes(db: Database) -> bool:
+    ''' Create indexes of imdb details cache. Return False if could not create.
+
+        Documents expire by TTL index on 'cached' after
+        env AUTORADARR_DETAIL_CACHE_TTL seconds (default 7 days).
+
+    '''
+
+    details: Any = db.get_collection('imdb_details')
+    ttl: int = get_env_int('AUTORADARR_DETAIL_CACHE_TTL', 7 * 24 * 60 * 60)
+    try:
+        details.create_index('imdbId', unique=True)
+        try:
+            details.create_index('cached', expireAfterSeconds=max(ttl, 1))
+        # TTL has been changed - recreate index
+        except pymongo.errors.OperationFailure:
+            details.drop_index('cached_1')
+            details.create_index('cached', expireAfterSeconds=max(ttl, 1))
+    except pymongo.errors.OperationFailure as err:
+        db_log.error('Could not create indexes of imdb_details with error: %s', err)
+        return False
+    return True
+
+
+# Budget name -> env of calls allowed per day
+QUOTA_ENVS: Dict[str, str] = {'imdb-api.com': 'AUTORADARR_IMDB_DAILY_QUOTA'}
+
+
+class RequestBudget(object):
+    ''' Token bucket of API calls persisted in 'budgets' collection.
+
+        Bucket holds up to capacity tokens and is refilled evenly during
+        period seconds, spent tokens survive restarts.
+
+    '''
+
+    def __init__(self,
+                 db: Database,
+                 name: str,
+                 capacity: float,
+                 period: float = 24 * 60 * 60,
+                 clock: Any = datetime.datetime.utcnow) -> None:
+        self.budgets: Any = db.get_collection('budgets')
+        self.name: str = name
+        self.capacity: float = capacity
+        self.period: float = period
+        self.clock: Any = clock
+
+    def refill(self, doc: 'Dict[str, Any]', now: datetime.datetime) -> float:
+        elapsed: float = max(0, (now - doc['updated']).total_seconds())
+        return min(self.capacity, doc['tokens'] + elapsed * self.capacity / self.period)
+
+    def available(self) -> float:
+        doc: Any = self.budgets.find_one({'_id': self.name})
+        if doc is None:
+            return self.capacity
+        return self.refill(doc, self.clock())
+
+    def take(self, count: float = 1) -> bool:
+        ''' Spend count tokens, return False if budget is exhausted '''
+
+        # Optimistic update - retry if other process has spent tokens meanwhile
+        for _ in range(5):
+            doc: Any = self.budgets.find_one({'_id': self.name})
+            now: datetime.datetime = self.clock()
+            if doc is None:
+                try:
+                    self.budgets.insert_one({'_id': self.name, 'tokens': self.capacity,
+                                             'updated': now})
+                except pymongo.errors.DuplicateKeyError:
+                    pass
+                continue
+            tokens: float = self.refill(doc, now)
+            if tokens < count:
+                metrics.inc('autoradarr_budget_calls_total', budget=self.name, result='denied')
+                return False
+            result: Any = self.budgets.update_one(
+                {'_id': self.name, 'tokens': doc['tokens'], 'updated': doc['updated']},
+                {'$set': {'tokens': tokens - count, 'updated': now}})
+            if result.modified_count:
+                metrics.inc('autoradarr_budget_calls_total', budget=self.name, result='taken')
+                return True
+        return False
+
+
+def get_budget(db: Database, name: str) -> Optional[RequestBudget]:
+    ''' Return budget of API by QUOTA_ENVS or None if quota is not set (0) '''
+
+    quota: int = get_env_int(QUOTA_ENVS.get(name, ''), 0)
+    if quota <= 0:
+        return None
+    return RequestBudget(db, name, quota)
+
+
+def acceptance_score(film: Any, current_year: int = 0) -> float:
+    ''' Rank of imdb-api.com film, higher for films more likely accepted:
+        high rating, many votes, recent year '''
+
+    if not current_year:
+        current_year = datetime.datetime.utcnow().year
+    try:
+        rating: float = float(film.get('imDbRating') or 0)
+        count: int = int(film.get('imDbRatingCount') or 0)
+        year: int = int(film.get('year') or 0)
+    except ValueError:
+        return 0
+    return rating + math.log10(count + 1) - max(0, current_year - year) * 0.5
 
 
 def filter_in_db(db: Database, newfilms: Any, imdbid_field_name: str) -> Any:
@@ -103,12 +994,16 @@ def filter_in_db(db: Database, newfilms: Any, imdbid_field_name: str) -> Any:
 
     films: Any = db.get_collection('films')
 
+    imdbids: List[str] = [item[imdbid_field_name] for item in newfilms]
+    if not imdbids:
+        return []
+    # One projected query for all films instead of find_one per film
+    found: Set[str] = {film['imdbId'] for film in
+                       films.find({'imdbId': {'$in': imdbids}}, {'imdbId': 1, '_id': 0})}
+
     notfiltred_films: Any = []
     for item in newfilms:
-        removeflag: bool = False
-        if films.find_one({'imdbId': item[imdbid_field_name]}):
-            removeflag = True
-        if not removeflag:
+        if item[imdbid_field_name] not in found:
             notfiltred_films.append(item)
 
     return notfiltred_films
@@ -116,68 +1011,294 @@ def filter_in_db(db: Database, newfilms: Any, imdbid_field_name: str) -> Any:
 
 def get_imdb_data(client: Session,
                   data_type: str,
-                  param: str = '') -> Optional[Response]:
-    ''' Get imdb api data, data_type - 'popular', 'details'. param - imdb id, etc. '''
+                  param: str = '',
+                  budget: Optional[RequestBudget] = None) -> Optional[Response]:
+    ''' Get imdb api data, data_type - 'popular', 'top250', 'details'.
+        param - imdb id, etc. Call is not made if budget is exhausted. '''
 
     imdb_apikey: Optional[str] = os.environ.get('IMDB_APIKEY')
     if not imdb_apikey:
-        print('Could not get env IMDB_APIKEY', file=sys.stderr)
+        imdb_log.error('Could not get env IMDB_APIKEY')
         raise Exception('Could not get env IMDB_APIKEY')
 
+    # IMDB_API_URL - for local stand-in servers (benchmarks)
+    imdb_url: str = os.environ.get('IMDB_API_URL') or 'https://imdb-api.com'
     headers: Dict[str, str] = {'User-Agent': 'Mozilla/5.0'}
     if data_type == 'popular':
-        print('Getting Popular films from imdb...')
-        r: Response = client.get('https://imdb-api.com/ru/API/MostPopularMovies/' +
-                                 imdb_apikey, headers=headers)
+        imdb_log.info('Getting Popular films from imdb...')
+        url: str = imdb_url + '/ru/API/MostPopularMovies/' + imdb_apikey
+    if data_type == 'top250':
+        imdb_log.info('Getting Top 250 films from imdb...')
+        url = imdb_url + '/ru/API/Top250Movies/' + imdb_apikey
     if data_type == 'details':
-        print('Getting detail of film', param, '...')
-        url = 'https://imdb-api.com/ru/API/Title/' + imdb_apikey + '/' + param
-        r = client.get(url, headers=headers)
+        imdb_log.debug('Getting detail of film %s...', param, extra={'imdbId': param})
+        url = imdb_url + '/ru/API/Title/' + imdb_apikey + '/' + param
+
+    if budget is not None and not budget.take():
+        imdb_log.warning('Daily quota of imdb-api.com is exhausted',
+                         extra={'data_type': data_type, 'imdbId': param})
+        return None
+    try:
+        with host_slot(url):
+            r: Response = client.get(url, headers=headers)
+    # Timeouts, connection errors - skip like answer without result
+    except RequestException as err:
+        imdb_log.warning('Request failed: %s', err,
+                         extra={'data_type': data_type, 'imdbId': param})
+        return None
 
     if r.status_code == 200:
-        print('Processing result...')
+        imdb_log.debug('Processing result...')
         return r
 
-    print('No result')
+    imdb_log.warning('No result', extra={'status': r.status_code, 'data_type': data_type})
     return None
 
 
+class RadarrInstance(object):
+    ''' Radarr server films are added into.
+
+        Default instance (no url) is env RADARR_URL, RADARR_APIKEY and uses
+        HTTP client of run. Instances of env RADARR_INSTANCES have own HTTP
+        client (connection pool) and routing rules:
+        genres - only films with one of genres (any film if empty),
+        root_folders - only films with one of root folders chosen by
+        RADARR_ROOT_OTHER / RADARR_ROOT_ANIMATIONS (any film if empty),
+        root_folder_map - root folder -> root folder of instance,
+        quality - qualityProfileId (RADARR_DEFAULT_QUALITY if 0).
+
+    '''
+
+    def __init__(self,
+                 name: str,
+                 url: str = '',
+                 apikey: str = '',
+                 quality: int = 0,
+                 genres: 'Optional[Iterable[str]]' = None,
+                 root_folders: 'Optional[Iterable[str]]' = None,
+                 root_folder_map: 'Optional[Dict[str, str]]' = None) -> None:
+        self.name: str = name
+        self.url: str = url.rstrip('/')
+        self.apikey: str = apikey
+        self.quality: int = quality
+        self.genres: FrozenSet[str] = frozenset(genres or ())
+        self.root_folders: FrozenSet[str] = frozenset(root_folders or ())
+        self.root_folder_map: Dict[str, str] = dict(root_folder_map or {})
+        self.client: Optional[HttpClient] = None
+        self.lock: threading.Lock = threading.Lock()
+
+    def get_client(self, default: Session) -> Session:
+        ''' Return own HTTP client of instance (default client for default
+            instance), new one after AUTORADARR_HTTP_MAX_FAILURES failures in a row '''
+
+        if not self.url:
+            return default
+        with self.lock:
+            if self.client is not None and \
+               self.client.failures >= get_env_int('AUTORADARR_HTTP_MAX_FAILURES', 5):
+                http_log.warning('HTTP requests keep failing - recreating client',
+                                 extra={'radarr': self.name})
+                self.client.close()
+                self.client = None
+            if self.client is None:
+                self.client = make_http_client()
+            return self.client
+
+    def accepts(self, film: Any) -> bool:
+        ''' Check routing rules of instance '''
+
+        if self.genres and not self.genres.intersection(film.get('genres') or ()):
+            return False
+        return not self.root_folders or film.get('rootFolderPath') in self.root_folders
+
+    def prepare(self, film: 'RadarrFilm') -> 'RadarrFilm':
+        ''' Return copy of film (radarr format) with quality and folders of instance '''
+
+        radarr_film: RadarrFilm = dict(film)
+        if self.quality:
+            radarr_film['qualityProfileId'] = self.quality
+        root: str = str(film.get('rootFolderPath') or '')
+        if root in self.root_folder_map:
+            radarr_film['rootFolderPath'] = self.root_folder_map[root]
+            for field in ('folderName', 'path'):
+                value: str = str(film.get(field) or '')
+                if value.startswith(root):
+                    radarr_film[field] = self.root_folder_map[root] + value[len(root):]
+        return radarr_film
+
+    def close(self) -> None:
+        with self.lock:
+            if self.client is not None:
+                self.client.close()
+                self.client = None
+
+
+@functools.lru_cache(maxsize=4)
+def parse_radarr_instances(config: str) -> 'Tuple[RadarrInstance, ...]':
+    ''' Build instances of JSON list, default instance if config is empty '''
+
+    if not config:
+        return (RadarrInstance('radarr'),)
+    try:
+        instances: Tuple[RadarrInstance, ...] = tuple(
+            RadarrInstance(str(item['name']), str(item['url']), str(item['apikey']),
+                           int(item.get('quality') or 0), item.get('genres'),
+                           item.get('root_folders'), item.get('root_folder_map'))
+            for item in json.loads(config))
+    except (ValueError, TypeError, KeyError, AttributeError) as err:
+        radarr_log.error('Could not parse env RADARR_INSTANCES: %s', err)
+        raise Exception('Could not parse env RADARR_INSTANCES')
+    names: Set[str] = {instance.name for instance in instances}
+    if not instances or len(names) != len(instances):
+        radarr_log.error('Env RADARR_INSTANCES must be list of instances with unique names')
+        raise Exception('Could not parse env RADARR_INSTANCES')
+    return instances
+
+
+def get_radarr_instances() -> 'Tuple[RadarrInstance, ...]':
+    ''' Return Radarr instances of env RADARR_INSTANCES - JSON list of
+        {"name", "url", "apikey", "quality", "genres", "root_folders",
+        "root_folder_map"} (see RadarrInstance), default instance if not set.
+
+        Instances (and their connection pools) are built once for config.
+        Env RADARR_DEFAULT_QUALITY is needed only if some instance has no quality.
+
+    '''
+
+    instances: Tuple[RadarrInstance, ...] = parse_radarr_instances(
+        os.environ.get('RADARR_INSTANCES') or '')
+    if not os.environ.get('RADARR_DEFAULT_QUALITY') and \
+       any(not instance.quality for instance in instances):
+        radarr_log.error('Could not get env RADARR_DEFAULT_QUALITY')
+        raise Exception('Could not get env RADARR_DEFAULT_QUALITY')
+    return instances
+
+
 def get_radarr_data(client: Session,
                     data_type: str,
-                    api_json: Any = '') -> Optional[Response]:
-    ''' Get radarr data, data_type - 'get_movie', 'add_movie'.
+                    api_json: Any = '',
+                    instance: Optional[RadarrInstance] = None) -> Optional[Response]:
+    ''' Get radarr data, data_type - 'get_movie', 'add_movie', 'import_movies',
+        'lookup_imdb'.
 
-        Prefix - json film to add, etc.
+        Prefix - json film to add, list of films to import, imdbId to lookup, etc.
+        instance - Radarr instance, default - env RADARR_URL, RADARR_APIKEY.
 
     '''
 
     radarr_apikey: Optional[str] = os.environ.get('RADARR_APIKEY')
+    radarr_url: Optional[str] = os.environ.get('RADARR_URL')
+    if instance is not None and instance.url:
+        radarr_apikey, radarr_url = instance.apikey, instance.url
     if not radarr_apikey:
-        print('Could not get env RADARR_APIKEY', file=sys.stderr)
+        radarr_log.error('Could not get env RADARR_APIKEY')
         raise Exception('Could not get env RADARR_APIKEY')
-    radarr_url: Optional[str] = os.environ.get('RADARR_URL')
     if not radarr_url:
-        print('Could not get env RADARR_URL', file=sys.stderr)
+        radarr_log.error('Could not get env RADARR_URL')
         raise Exception('Could not get env RADARR_URL')
 
+    try:
+        return send_radarr_request(client, data_type, api_json, radarr_url, radarr_apikey)
+    # Timeouts, connection errors - same as error answer
+    except RequestException as err:
+        radarr_log.warning('Request failed: %s', err, extra={'data_type': data_type})
+        return None
+
+
+def send_radarr_request(client: Session,
+                        data_type: str,
+                        api_json: Any,
+                        radarr_url: str,
+                        radarr_apikey: str) -> Optional[Response]:
+    ''' Request of get_radarr_data, return None if answer is not successful '''
+
     headers: Dict[str, str] = {'User-Agent': 'Mozilla/5.0'}
     if data_type == 'get_movie':
+        # Library is big - stream it to get_radarr_imdbid_list
         r: Response = client.get(radarr_url + '/api/v3/movie?apiKey=' +
-                                 radarr_apikey, headers=headers)
+                                 radarr_apikey, headers=headers, stream=True)
         if r.status_code == 200:
             return r
+        r.close()
     if data_type == 'add_movie':
-        r = client.post(radarr_url + '/api/v3/movie?apiKey=' +
-                        radarr_apikey, json=api_json, headers=headers)
+        url: str = radarr_url + '/api/v3/movie?apiKey=' + radarr_apikey
+        with host_slot(url):
+            r = client.post(url, json=api_json, headers=headers)
         if r.status_code == 201:
             return r
+    if data_type == 'import_movies':
+        url = radarr_url + '/api/v3/movie/import?apiKey=' + radarr_apikey
+        with host_slot(url):
+            r = client.post(url, json=api_json, headers=headers)
+        if r.status_code in (200, 201, 202):
+            return r
+    if data_type == 'lookup_imdb':
+        r = client.get(radarr_url + '/api/v3/movie/lookup/imdb?imdbId=' + str(api_json) +
+                       '&apiKey=' + radarr_apikey, headers=headers)
+        if r.status_code == 200:
+            return r
 
     return None
 
 
+def iter_json_array(chunks: 'Iterable[bytes]') -> 'Iterator[Any]':
+    ''' Yield items of JSON array read by chunks of bytes, so only one item
+        is kept in memory. Raise ValueError if JSON is not array or broken. '''
+
+    decoder: json.JSONDecoder = json.JSONDecoder()
+    text: Any = codecs.getincrementaldecoder('utf-8')()
+    buf: str = ''
+    pos: int = 0
+    started: bool = False
+    chunks_iter: Iterator[bytes] = iter(chunks)
+    finished: bool = False
+
+    while True:
+        # Skip whitespace and separators before next item
+        while pos < len(buf) and (buf[pos].isspace() or (started and buf[pos] == ',')):
+            pos += 1
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('JSON array expected')
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                end = -1
+            # Item not followed by separator could be cut (number, etc) - need next chunk
+            if end >= 0 and ((end < len(buf) and buf[end] in ' \t\r\n,]') or finished):
+                yield item
+                pos = end
+                continue
+            if finished:
+                raise ValueError('Broken JSON array')
+        elif finished:
+            raise ValueError('Unexpected end of JSON array')
+
+        chunk: Optional[bytes] = next(chunks_iter, None)
+        if chunk is None:
+            finished = True
+            buf = buf[pos:] + text.decode(b'', final=True)
+        else:
+            buf = buf[pos:] + text.decode(chunk)
+        pos = 0
+
+
 def get_radarr_imdbid_list(r: Response) -> 'List[Any]':
+    ''' Return imdbIds of Radarr library ({'imdbId': '0'} if film has no imdbId).
+
+        Library is parsed by chunks while it is downloaded, only imdbIds stay
+        in memory.
+
+    '''
+
     imdb_list: List[Any] = []
-    for item in r.json():
+    for item in iter_json_array(r.iter_content(chunk_size=64 * 1024)):
         if 'imdbId' not in item:
             imdb_list.append({'imdbId': '0'})
         elif item['imdbId']:
@@ -185,63 +1306,392 @@ def get_radarr_imdbid_list(r: Response) -> 'List[Any]':
     return imdb_list
 
 
+def get_radarr_index(imdbid_list: 'List[Any]') -> 'FrozenSet[str]':
+    ''' Return hashed index of radarr imdbIds for O(1) membership check.
+
+        Placeholders of films without imdbId ({'imdbId': '0'}) are skipped,
+        they never match any film.
+
+    '''
+
+    return frozenset(imdbid for imdbid in imdbid_list if isinstance(imdbid, str))
+
+
+def fetch_radarr_indexes(client: Session) -> 'Dict[str, Optional[FrozenSet[str]]]':
+    ''' Get libraries of all Radarr instances concurrently, return
+        name of instance -> index of library (None if instance is unavailable) '''
+
+    def fetch(instance: RadarrInstance) -> 'Optional[FrozenSet[str]]':
+        r: Optional[Response] = get_radarr_data(instance.get_client(client), 'get_movie',
+                                                instance=instance)
+        if r is None:
+            radarr_log.error('Could not get Radarr library', extra={'radarr': instance.name})
+            return None
+        try:
+            return get_radarr_index(get_radarr_imdbid_list(r))
+        # Connection broken while library is streamed
+        except RequestException as err:
+            radarr_log.error('Could not get Radarr library: %s', err,
+                             extra={'radarr': instance.name})
+            return None
+
+    instances: Tuple[RadarrInstance, ...] = get_radarr_instances()
+    if len(instances) == 1:
+        return {instances[0].name: fetch(instances[0])}
+    with ThreadPoolExecutor(max_workers=len(instances)) as executor:
+        return dict(zip([instance.name for instance in instances],
+                        executor.map(fetch, instances)))
+
+
+def common_index(indexes: 'Iterable[Optional[FrozenSet[str]]]') -> 'FrozenSet[str]':
+    ''' Return index of films persisting in all libraries (unknown library - empty) '''
+
+    common: Optional[FrozenSet[str]] = None
+    for index in indexes:
+        if index is None:
+            return frozenset()
+        common = index if common is None else common & index
+    return common or frozenset()
+
+
+def film_mark_doc(imdbid: str, title: str, persist_in_radarr: int = 0) -> 'Dict[str, Any]':
+    ''' Return films document to mark film in DB '''
+
+    if persist_in_radarr == 1:
+        return {'imdbId': imdbid, 'originalTitle': title,
+                'persistInRadarr': persist_in_radarr,
+                'added': datetime.datetime.utcnow()}
+    return {'imdbId': imdbid, 'originalTitle': title, 'filtred': 1,
+            'added': datetime.datetime.utcnow()}
+
+
+def imdbid_number(imdbid: str) -> Optional[int]:
+    ''' Return number of 'tt<digits>' imdb id fitting uint32, None for others '''
+
+    if imdbid[:2] != 'tt' or not imdbid[2:].isdigit():
+        return None
+    number: int = int(imdbid[2:])
+    return number if number < 2 ** 32 else None
+
+
+# Marks of films are dated when collected, written later - seen index is
+# reconciled with marks from this time before its last save
+SEEN_RECONCILE_MARGIN: datetime.timedelta = datetime.timedelta(days=1)
+
+
+class SeenIndex(object):
+    ''' imdbIds of known films (DB marks and Radarr library) for dedup
+        without DB queries.
+
+        Ids are kept in file as sorted uint32 array (native byte order),
+        file is mapped by mmap and searched by bisect. New ids are kept in
+        set till save() merges them into file by atomic rewrite.
+        Ids not like 'tt<digits>' are kept in memory only.
+
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self.lock: threading.Lock = threading.Lock()
+        self.added: Set[int] = set()
+        self.other: Set[str] = set()
+        self.file: Any = None
+        self.map: Optional[mmap.mmap] = None
+        self.ids: Any = array.array('I')
+        self.load()
+
+    def saved(self) -> Optional[datetime.datetime]:
+        ''' Return UTC time of last save, None if there is no file '''
+
+        if not os.path.exists(self.path):
+            return None
+        return datetime.datetime.utcfromtimestamp(os.path.getmtime(self.path))
+
+    def load(self) -> None:
+        ''' (Re)map file, broken or missing file gives empty index '''
+
+        self.close()
+        if not os.path.exists(self.path) or not os.path.getsize(self.path):
+            return
+        if os.path.getsize(self.path) % self.ids.itemsize:
+            log.warning('Seen index %s is broken - ignored', self.path)
+            return
+        self.file = open(self.path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.ids = memoryview(self.map).cast('I')
+
+    def close(self) -> None:
+        if isinstance(self.ids, memoryview):
+            self.ids.release()
+        self.ids = array.array('I')
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __len__(self) -> int:
+        return len(self.ids) + len(self.added) + len(self.other)
+
+    def __contains__(self, imdbid: str) -> bool:
+        number: Optional[int] = imdbid_number(imdbid)
+        with self.lock:
+            if number is None:
+                return imdbid in self.other
+            if number in self.added:
+                return True
+            index: int = bisect.bisect_left(self.ids, number)
+            return index < len(self.ids) and self.ids[index] == number
+
+    def update(self, imdbids: 'Iterable[str]') -> None:
+        with self.lock:
+            for imdbid in imdbids:
+                number: Optional[int] = imdbid_number(imdbid)
+                if number is None:
+                    self.other.add(imdbid)
+                else:
+                    self.added.add(number)
+
+    def save(self) -> bool:
+        ''' Merge new ids into file, return False if nothing to save or error '''
+
+        with self.lock:
+            if not self.added:
+                return False
+            merged: 'array.array[int]' = array.array('I')
+            last: int = -1
+            for number in heapq.merge(self.ids, sorted(self.added)):
+                if number != last:
+                    merged.append(number)
+                    last = number
+            temp_path: str = self.path + '.tmp'
+            try:
+                with open(temp_path, 'wb') as temp:
+                    merged.tofile(temp)
+                    temp.flush()
+                    os.fsync(temp.fileno())
+                os.replace(temp_path, self.path)
+            except OSError as err:
+                log.error('Could not save seen index %s with error: %s', self.path, err)
+                return False
+            self.added.clear()
+            self.load()
+        return True
+
+
+class MarkBuffer(object):
+    ''' Collect films marks during run and write them by one bulk_write.
+
+        Every mark is upsert keyed on imdbId with $setOnInsert, so already
+        marked films stay untouched and there is no read before write.
+        Films are added to seen index after their marks have been written,
+        so failed writes are not seen and are tried by next runs.
+
+    '''
+
+    def __init__(self, db: Database, seen: Optional[SeenIndex] = None) -> None:
+        self.db: Database = db
+        self.seen: Optional[SeenIndex] = seen
+        # imdbId -> document, first mark of film wins as in DB
+        self.docs: Dict[str, Dict[str, Any]] = {}
+        # Background writes (flush_background), one at a time
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.pending: List[Any] = []
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def add(self, imdbid: str, title: str, persist_in_radarr: int = 0) -> None:
+        if imdbid not in self.docs:
+            self.docs[imdbid] = film_mark_doc(imdbid, title, persist_in_radarr)
+
+    def flush(self) -> int:
+        ''' Write collected marks, wait for background writes and
+            return count of new films in DB '''
+
+        count: int = sum(future.result() for future in self.pending)
+        self.pending = []
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        docs: Dict[str, Dict[str, Any]] = self.docs
+        self.docs = {}
+        return count + self.write(docs)
+
+    def flush_background(self) -> None:
+        ''' Write collected marks in background thread, flush() waits for them '''
+
+        if not self.docs:
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        docs: Dict[str, Dict[str, Any]] = self.docs
+        self.docs = {}
+        self.pending.append(self.executor.submit(self.write, docs))
+
+    def write(self, docs: 'Dict[str, Dict[str, Any]]') -> int:
+        if not docs:
+            return 0
+        requests_list: List[pymongo.UpdateOne] = [
+            pymongo.UpdateOne({'imdbId': imdbid}, {'$setOnInsert': doc}, upsert=True)
+            for imdbid, doc in docs.items()
+        ]
+        imdbids: List[str] = list(docs)
+        try:
+            result: Any = self.db.get_collection('films').bulk_write(requests_list,
+                                                                     ordered=False)
+        except pymongo.errors.BulkWriteError as err:
+            db_log.error('Could not write marks into DB with error: %s', err.details)
+            failed: Set[int] = {error['index'] for error in err.details.get('writeErrors', [])}
+            self.mark_seen([imdbid for index, imdbid in enumerate(imdbids)
+                            if index not in failed])
+            return int(err.details.get('nUpserted', 0))
+        except pymongo.errors.PyMongoError as err:
+            db_log.error('Could not write marks into DB with error: %s', err)
+            return 0
+        self.mark_seen(imdbids)
+        return int(result.upserted_count)
+
+    def mark_seen(self, imdbids: 'List[str]') -> None:
+        if self.seen is not None:
+            self.seen.update(imdbids)
+
+
 def mark_filtred_in_db(db: Database,
                        imdbid: str,
                        title: str,
-                       persist_in_radarr: int = 0) -> bool:
+                       persist_in_radarr: int = 0,
+                       buffer: Optional[MarkBuffer] = None) -> bool:
     ''' Mark film 'filtred' in DB and return True.
 
-        If already founded in DB - return False
+        If already founded in DB - return False.
+        If buffer is set - mark is delayed till buffer.flush() and return True.
 
     '''
 
-    films: Any = db.get_collection('films')
+    if buffer is not None:
+        buffer.add(imdbid, title, persist_in_radarr)
+        return True
 
-    if films.find_one({'imdbId': imdbid}):
-        return False
-
-    if persist_in_radarr == 1:
-        films.insert_one({'imdbId': imdbid, 'originalTitle': title,
-                          'persistInRadarr': persist_in_radarr,
-                          'added': datetime.datetime.utcnow()})
-    else:
-        films.insert_one({'imdbId': imdbid, 'originalTitle': title, 'filtred': 1,
-                          'added': datetime.datetime.utcnow()})
-
-    return True
+    films: Any = db.get_collection('films')
+    result: Any = films.update_one({'imdbId': imdbid},
+                                   {'$setOnInsert': film_mark_doc(imdbid, title,
+                                                                  persist_in_radarr)},
+                                   upsert=True)
+    return result.upserted_id is not None
 
 
 def filter_in_radarr(client: Session,
                      db: Database,
                      newfilms: Any,
                      imdbid_field_name: str,
-                     title_field_name: str) -> Any:
-    ''' Filter if film already persist in Radarr '''
+                     title_field_name: str,
+                     buffer: Optional[MarkBuffer] = None,
+                     radarr_index: Optional[FrozenSet[str]] = None) -> Any:
+    ''' Filter if film already persist in Radarr.
 
-    r: Optional[Response] = get_radarr_data(client, 'get_movie')
-    if r is None:
-        return newfilms
-    imdbid_list: List[str] = get_radarr_imdbid_list(r)
+        radarr_index - already loaded index of Radarr library,
+        if None - library is got from Radarr.
+        With many Radarr instances only films persisting in all of them are
+        filtered.
+
+    '''
+
+    if radarr_index is None:
+        indexes: Dict[str, Optional[FrozenSet[str]]] = fetch_radarr_indexes(client)
+        if all(index is None for index in indexes.values()):
+            return newfilms
+        radarr_index = common_index(indexes.values())
 
     notfiltred_films: Any = []
     for item in newfilms:
         removeflag: bool = False
-        if item[imdbid_field_name] in imdbid_list:
+        if item[imdbid_field_name] in radarr_index:
             removeflag = True
-            mark_filtred_in_db(db, item[imdbid_field_name], item[title_field_name], 1)
+            mark_filtred_in_db(db, item[imdbid_field_name], item[title_field_name], 1,
+                               buffer)
         if not removeflag:
             notfiltred_films.append(item)
 
     return notfiltred_films
 
 
-def normalize_filepath(filepath: str) -> str:
-    value: str = str(filepath)
-    # TODO get replace format from env
-    value = value.replace(':', ' - ')   # Radarr format
+# Radarr format of folder name, https://wiki.servarr.com/radarr/settings#folder-naming
+DEFAULT_FOLDER_FORMAT: str = '{Movie Title} ({Release Year})'
+# Radarr token -> imdb-api.com field
+FOLDER_TOKENS: Dict[str, str] = {'Movie Title': 'title',
+                                 'Release Year': 'year',
+                                 'ImdbId': 'id'}
+FOLDER_TOKEN_RE: Any = re.compile(r'{([^{}]*)}')
+NOT_PATH_CHARS_RE: Any = re.compile(r'[^-()\w\s]')
+PATH_SEPARATORS_RE: Any = re.compile(r'[-\t\n\r\f\v]+')
+
+
+@functools.lru_cache(maxsize=4096)
+def sanitize_path_fragment(fragment: str) -> str:
+    ''' Remove not path chars from part of folder name (chars one by one) '''
+
+    value: str = fragment.replace(':', ' - ')   # Radarr format
     value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode('ascii')
-    value = re.sub(r'[^-()\w\s]', '', value)
-    return re.sub(r'[-\t\n\r\f\v]+', '-', value).strip('-_').replace('  ', ' ').strip()
+    return NOT_PATH_CHARS_RE.sub('', value)
+
+
+def collapse_path(value: str) -> str:
+    ''' Collapse separators and spaces of sanitized folder name '''
+
+    return PATH_SEPARATORS_RE.sub('-', value).strip('-_').replace('  ', ' ').strip()
+
+
+def normalize_filepath(filepath: str) -> str:
+    return collapse_path(sanitize_path_fragment(str(filepath)))
+
+
+class FolderFormat(object):
+    ''' Radarr-style folder name template compiled once.
+
+        Literal parts are sanitized at compile time, token values are
+        sanitized by memoised sanitize_path_fragment().
+
+    '''
+
+    def __init__(self, template: str) -> None:
+        self.template: str = template
+        # (field of film or None, sanitized literal)
+        self.parts: List[Tuple[Optional[str], str]] = []
+        position: int = 0
+        for match in FOLDER_TOKEN_RE.finditer(template):
+            if match.start() > position:
+                self.parts.append((None, sanitize_path_fragment(template[position:match.start()])))
+            if match.group(1) not in FOLDER_TOKENS:
+                raise Exception('Unknown token in folder format: ' + match.group(0))
+            self.parts.append((FOLDER_TOKENS[match.group(1)], ''))
+            position = match.end()
+        if position < len(template):
+            self.parts.append((None, sanitize_path_fragment(template[position:])))
+        # imdb-api.com fullTitle is default format already
+        self.full_title: bool = template == DEFAULT_FOLDER_FORMAT
+
+    def __call__(self, film: Any) -> str:
+        ''' Return folder name of film, empty if nothing left after sanitizing '''
+
+        if self.full_title and film.get('fullTitle'):
+            return collapse_path(sanitize_path_fragment(str(film['fullTitle'])))
+        return collapse_path(''.join(
+            sanitize_path_fragment(str(film.get(field) or '')) if field else literal
+            for field, literal in self.parts))
+
+
+@functools.lru_cache(maxsize=8)
+def compile_folder_format(template: str) -> FolderFormat:
+    return FolderFormat(template)
+
+
+def get_folder_format() -> FolderFormat:
+    ''' Return compiled env RADARR_FOLDER_FORMAT (default DEFAULT_FOLDER_FORMAT) '''
+
+    return compile_folder_format(os.environ.get('RADARR_FOLDER_FORMAT') or
+                                 DEFAULT_FOLDER_FORMAT)
 
 
 def set_root_folders_by_genres(film: Any, genres: Any) -> Any:
@@ -250,40 +1700,112 @@ def set_root_folders_by_genres(film: Any, genres: Any) -> Any:
     # TODO parse many types of genres path from env
     radarr_root_other: str = str(os.environ.get('RADARR_ROOT_OTHER'))
     radarr_root_animations: str = str(os.environ.get('RADARR_ROOT_ANIMATIONS'))
-    # TODO getformat from radarr template (from env?) -
-    # '{Movie Title} ({Release Year})'
 
-    if normalize_filepath(film['fullTitle']) == '':
+    folder_name: str = get_folder_format()(film)
+    if folder_name == '':
         raise Exception('Directory name can\'t be empty')
 
     film['rootFolderPath'] = radarr_root_other
-    film['folderName'] = radarr_root_other + '/' + normalize_filepath(film['fullTitle'])
     if 'Animation' in genres:
         film['rootFolderPath'] = radarr_root_animations
-        film['folderName'] = radarr_root_animations + '/' + normalize_filepath(film['fullTitle'])
+    film['folderName'] = film['rootFolderPath'] + '/' + folder_name
     return film
 
 
+def get_imdb_details(client: Session,
+                     db: Database,
+                     imdbid: str,
+                     budget: Optional[RequestBudget] = None) -> 'Optional[Dict[str, Any]]':
+    ''' Get imdb details of film (DETAIL_CACHE_FIELDS only) or None if error.
+
+        Details are cached in 'imdb_details' collection for
+        env AUTORADARR_DETAIL_CACHE_TTL seconds (default 7 days, 0 - disabled),
+        only cache misses spend budget.
+
+    '''
+
+    ttl: int = get_env_int('AUTORADARR_DETAIL_CACHE_TTL', 7 * 24 * 60 * 60)
+    details: Any = db.get_collection('imdb_details')
+    if ttl > 0:
+        fresh: datetime.datetime = datetime.datetime.utcnow() - datetime.timedelta(seconds=ttl)
+        cached: Any = details.find_one({'imdbId': imdbid, 'cached': {'$gte': fresh}})
+        count_cache('imdb_details', cached is not None)
+        if cached is not None:
+            return {field: cached.get(field) for field in DETAIL_CACHE_FIELDS}
+
+    r: Optional[Response] = get_imdb_data(client, 'details', imdbid, budget)
+    if r is None:
+        return None
+    data: Any = r.json()
+    # imdb-api.com returns 200 with empty fields on errors (quota, etc)
+    if not data.get('genres'):
+        return None
+
+    film_details: Dict[str, Any] = {field: data.get(field) for field in DETAIL_CACHE_FIELDS}
+    if ttl > 0:
+        details.update_one({'imdbId': imdbid},
+                           {'$set': dict(film_details, cached=datetime.datetime.utcnow())},
+                           upsert=True)
+    return film_details
+
+
+def fetch_imdb_details(client: Session,
+                       db: Database,
+                       imdbids: 'List[str]',
+                       workers: int = 1,
+                       budget: Optional[RequestBudget] = None
+                       ) -> 'List[Optional[Dict[str, Any]]]':
+    ''' Get imdb details of films, return results in order of imdbids.
+
+        With workers > 1 films are fetched by thread pool, concurrent
+        requests to one host are limited by host_slot().
+
+    '''
+
+    if workers <= 1 or len(imdbids) <= 1:
+        return [get_imdb_details(client, db, imdbid, budget) for imdbid in imdbids]
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(imdbids))) as executor:
+        return list(executor.map(lambda imdbid: get_imdb_details(client, db, imdbid, budget),
+                                 imdbids))
+
+
 def filter_by_detail(client: Session,
                      db: Database,
                      newfilms: Any,
-                     rating_type: str = 'imdb-api.com') -> Any:
-    ''' Filter by film's genres, etc. '''
+                     rating_type: str = 'imdb-api.com',
+                     buffer: Optional[MarkBuffer] = None,
+                     workers: int = 0) -> Any:
+    ''' Filter by film's genres, etc.
+
+        workers - count of concurrent detail requests,
+        default from env AUTORADARR_DETAIL_WORKERS (4).
+        Detail requests spend imdb-api.com budget (AUTORADARR_IMDB_DAILY_QUOTA),
+        films not fetched because of quota are skipped till next scan.
+
+    '''
 
     accepted_genres: Set[str] = {'Action', 'Adventure', 'Sci-Fi', 'Animation', 'Comedy'}
     bad_genres: Set[str] = {'Drama'}
     notfiltred_films: Any = []
 
-    for item in newfilms:
+    if not workers:
+        workers = get_env_int('AUTORADARR_DETAIL_WORKERS', 4)
+    details: List[Optional[Dict[str, Any]]] = []
+    if rating_type == 'imdb-api.com':
+        details = fetch_imdb_details(client, db, [item['id'] for item in newfilms], workers,
+                                     get_budget(db, 'imdb-api.com'))
+
+    for index, item in enumerate(newfilms):
         removeflag: bool = True
         genres: Any = []
         rating: float = 0
         if rating_type == 'imdb-api.com':
-            r: Union[Response, None] = get_imdb_data(client, 'details', item['id'])
+            film_details: Optional[Dict[str, Any]] = details[index]
             # Skip film - don't add to notfiltred and NOT filter it in db.
-            if r is None:
+            if film_details is None:
                 continue
-            genres = r.json()['genres'].split(', ')
+            genres = film_details['genres'].split(', ')
             rating = float(item['imDbRating'])
 
         if set.intersection(accepted_genres, genres):
@@ -293,29 +1815,144 @@ def filter_by_detail(client: Session,
 
         if not removeflag:
             new_film: Any = set_root_folders_by_genres(item, genres)
+            # Films are routed to Radarr instances by genres
+            new_film['genres'] = genres
             notfiltred_films.append(new_film)
         else:
             # Next scan will ignore this film
-            mark_filtred_in_db(db, item['id'], item['title'])
+            mark_filtred_in_db(db, item['id'], item['title'], buffer=buffer)
 
     return notfiltred_films
 
 
-def filter_imdb_films(client: Session, db: Database, newfilms: Any) -> Any:
+def sync_radarr_index(client: Session) -> 'Optional[FrozenSet[str]]':
+    ''' Get libraries of Radarr instances, store their indexes in radarr_library
+        and return index of films persisting in all instances.
+
+        Return None if no instance is available (previous indexes are kept),
+        unavailable instance keeps its previous index.
+
+    '''
+
+    indexes: Dict[str, Optional[FrozenSet[str]]] = fetch_radarr_indexes(client)
+    if all(index is None for index in indexes.values()):
+        return None
+    with radarr_library_lock:
+        instances: Dict[str, Optional[FrozenSet[str]]] = {
+            name: radarr_library['instances'].get(name) if index is None else index
+            for name, index in indexes.items()}
+        radarr_index: FrozenSet[str] = common_index(instances.values())
+        radarr_library['index'] = radarr_index
+        radarr_library['instances'] = instances
+        radarr_library['loaded'] = time.monotonic()
+    return radarr_index
+
+
+def load_radarr_index(client: Session) -> 'FrozenSet[str]':
+    ''' Return index of Radarr library or empty index if Radarr is unavailable.
+
+        Index synced less than env AUTORADARR_RADARR_MAX_AGE seconds ago
+        (default 1800, 0 - always get library) is reused.
+
+    '''
+
+    max_age: int = get_env_int('AUTORADARR_RADARR_MAX_AGE', 30 * 60)
+    with radarr_library_lock:
+        radarr_index: Optional[FrozenSet[str]] = radarr_library['index']
+        loaded: float = radarr_library['loaded']
+    if radarr_index is not None and time.monotonic() - loaded < max_age:
+        return radarr_index
+    return sync_radarr_index(client) or frozenset()
+
+
+def filter_imdb_films(client: Session,
+                      db: Database,
+                      newfilms: Any,
+                      buffer: Optional[MarkBuffer] = None) -> Any:
     ''' Filter: first (new or popular films list) result (by rating & year,
         etc), if not persist in DB, film's detail (by genres or other) '''
 
-    filtred: Any = filter_regular_result(newfilms, 'imDbRating', 'imDbRatingCount', 'year')
-    filtred = filter_in_db(db, filtred, 'id')
-    filtred = filter_in_radarr(client, db, filtred, 'id', 'title')
-    filtred = filter_by_detail(client, db, filtred)
-    return filtred
+    return [film for chunk in iter_imdb_films(client, db, newfilms, buffer) for film in chunk]
+
+
+def iter_regular_chunks(batches: 'Iterable[Any]',
+                        chunk_size: int,
+                        budget: Optional[RequestBudget] = None) -> 'Iterator[List[Any]]':
+    ''' Yield chunks of chunk_size films of every batch passed
+        filter_regular_result, last chunk of batch could be shorter.
+
+        If budget can't pay details of all films of batch, films go by
+        acceptance_score.
+
+    '''
+
+    for batch in batches:
+        regular: Iterable[Any] = iter_regular_result(batch, 'imDbRating', 'imDbRatingCount',
+                                                     'year')
+        if budget is not None:
+            regular = list(regular)
+            if budget.available() < len(regular):
+                regular = sorted(regular, key=acceptance_score, reverse=True)
+        yield from iter_chunks(regular, chunk_size)
+
+
+def iter_imdb_films(client: Session,
+                    db: Database,
+                    newfilms: Any,
+                    buffer: Optional[MarkBuffer] = None,
+                    chunk_size: int = 0,
+                    seen: Optional[SeenIndex] = None,
+                    batched: bool = False) -> 'Iterator[List[Any]]':
+    ''' Lazy filter_imdb_films - yield chunks of films passed all filters.
+
+        Films passed filter_regular_result go through next stages by chunks
+        of chunk_size (env AUTORADARR_CHUNK_SIZE, default 10), so first films
+        can be added before details of next ones are fetched.
+        batched - newfilms are batches of films (one per provider), batch is
+        filtered as soon as it comes and its chunks don't wait for next batch.
+        Radarr library is loaded once when first chunk reaches it.
+        Buffered marks are flushed after every chunk.
+        If imdb-api.com budget can't pay details of all films, films go
+        by acceptance_score, so quota is spent on most promising ones.
+        With seen index known films are removed without DB queries and
+        marks are written in background.
 
+    '''
+
+    if not chunk_size:
+        chunk_size = max(1, get_env_int('AUTORADARR_CHUNK_SIZE', 10))
+    radarr_index: Optional[FrozenSet[str]] = None
 
-def convert_imdb_in_radarr(newfilms: Any) -> 'List[Dict[str, Union[str, int]]]':
+    batches: Iterable[Any] = newfilms if batched else [newfilms]
+    for chunk in iter_regular_chunks(batches, chunk_size, get_budget(db, 'imdb-api.com')):
+        if seen is not None:
+            with StageTimer('filter_seen', chunk) as stage:
+                filtred: Any = stage.out([film for film in chunk if film['id'] not in seen])
+        else:
+            with StageTimer('filter_in_db', chunk) as stage:
+                filtred = stage.out(filter_in_db(db, chunk, 'id'))
+        if not filtred:
+            continue
+        if radarr_index is None:
+            with StageTimer('load_radarr_index'):
+                radarr_index = load_radarr_index(client)
+        with StageTimer('filter_in_radarr', filtred) as stage:
+            filtred = stage.out(filter_in_radarr(client, db, filtred, 'id', 'title', buffer,
+                                                 radarr_index))
+        with StageTimer('filter_by_detail', filtred) as stage:
+            filtred = stage.out(filter_by_detail(client, db, filtred, buffer=buffer))
+        if buffer is not None and seen is not None:
+            buffer.flush_background()
+        elif buffer is not None:
+            buffer.flush()
+        if filtred:
+            yield filtred
+
+
+def convert_imdb_in_radarr(newfilms: Any) -> 'List[RadarrFilm]':
     ''' return newfilms in radarr api format (list[dict]) '''
 
-    new_radarr_films: List[Dict[str, Union[str, int]]] = []
+    new_radarr_films: List[RadarrFilm] = []
     for item in newfilms:
         new_radarr_films.append({
             'originalTitle': item['title'],
@@ -324,40 +1961,405 @@ def convert_imdb_in_radarr(newfilms: Any) -> 'List[Dict[str, Union[str, int]]]':
             'folderName': item['folderName'],
             'rootFolderPath': item['rootFolderPath']
         })
+        # Genres route film to Radarr instances
+        if item.get('genres'):
+            new_radarr_films[-1]['genres'] = list(item['genres'])
     return new_radarr_films
 
 
-def get_new_from_imdb(client: Session, db: Database) -> 'List[Dict[str, Union[str, int]]]':
-    ''' Get new films from imdb-api.com.
+class Provider(object):
+    ''' Source of new films.
 
-        1. Get new films
-        2. NOT ADD film if old, allready persist in DB or marked_filtred, etc.
-        3. Convert in radarr format.
+        fetch(client) returns list of films or None if error.
+        fields - imdb-api.com field -> field of provider's film
+        ('id', 'title', 'fullTitle', 'year', 'imDbRating', 'imDbRatingCount'),
+        films are converted to imdb-api.com fields before filters.
 
     '''
 
-    radarr_newfilms: List[Dict[str, Union[str, int]]] = []
-    r: Union[Response, None] = get_imdb_data(client, 'popular')
+    def __init__(self,
+                 name: str,
+                 fetch: Any,
+                 fields: 'Optional[Dict[str, str]]' = None,
+                 budget: Optional[str] = None) -> None:
+        self.name: str = name
+        self.fetch: Any = fetch
+        self.fields: Dict[str, str] = fields or {}
+        # Name of budget (QUOTA_ENVS) spent by one fetch
+        self.budget: Optional[str] = budget
+
+    def get_films(self, client: Session) -> 'Optional[List[Any]]':
+        films: Optional[List[Any]] = self.fetch(client)
+        if films is None or not self.fields:
+            return films
+        return [{field: film.get(provider_field)
+                 for field, provider_field in self.fields.items()} for film in films]
+
+
+providers: Dict[str, Provider] = {}
+
+
+def register_provider(provider: Provider) -> Provider:
+    providers[provider.name] = provider
+    return provider
+
+
+def get_imdb_list(client: Session, data_type: str) -> 'Optional[List[Any]]':
+    ''' Return items of imdb-api.com list (MostPopularMovies, Top250Movies) '''
+
+    r: Optional[Response] = get_imdb_data(client, data_type)
     if r is None:
-        return radarr_newfilms
-    newfilms: Any = filter_imdb_films(client, db, r.json()['items'])
-    radarr_newfilms = convert_imdb_in_radarr(newfilms)
-    return radarr_newfilms
+        return None
+    return r.json()['items']
 
 
-def get_new_films(client: Session, db: Database) -> 'List[Dict[str, Union[str, int]]]':
-    ''' Get new films from some kind of rating providers.
+register_provider(Provider('imdb_popular', lambda client: get_imdb_list(client, 'popular'),
+                           budget='imdb-api.com'))
+register_provider(Provider('imdb_top250', lambda client: get_imdb_list(client, 'top250'),
+                           budget='imdb-api.com'))
+# TODO register_provider(Provider('kinopoisk', get_kinopoisk_list, {'id': ..., }))
 
-        Get_new_from_imdb, get_new_from_kinopoisk (TODO) if enabled (TODO).
-        Geters must return fields IN RADARR format.
-        schema: get_new_films - get_new_from_imdb|kinopoisk|etc -
-                filter_imdb|kinopoisk|etc - filter_*.
+
+def month_start(moment: datetime.datetime) -> datetime.datetime:
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def record_ratings(db: Database,
+                   films: 'List[Film]',
+                   now: Optional[datetime.datetime] = None) -> int:
+    ''' Store rating and votes of films in 'rating_history', return count of
+        observations.
+
+        One document per film and month keeps parallel arrays:
+        t - minutes since month start, r - rating * 10, c - votes,
+        and latest observation {t, r, c} in 'last' for queries.
+        Films without rating or votes are skipped.
 
     '''
 
-    newfilms: List[Dict[str, Union[str, int]]] = get_new_from_imdb(client, db)
-    # TODO get_new_from_kinopoisk(client, db)
-    return newfilms
+    if now is None:
+        now = datetime.datetime.utcnow()
+    month: datetime.datetime = month_start(now)
+    offset: int = int((now - month).total_seconds() // 60)
+    updates: List[Any] = []
+    for film in films:
+        if not film.id or not film.rating or not film.rating_count:
+            continue
+        rating: int = int(round(film.rating * 10))
+        count: int = film.rating_count
+        updates.append(pymongo.UpdateOne({'imdbId': film.id, 'month': month},
+                                         {'$push': {'t': offset, 'r': rating, 'c': count},
+                                          '$set': {'last': {'t': offset, 'r': rating,
+                                                            'c': count}}},
+                                         upsert=True))
+    if not updates:
+        return 0
+    try:
+        db.get_collection('rating_history').bulk_write(updates, ordered=False)
+    except pymongo.errors.BulkWriteError as err:
+        db_log.error('Could not write rating history with error: %s', err.details)
+        return 0
+    # History is not needed by discovery - films go on
+    except pymongo.errors.PyMongoError as err:
+        db_log.error('Could not write rating history with error: %s', err)
+        return 0
+    return len(updates)
+
+
+def films_near_thresholds(db: Database,
+                          rating_margin: float = 0.5,
+                          count_ratio: float = 0.5,
+                          days: int = 30,
+                          now: Optional[datetime.datetime] = None) -> 'List[Dict[str, Any]]':
+    ''' Return films observed in last days which don't pass rating or votes
+        threshold (AUTORADARR_MIN_RATING, AUTORADARR_MIN_RATING_COUNT) yet,
+        but have rating >= threshold - rating_margin and
+        votes >= threshold * count_ratio.
+
+        Every film - {'imdbId', 'rating', 'count', 'countPerDay', 'etaDays'},
+        etaDays - days till votes threshold by votes growth in period
+        (None if votes pass already or don't grow). Films with nearest
+        etaDays go first.
+        Buckets are selected in DB by their latest observation, so only
+        history of films near thresholds is read.
+
+    '''
+
+    if now is None:
+        now = datetime.datetime.utcnow()
+    min_rating: float = get_env_float('AUTORADARR_MIN_RATING', 6.5)
+    min_count: int = get_env_int('AUTORADARR_MIN_RATING_COUNT', 5000)
+    since: datetime.datetime = now - datetime.timedelta(days=days)
+    rating_history: Any = db.get_collection('rating_history')
+
+    # Latest bucket of film keeps its latest observation - other films can't be near
+    candidates: List[str] = list({doc['imdbId'] for doc in rating_history.find(
+        {'month': {'$gte': month_start(since)},
+         'last.c': {'$gte': min_count * count_ratio},
+         'last.r': {'$gte': (min_rating - rating_margin) * 10 - 1e-6},
+         '$or': [{'last.r': {'$lt': min_rating * 10 + 1e-6}},
+                 {'last.c': {'$lt': min_count}}]},
+        {'imdbId': 1, '_id': 0})})
+    if not candidates:
+        return []
+
+    # imdbId -> observations (time, rating * 10, votes) in time order
+    history: Dict[str, List[Tuple[datetime.datetime, int, int]]] = {}
+    for doc in rating_history.find(
+            {'imdbId': {'$in': candidates}, 'month': {'$gte': month_start(since)}},
+            {'last': 0}).sort('month', pymongo.ASCENDING):
+        observations: List[Tuple[datetime.datetime, int, int]] = history.setdefault(
+            doc['imdbId'], [])
+        for offset, rating, count in zip(doc['t'], doc['r'], doc['c']):
+            moment: datetime.datetime = doc['month'] + datetime.timedelta(minutes=offset)
+            if moment >= since:
+                observations.append((moment, rating, count))
+
+    near: List[Dict[str, Any]] = []
+    for imdbid, observations in history.items():
+        if not observations:
+            continue
+        first: Tuple[datetime.datetime, int, int] = observations[0]
+        last: Tuple[datetime.datetime, int, int] = observations[-1]
+        last_rating: float = last[1] / 10
+        if last_rating >= min_rating and last[2] >= min_count:
+            continue
+        if last_rating < min_rating - rating_margin or last[2] < min_count * count_ratio:
+            continue
+        period: float = (last[0] - first[0]).total_seconds() / (24 * 60 * 60)
+        per_day: float = (last[2] - first[2]) / period if period > 0 else 0
+        eta: Optional[float] = None
+        if last[2] < min_count and per_day > 0:
+            eta = (min_count - last[2]) / per_day
+        near.append({'imdbId': imdbid, 'rating': last_rating, 'count': last[2],
+                     'countPerDay': per_day, 'etaDays': eta})
+    near.sort(key=lambda film: (film['etaDays'] is None, film['etaDays'] or 0, -film['count']))
+    return near
+
+
+def payload_fingerprint(films: 'List[Film]') -> str:
+    ''' Return sha1 of provider's films, same for identical payloads '''
+
+    return hashlib.sha1(json.dumps([film.astuple() for film in films],
+                                   default=str).encode()).hexdigest()
+
+
+def diff_snapshot(db: Database,
+                  name: str,
+                  films: 'List[Film]',
+                  full_scan_interval: int = -1) -> 'List[Film]':
+    ''' Return films of provider name changed since its last payload
+        and store new snapshot in 'snapshots' collection.
+
+        Snapshot keeps payload fingerprint and [rating, count] of every film.
+        Identical payload returns no films. Otherwise new films and films
+        which passed rating or count threshold since last payload are
+        returned. Films passing thresholds but not marked in DB or queued in
+        'tmdb_pending' yet (skipped by later stages - timeouts, quota, adds
+        limit) are returned every time. Full payload is returned after
+        full_scan_interval seconds since last full scan (env
+        AUTORADARR_FULL_SCAN_INTERVAL, default 1 day, 0 - every time), so
+        filtred films get another chance.
+
+    '''
+
+    if full_scan_interval < 0:
+        full_scan_interval = get_env_int('AUTORADARR_FULL_SCAN_INTERVAL', 24 * 60 * 60)
+    snapshots: Any = db.get_collection('snapshots')
+    now: datetime.datetime = datetime.datetime.utcnow()
+    fingerprint: str = payload_fingerprint(films)
+    snapshot: Any = snapshots.find_one({'_id': name}) or {}
+
+    full_scan: bool = not snapshot or \
+        (now - snapshot['full_scan']).total_seconds() >= full_scan_interval
+    changed: List[Film] = films
+    if full_scan:
+        snapshot['full_scan'] = now
+    else:
+        regular_filter: RegularFilter = get_regular_filter('imDbRating', 'imDbRatingCount',
+                                                           'year')
+        passing: Set[str] = {film.id for film, ok in zip(films, regular_filter.mask(films))
+                             if ok}
+        send: Set[str] = set()
+        if snapshot['fingerprint'] != fingerprint:
+            previous: Dict[str, List[Any]] = snapshot['films']
+            known: List[Film] = [film for film in films if film.id in previous]
+            # Known films as they were in last payload (older snapshots keep strings)
+            passed: List[bool] = regular_filter.mask([
+                Film(film.id, film.title, film.full_title, film.year,
+                     parse_number(previous[film.id][0], float),
+                     parse_number(previous[film.id][1], int)) for film in known])
+            was_passed: Set[str] = {film.id for film, ok in zip(known, passed) if ok}
+            send = {film.id for film in films if film.id not in previous or
+                    (film.id in passing and film.id not in was_passed)}
+        # Films passing thresholds before which have not reached DB are sent again,
+        # films waiting for tmdbId are resolved by add_tmdb_pending
+        unsent: List[str] = [imdbid for imdbid in passing if imdbid not in send]
+        if unsent:
+            marked: Set[str] = {doc['imdbId'] for collection in ('films', 'tmdb_pending')
+                                for doc in db.get_collection(collection).find(
+                                    {'imdbId': {'$in': unsent}}, {'imdbId': 1, '_id': 0})}
+            send.update(imdbid for imdbid in unsent if imdbid not in marked)
+        changed = [film for film in films if film.id in send]
+
+    snapshots.replace_one({'_id': name}, {
+        'fingerprint': fingerprint,
+        'films': {film.id: [film.rating, film.rating_count] for film in films if film.id},
+        'scanned': now,
+        'full_scan': snapshot['full_scan'],
+    }, upsert=True)
+    metrics.inc('autoradarr_snapshot_films_total', len(films) - len(changed),
+                provider=name, result='skipped')
+    metrics.inc('autoradarr_snapshot_films_total', len(changed), provider=name, result='sent')
+    return changed
+
+
+def fetch_provider(provider: Provider,
+                   client: Session,
+                   db: Optional[Database] = None) -> 'Optional[List[Film]]':
+    ''' Provider.get_films as Film records timed as stage 'provider:<name>',
+        None if provider's budget is exhausted.
+        Films are parsed once here, before all stages. With db ratings are
+        recorded (record_ratings) and only films changed since last payload
+        are returned (diff_snapshot).
+
+    '''
+
+    budget: Optional[RequestBudget] = None
+    if provider.budget and db is not None:
+        budget = get_budget(db, provider.budget)
+    if budget is not None and not budget.take():
+        log.warning('Budget %s is exhausted - provider %s skipped', provider.budget,
+                    provider.name)
+        return None
+    with StageTimer('provider:' + provider.name) as stage:
+        items: Optional[List[Any]] = provider.get_films(client)
+        if items is None:
+            return stage.out(None)
+        films: List[Film] = [Film.from_imdb(item) for item in items]
+        if films and db is not None:
+            record_ratings(db, films)
+            films = diff_snapshot(db, provider.name, films)
+            if not films:
+                log.info('Films of provider %s have not changed - skipped', provider.name)
+        return stage.out(films)
+
+
+def iter_providers_films(client: Session,
+                         names: 'List[str]',
+                         timeout: float = 0,
+                         db: Optional[Database] = None,
+                         failed: Optional[Set[str]] = None) -> 'Iterator[Film]':
+    ''' Films of iter_providers_batches one by one '''
+
+    for batch in iter_providers_batches(client, names, timeout, db, failed):
+        yield from batch
+
+
+def iter_providers_batches(client: Session,
+                           names: 'List[str]',
+                           timeout: float = 0,
+                           db: Optional[Database] = None,
+                           failed: Optional[Set[str]] = None) -> 'Iterator[List[Film]]':
+    ''' Fetch films of providers concurrently, yield Film records of every
+        provider (deduped by imdb id) as one batch as soon as provider answers.
+        Providers' budgets are kept in db.
+
+        Providers still running timeout seconds after start
+        (env AUTORADARR_PROVIDER_TIMEOUT, default 120) are skipped, so slow
+        provider doesn't delay others. Answered providers are never skipped,
+        however long batches already yielded are processed.
+        Names of unknown, failed, skipped and not answered providers are
+        added into failed.
+
+    '''
+
+    if failed is None:
+        failed = set()
+    enabled: List[Provider] = []
+    for name in names:
+        if name in providers:
+            enabled.append(providers[name])
+        else:
+            log.error('Unknown provider %s', name)
+            failed.add(name)
+    if not enabled:
+        return
+    if not timeout:
+        timeout = get_env_float('AUTORADARR_PROVIDER_TIMEOUT', 120)
+    deadline: float = time.monotonic() + timeout
+
+    executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=len(enabled))
+    # Answered providers in order of answers
+    answered: 'queue.Queue[concurrent.futures.Future[Optional[List[Film]]]]' = queue.Queue()
+    futures: Dict[Any, str] = {}
+    for provider in enabled:
+        future: Any = executor.submit(fetch_provider, provider, client, db)
+        futures[future] = provider.name
+        future.add_done_callback(answered.put)
+    seen: Set[str] = set()
+    try:
+        for _ in range(len(futures)):
+            try:
+                future = answered.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                late: List[str] = [name for future, name in futures.items()
+                                   if not future.done()]
+                if late:
+                    log.error('Providers have not answered in time: %s', late)
+                    failed.update(late)
+                    return
+                # Provider has just answered - its callback is running
+                future = answered.get()
+            try:
+                films: Optional[List[Film]] = future.result()
+            except Exception as err:
+                log.error('Provider %s failed with error: %s', futures[future], err)
+                failed.add(futures[future])
+                continue
+            if films is None:
+                failed.add(futures[future])
+            batch: List[Film] = []
+            for film in films or []:
+                if film.id and film.id not in seen:
+                    seen.add(film.id)
+                    batch.append(film)
+            if batch:
+                yield batch
+    finally:
+        # Don't wait for slow provider
+        executor.shutdown(wait=False)
+
+
+def get_provider_names() -> 'List[str]':
+    ''' Return providers enabled by env AUTORADARR_PROVIDERS
+        (comma separated, default 'imdb_popular') '''
+
+    return [name.strip() for name in
+            (os.environ.get('AUTORADARR_PROVIDERS') or 'imdb_popular').split(',')
+            if name.strip()]
+
+
+def get_new_films(client: Session,
+                  db: Database,
+                  buffer: Optional[MarkBuffer] = None,
+                  seen: Optional[SeenIndex] = None,
+                  failed: Optional[Set[str]] = None
+                  ) -> 'Iterator[List[RadarrFilm]]':
+    ''' Get new films from rating providers, lazy - yield chunks of films.
+
+        1. Get new films of enabled providers (get_provider_names), merged by
+           imdb id, names of failed providers are added into failed.
+        2. NOT ADD film if old, allready persist in DB or marked_filtred, etc.
+        3. Convert in radarr format.
+
+    '''
+
+    # Films of every provider are filtered as soon as it answers
+    batches: Iterator[List[Film]] = iter_providers_batches(client, get_provider_names(),
+                                                           db=db, failed=failed)
+    for chunk in iter_imdb_films(client, db, batches, buffer, seen=seen, batched=True):
+        yield convert_imdb_in_radarr(chunk)
 
 
 def get_tmdbid_by_imdbid(client: Session, imdbId: str) -> int:
@@ -366,47 +2368,345 @@ def get_tmdbid_by_imdbid(client: Session, imdbId: str) -> int:
         https://developers.themoviedb.org/3/find/find-by-id
     '''
 
+    return find_tmdbid_by_imdbid(client, imdbId) or 0
+
+
+def find_tmdbid_by_imdbid(client: Session, imdbId: str) -> Optional[int]:
+    ''' get_tmdbid_by_imdbid, 0 if not found, None if TMDB has not answered '''
+
     tmdb_apikey: str = str(os.environ.get('TMDB_APIKEY'))
     if not tmdb_apikey:
-        print('Could not get env TMDB_APIKEY', file=sys.stderr)
+        tmdb_log.error('Could not get env TMDB_APIKEY')
         raise Exception('Could not get env TMDB_APIKEY')
 
     headers: Dict[str, str] = {'User-Agent': 'Mozilla/5.0'}
-    r: Response = client.get('https://api.themoviedb.org/3/find/' + imdbId +
-                             '?api_key=' + tmdb_apikey +
-                             '&language=en-US&external_source=imdb_id', headers=headers)
+    # TMDB_API_URL - for local stand-in servers (benchmarks)
+    tmdb_url: str = os.environ.get('TMDB_API_URL') or 'https://api.themoviedb.org'
+    url: str = tmdb_url + '/3/find/' + imdbId + '?api_key=' + tmdb_apikey + \
+        '&language=en-US&external_source=imdb_id'
+    try:
+        with host_slot(url):
+            r: Response = client.get(url, headers=headers)
+    # Timeouts, connection errors - film waits in tmdb_pending
+    except RequestException as err:
+        tmdb_log.warning('Request failed: %s', err, extra={'imdbId': imdbId})
+        return None
 
-    if (r.status_code == 200) and (r.json()['movie_results']):
-        return r.json()['movie_results'][0]['id']
+    if r.status_code != 200:
+        tmdb_log.warning('No result', extra={'status': r.status_code, 'imdbId': imdbId})
+        return None
+    movie_results: Any = r.json()['movie_results']
+    if movie_results:
+        return movie_results[0]['id']
     return 0
 
 
+def get_tmdbid_by_radarr(client: Session, imdbId: str) -> int:
+    ''' Get tmdbId by imdbId useing Radarr lookup (Radarr asks own metadata server) '''
+
+    instance: RadarrInstance = get_radarr_instances()[0]
+    r: Optional[Response] = get_radarr_data(instance.get_client(client), 'lookup_imdb', imdbId,
+                                            instance)
+    if r is None:
+        return 0
+    return int(r.json().get('tmdbId') or 0)
+
+
+def resolve_tmdbid(client: Session, imdbId: str) -> Optional[int]:
+    ''' Get tmdbId by imdbId, return 0 if not found, None if TMDB has not answered.
+
+        env AUTORADARR_TMDB_RESOLVER - 'tmdb' (default) or 'radarr'.
+        Radarr resolver falls back to TMDB API if Radarr can't answer.
+
+    '''
+
+    if os.environ.get('AUTORADARR_TMDB_RESOLVER') == 'radarr':
+        tmdbid: int = get_tmdbid_by_radarr(client, imdbId)
+        if tmdbid:
+            return tmdbid
+    return find_tmdbid_by_imdbid(client, imdbId)
+
+
+def resolve_tmdbids(client: Session,
+                    db: Database,
+                    imdbids: 'List[str]',
+                    workers: int = 0,
+                    failed: Optional[Set[str]] = None) -> 'Dict[str, int]':
+    ''' Return imdbId -> tmdbId (0 if not found) for all imdbids.
+
+        Mapping never changes, so found ids are stored in 'tmdb_ids' forever.
+        Misses are resolved concurrently,
+        workers - default from env AUTORADARR_TMDB_WORKERS (4).
+        imdbIds TMDB has not answered for are added into failed.
+
+    '''
+
+    tmdb_ids: Any = db.get_collection('tmdb_ids')
+    tmdbids: Dict[str, int] = {
+        item['imdbId']: item['tmdbId'] for item in
+        tmdb_ids.find({'imdbId': {'$in': imdbids}}, {'imdbId': 1, 'tmdbId': 1, '_id': 0})
+    }
+    misses: List[str] = [imdbid for imdbid in dict.fromkeys(imdbids) if imdbid not in tmdbids]
+    for imdbid in imdbids:
+        count_cache('tmdb_ids', imdbid in tmdbids)
+    if not misses:
+        return tmdbids
+
+    if not workers:
+        workers = get_env_int('AUTORADARR_TMDB_WORKERS', 4)
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(misses)))) as executor:
+        resolved: List[Optional[int]] = list(executor.map(
+            lambda imdbid: resolve_tmdbid(client, imdbid), misses))
+
+    requests_list: List[pymongo.UpdateOne] = []
+    for imdbid, tmdbid in zip(misses, resolved):
+        tmdbids[imdbid] = tmdbid or 0
+        if tmdbid is None and failed is not None:
+            failed.add(imdbid)
+        if tmdbid:
+            requests_list.append(pymongo.UpdateOne({'imdbId': imdbid},
+                                                   {'$set': {'tmdbId': tmdbid}},
+                                                   upsert=True))
+    if requests_list:
+        tmdb_ids.bulk_write(requests_list, ordered=False)
+    return tmdbids
+
+
 def necessary_fields_for_radarr(client: Session,
-                                film: 'Dict[str, Union[str, int]]') -> 'Dict[str, Union[str, int]]':
-    ''' Add necessary fields for radarr import '''
+                                film: 'RadarrFilm',
+                                tmdbid: Optional[int] = None) -> 'RadarrFilm':
+    ''' Add necessary fields for radarr import.
+
+        tmdbid - already resolved tmdbId, if None - get it from TMDB.
+        qualityProfileId is env RADARR_DEFAULT_QUALITY, if not set - quality
+        of Radarr instance (RadarrInstance.prepare).
 
-    radarr_film: 'Dict[str, Union[str, int]]' = film
-    radarr_film['qualityProfileId'] = int(str(os.environ.get('RADARR_DEFAULT_QUALITY')))
+    '''
+
+    radarr_film: 'RadarrFilm' = film
+    default_quality: str = os.environ.get('RADARR_DEFAULT_QUALITY') or ''
+    if default_quality:
+        radarr_film['qualityProfileId'] = int(default_quality)
     radarr_film['path'] = film['folderName']
     radarr_film['title'] = film['originalTitle']
-    radarr_film['tmdbId'] = get_tmdbid_by_imdbid(client, str(film['imdbId']))
+    if tmdbid is None:
+        tmdbid = get_tmdbid_by_imdbid(client, str(film['imdbId']))
+    radarr_film['tmdbId'] = tmdbid
 
     return radarr_film
 
 
+def import_to_radarr(client: Session,
+                     radarr_films: 'List[RadarrFilm]',
+                     bulk_size: int = 50,
+                     instance: Optional[RadarrInstance] = None
+                     ) -> Tuple[List[RadarrFilm], List[RadarrFilm]]:
+    ''' Add films by Radarr bulk import, bulk_size films per request.
+
+        Return films confirmed by Radarr response and films of failed
+        requests (they could be added one by one).
+
+    '''
+
+    added: List[RadarrFilm] = []
+    failed: List[RadarrFilm] = []
+    bulk_size = max(1, bulk_size)
+    for start in range(0, len(radarr_films), bulk_size):
+        chunk: List[RadarrFilm] = radarr_films[start:start + bulk_size]
+        r: Optional[Response] = get_radarr_data(client, 'import_movies', api_json=chunk,
+                                                instance=instance)
+        if r is None:
+            failed.extend(chunk)
+            continue
+        try:
+            confirmed: Set[str] = {str(item.get('imdbId')) for item in r.json()}
+        # Radarr answers without list of movies - can't confirm anything
+        except (ValueError, AttributeError, TypeError):
+            confirmed = set()
+        added.extend(film for film in chunk if str(film['imdbId']) in confirmed)
+    return added, failed
+
+
+def post_to_radarr(client: Session,
+                   radarr_films: 'List[RadarrFilm]',
+                   workers: int = 1,
+                   instance: Optional[RadarrInstance] = None
+                   ) -> 'List[RadarrFilm]':
+    ''' Add films one by one (workers requests at once), return added films '''
+
+    def post(film: 'RadarrFilm') -> Optional[Response]:
+        return get_radarr_data(client, 'add_movie', api_json=film, instance=instance)
+
+    if workers <= 1 or len(radarr_films) <= 1:
+        responses: List[Optional[Response]] = [post(film) for film in radarr_films]
+    else:
+        with ThreadPoolExecutor(max_workers=min(workers, len(radarr_films))) as executor:
+            responses = list(executor.map(post, radarr_films))
+    return [film for film, r in zip(radarr_films, responses) if r is not None]
+
+
 def add_to_radarr(client: Session,
                   db: Database,
-                  newfilms: 'List[Dict[str, Union[str, int]]]') -> int:
-    ''' Add new films to radarr and return count of added items '''
+                  newfilms: 'Iterable[List[RadarrFilm]]',
+                  buffer: Optional[MarkBuffer] = None,
+                  max_adds: int = -1) -> int:
+    ''' Add chunks of new films to radarr and return count of added items.
+
+        Chunks are added as soon as they come from getters (get_new_films).
+        max_adds - limit of added films per run, default from
+        env AUTORADARR_MAX_ADDS_PER_RUN (0 - unlimited). When limit is reached
+        next chunks are not requested, so their details are not fetched.
 
-    r: Optional[Response] = None
+    '''
+
+    if max_adds < 0:
+        max_adds = get_env_int('AUTORADARR_MAX_ADDS_PER_RUN', 0)
     count: int = 0
-    for item in newfilms:
-        radarr_film: Dict[str, Union[str, int]] = necessary_fields_for_radarr(client, item)
-        r = get_radarr_data(client, 'add_movie', api_json=radarr_film)
-        if r is not None:
-            mark_filtred_in_db(db, str(radarr_film['imdbId']), str(radarr_film['originalTitle']))
-            count = count + 1
+    for chunk in newfilms:
+        if max_adds:
+            chunk = chunk[:max_adds - count]
+        count += add_chunk_to_radarr(client, db, chunk, buffer)
+        if max_adds and count >= max_adds:
+            log.info('Limit of added films per run has been reached: %s', max_adds)
+            break
+    return count
+
+
+def add_chunk_to_radarr(client: Session,
+                        db: Database,
+                        newfilms: 'List[RadarrFilm]',
+                        buffer: Optional[MarkBuffer] = None) -> int:
+    ''' Add new films to radarr and return count of added items.
+
+        env AUTORADARR_RADARR_WORKERS - concurrent POSTs of films (default 4),
+        AUTORADARR_RADARR_BULK=1 - add films by bulk import
+        (AUTORADARR_RADARR_BULK_SIZE films per request, default 50),
+        if bulk import fails, rest films are added one by one.
+        Films are added into all Radarr instances they are routed to
+        concurrently. Film is marked in DB when every instance it is routed to
+        has confirmed it or had it in library.
+
+    '''
+
+    with StageTimer('resolve_tmdbids', newfilms):
+        tmdbids: Dict[str, int] = resolve_tmdbids(client, db,
+                                                  [str(item['imdbId']) for item in newfilms])
+    # Radarr can't add film without tmdbId - try later by 'tmdb_resolution' job
+    queue_tmdb_pending(db, [item for item in newfilms if not tmdbids[str(item['imdbId'])]])
+    radarr_films: List[RadarrFilm] = [
+        necessary_fields_for_radarr(client, item, tmdbids[str(item['imdbId'])])
+        for item in newfilms if tmdbids[str(item['imdbId'])]]
+
+    instances: Tuple[RadarrInstance, ...] = get_radarr_instances()
+    with radarr_library_lock:
+        libraries: Dict[str, Optional[FrozenSet[str]]] = dict(radarr_library['instances'])
+
+    def add(instance: RadarrInstance) -> 'Tuple[Set[str], List[RadarrFilm]]':
+        return add_to_instance(client, instance, radarr_films, libraries.get(instance.name))
+
+    with StageTimer('add_to_radarr', radarr_films) as stage:
+        if len(instances) == 1:
+            results: List[Tuple[Set[str], List[RadarrFilm]]] = [
+                add(instances[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(instances)) as executor:
+                results = list(executor.map(add, instances))
+        missing: Set[str] = set()
+        added_ids: Set[str] = set()
+        for instance, (instance_missing, instance_added) in zip(instances, results):
+            missing.update(instance_missing)
+            for radarr_film in instance_added:
+                radarr_log.info('Added into Radarr: %s', radarr_film['title'],
+                                extra={'imdbId': radarr_film['imdbId'],
+                                       'radarr': instance.name})
+                added_ids.add(str(radarr_film['imdbId']))
+        added: List[RadarrFilm] = [
+            film for film in radarr_films if str(film['imdbId']) in added_ids]
+        stage.out(added)
+
+    for radarr_film in radarr_films:
+        if str(radarr_film['imdbId']) not in missing:
+            mark_filtred_in_db(db, str(radarr_film['imdbId']),
+                               str(radarr_film['originalTitle']), buffer=buffer)
+    return len(added)
+
+
+def add_to_instance(client: Session,
+                    instance: RadarrInstance,
+                    radarr_films: 'List[RadarrFilm]',
+                    library: 'Optional[FrozenSet[str]]' = None
+                    ) -> 'Tuple[Set[str], List[RadarrFilm]]':
+    ''' Add films routed to instance and absent in its library (index).
+
+        Return imdbIds of routed films instance hasn't confirmed and
+        added films (in format of instance).
+
+    '''
+
+    radarr_films = [instance.prepare(film) for film in radarr_films
+                    if instance.accepts(film) and str(film['imdbId']) not in (library or ())]
+    radarr_client: Session = instance.get_client(client)
+    added: List[RadarrFilm] = []
+    rest: List[RadarrFilm] = radarr_films
+    if os.environ.get('AUTORADARR_RADARR_BULK') == '1':
+        added, rest = import_to_radarr(radarr_client, radarr_films,
+                                       get_env_int('AUTORADARR_RADARR_BULK_SIZE', 50),
+                                       instance=instance)
+    added.extend(post_to_radarr(radarr_client, rest,
+                                get_env_int('AUTORADARR_RADARR_WORKERS', 4), instance=instance))
+    confirmed: Set[str] = {str(film['imdbId']) for film in added}
+    return {str(film['imdbId']) for film in radarr_films} - confirmed, added
+
+
+def queue_tmdb_pending(db: Database, newfilms: 'List[RadarrFilm]') -> None:
+    ''' Store films (radarr format) without tmdbId in 'tmdb_pending' collection.
+
+        Pending films expire after env AUTORADARR_TMDB_PENDING_TTL seconds
+        (default 30 days).
+
+    '''
+
+    if not newfilms:
+        return
+    db.get_collection('tmdb_pending').bulk_write([
+        pymongo.UpdateOne({'imdbId': film['imdbId']},
+                          {'$set': {'film': dict(film)},
+                           '$setOnInsert': {'queued': datetime.datetime.utcnow()}},
+                          upsert=True)
+        for film in newfilms], ordered=False)
+
+
+def add_tmdb_pending(client: Session,
+                     db: Database,
+                     seen: Optional[SeenIndex] = None) -> Optional[int]:
+    ''' Resolve tmdbId of pending films, add resolved ones to Radarr.
+
+        Return count of added films, None if TMDB has not answered and
+        nothing has been resolved. Marked films are added to seen index.
+
+    '''
+
+    tmdb_pending: Any = db.get_collection('tmdb_pending')
+    pending: List[RadarrFilm] = [item['film'] for item in tmdb_pending.find()]
+    if not pending:
+        return 0
+    failed: Set[str] = set()
+    tmdbids: Dict[str, int] = resolve_tmdbids(client, db,
+                                              [str(film['imdbId']) for film in pending],
+                                              failed=failed)
+    resolved: List[RadarrFilm] = [film for film in pending
+                                  if tmdbids[str(film['imdbId'])]]
+    if failed:
+        tmdb_log.warning('TMDB has not answered for %s pending films', len(failed))
+    if not resolved:
+        return None if failed else 0
+
+    buffer: MarkBuffer = MarkBuffer(db, seen)
+    count: int = add_chunk_to_radarr(client, db, resolved, buffer)
+    buffer.flush()
+    if seen is not None:
+        seen.save()
+    tmdb_pending.delete_many({'imdbId': {'$in': [film['imdbId'] for film in resolved]}})
     return count
 
 
@@ -416,49 +2716,471 @@ def add_to_radarr(client: Session,
 # %D0%B4%D0%B0%D0%BD%D0%BD%D1%8B%D1%85-%D0%B2-python
 
 
-def main() -> Optional[int]:
-    ''' Return count of added films or None if error '''
-    locale.setlocale(locale.LC_ALL, '')
-    print('--- Autoradarr has been started at {}'.format(datetime.datetime.utcnow()))
+def connect_db() -> Optional[Database]:
+    ''' Connect to autoradarr DB by env settings, return None if error '''
 
-    # DB
     db_host: str = str(os.environ.get('AUTORADARR_DB_HOST'))
     DB_NAME: str = 'autoradarr'
     db_user: str = str(os.environ.get('AUTORADARR_DB_USERNAME'))
     db_password: str = str(os.environ.get('AUTORADARR_DB_PASSWORD'))
 
-    # Prelogin into DB
-    db: Database = get_db(db_host, DB_NAME, db_user, db_password)
-    if not db:
+    db: Optional[Database] = get_db(db_host, DB_NAME, db_user, db_password)
+    if db is None:
         return None
+    ensure_db_indexes(db)
+    return db
 
-    # Get new films
-    print('Getting new films...')
-    client: Session = requests.session()
-    newfilms: List[Dict[str, Union[str, int]]] = get_new_films(client, db)
 
-    # Add to Radarr
-    count: int = add_to_radarr(client, db, newfilms)
+def main(client: Optional[Session] = None,
+         db: Optional[Database] = None,
+         seen: Optional[SeenIndex] = None) -> Optional[int]:
+    ''' Return count of added films or None if error (no DB, all providers failed).
+
+        client, db and seen index are shared by daemon runs (Runtime),
+        client and db are connected if not given.
 
+    '''
+    locale.setlocale(locale.LC_ALL, '')
+    log.info('--- Autoradarr has been started at %s', datetime.datetime.utcnow())
+
+    # Prelogin into DB
+    if db is None:
+        db = connect_db()
+    if db is None:
+        return None
+
+    # Get new films
+    log.info('Getting new films...')
+    if client is None:
+        client = make_http_client()
+    buffer: MarkBuffer = MarkBuffer(db, seen)
+    failed: Set[str] = set()
+    try:
+        # Films flow from getters into Radarr by chunks
+        newfilms: Iterator[List[RadarrFilm]] = get_new_films(client, db, buffer,
+                                                             seen, failed)
+
+        # Add to Radarr
+        count: int = add_to_radarr(client, db, newfilms, buffer)
+    finally:
+        # Write marks even if run has been interrupted
+        buffer.flush()
+        if seen is not None:
+            seen.save()
+
+    # Scheduler backs off if nothing could be fetched
+    if count == 0 and failed and failed >= set(get_provider_names()):
+        log.error('All providers have failed: %s', sorted(failed))
+        return None
     if count == 0:
-        print('Can\'t find new films')
+        log.info('Can\'t find new films')
         return 0
 
-    print('New films added into DB:')
-    for film in newfilms:
-        if 'fullTitle' in film:
-            print(film['fullTitle'])
-        elif 'title' in film:
-            print(film['title'])
-
+    log.info('New films added into DB: %s', count)
     return count
 
 
+class Job(object):
+    ''' Source polled by Scheduler.
+
+        func returns count of produced items (added films, changed ids, etc)
+        or None if error. Productive runs halve interval (down to
+        min_interval), empty runs stretch it by 1.5 (up to max_interval),
+        errors back off exponentially from current interval.
+        Every delay is randomized by +-jitter and counts from the end of run,
+        so slow runs don't follow each other without a pause.
+
+    '''
+
+    def __init__(self,
+                 name: str,
+                 func: Any,
+                 interval: float,
+                 min_interval: float = 0,
+                 max_interval: float = 0,
+                 jitter: float = 0.1) -> None:
+        self.name: str = name
+        self.func: Any = func
+        self.interval: float = interval
+        self.min_interval: float = min_interval or interval / 4
+        self.max_interval: float = max_interval or interval * 8
+        self.jitter: float = jitter
+        self.errors: int = 0
+        self.next_run: float = 0
+        self.lock: threading.Lock = threading.Lock()
+
+    def run(self, clock: Any = time.monotonic) -> Optional[int]:
+        ''' Run func if previous run finished and schedule next run by clock '''
+
+        # Don't overlap runs of one source
+        if not self.lock.acquire(blocking=False):
+            return None
+        start: float = time.perf_counter()
+        try:
+            produced: Optional[int] = self.func()
+        except Exception as err:
+            scheduler_log.error('Job %s failed with error: %s', self.name, err)
+            produced = None
+        finally:
+            self.lock.release()
+        metrics.observe('autoradarr_job_seconds', time.perf_counter() - start, job=self.name)
+        if produced is None:
+            metrics.inc('autoradarr_job_errors_total', job=self.name)
+        self.schedule(clock(), produced)
+        return produced
+
+    def schedule(self, now: float, produced: Optional[int]) -> None:
+        delay: float = self.interval
+        if produced is None:
+            self.errors += 1
+            delay = min(self.max_interval, self.interval * 2 ** self.errors)
+        else:
+            self.errors = 0
+            if produced > 0:
+                self.interval = max(self.min_interval, self.interval / 2)
+            else:
+                self.interval = min(self.max_interval, self.interval * 1.5)
+            delay = self.interval
+        self.next_run = now + delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class Scheduler(object):
+    ''' Run jobs one by one when they are due, sleep till next one '''
+
+    def __init__(self, jobs: 'List[Job]', clock: Any = time.monotonic,
+                 sleep: Any = time.sleep) -> None:
+        self.jobs: List[Job] = jobs
+        self.clock: Any = clock
+        self.sleep: Any = sleep
+
+    def run_pending(self) -> 'List[str]':
+        ''' Run due jobs, return their names '''
+
+        done: List[str] = []
+        for job in sorted(self.jobs, key=lambda job: job.next_run):
+            if job.next_run <= self.clock():
+                job.run(self.clock)
+                done.append(job.name)
+        return done
+
+    def run_forever(self) -> None:
+        while True:
+            self.run_pending()
+            next_run: float = min(job.next_run for job in self.jobs)
+            scheduler_log.info('--- Autoradarr has been entered in sleep mode at %s',
+                               datetime.datetime.utcnow())
+            self.sleep(max(0, next_run - self.clock()))
+
+
+class Runtime(object):
+    ''' Mongo and HTTP clients created once and shared by daemon runs.
+
+        Mongo connection is checked by 'ping' not often than
+        env AUTORADARR_DB_CHECK_INTERVAL seconds (default 60) and reconnected
+        only if check fails. HTTP client is recreated after
+        env AUTORADARR_HTTP_MAX_FAILURES requests failed in a row (default 5).
+        Seen index is loaded from file env AUTORADARR_SEEN_INDEX (not used
+        if not set), missing file is built from DB marks, existing one is
+        updated by marks added since its save (SEEN_RECONCILE_MARGIN before).
+
+    '''
+
+    def __init__(self, clock: Any = time.monotonic) -> None:
+        self.clock: Any = clock
+        self.db: Optional[Database] = None
+        self.checked: float = 0
+        self.client: Optional[HttpClient] = None
+        self.seen: Optional[SeenIndex] = None
+        self.lock: threading.Lock = threading.Lock()
+
+    def get_db(self) -> Optional[Database]:
+        ''' Return healthy DB, connect if needed, None if could not connect '''
+
+        with self.lock:
+            if self.db is not None and not self.db_alive():
+                db_log.warning('DB connection lost - reconnecting')
+                self.close_db()
+            if self.db is None:
+                self.db = connect_db()
+                self.checked = self.clock()
+            return self.db
+
+    def db_alive(self) -> bool:
+        assert self.db is not None
+        now: float = self.clock()
+        if now - self.checked < get_env_int('AUTORADARR_DB_CHECK_INTERVAL', 60):
+            return True
+        try:
+            self.db.command('ping')
+        except pymongo.errors.PyMongoError as err:
+            db_log.error('DB ping failed with error: %s', err)
+            return False
+        self.checked = now
+        return True
+
+    def get_client(self) -> HttpClient:
+        ''' Return shared HTTP client, new one if connections keep failing '''
+
+        with self.lock:
+            if self.client is not None and \
+               self.client.failures >= get_env_int('AUTORADARR_HTTP_MAX_FAILURES', 5):
+                http_log.warning('HTTP requests keep failing - recreating client')
+                self.client.close()
+                self.client = None
+            if self.client is None:
+                self.client = make_http_client()
+            return self.client
+
+    def get_seen(self, db: Database) -> Optional[SeenIndex]:
+        ''' Return seen index, load and reconcile with DB or build it on first call '''
+
+        path: str = os.environ.get('AUTORADARR_SEEN_INDEX') or ''
+        with self.lock:
+            if self.seen is None and path:
+                self.seen = SeenIndex(path)
+                saved: Optional[datetime.datetime] = self.seen.saved()
+                # Marks could be written after last save (crash, concurrent jobs)
+                query: Dict[str, Any] = {} if saved is None else {
+                    'added': {'$gte': saved - SEEN_RECONCILE_MARGIN}}
+                try:
+                    self.seen.update(film['imdbId'] for film in db.get_collection('films').find(
+                        query, {'imdbId': 1, '_id': 0}) if film.get('imdbId'))
+                except pymongo.errors.PyMongoError as err:
+                    db_log.error('Could not load marks for seen index with error: %s', err)
+                self.seen.save()
+            return self.seen
+
+    def close_db(self) -> None:
+        if self.db is not None:
+            self.db.client.close()
+            self.db = None
+
+    def close(self) -> None:
+        with self.lock:
+            self.close_db()
+            if self.seen is not None:
+                self.seen.save()
+                self.seen.close()
+                self.seen = None
+            if self.client is not None:
+                self.client.close()
+                self.client = None
+        try:
+            instances: Tuple[RadarrInstance, ...] = get_radarr_instances()
+        # Broken RADARR_INSTANCES - nothing has been connected
+        except Exception:
+            instances = ()
+        for instance in instances:
+            instance.close()
+
+
+def make_jobs(runtime: Runtime) -> 'List[Job]':
+    ''' Jobs of daemon: IMDb popular scan, Radarr library sync and
+        resolution of pending tmdbIds.
+
+        Intervals in seconds - env AUTORADARR_IMDB_INTERVAL (3600),
+        AUTORADARR_RADARR_INTERVAL (900), AUTORADARR_TMDB_INTERVAL (1800).
+
+    '''
+
+    def sync_radarr() -> Optional[int]:
+        with radarr_library_lock:
+            previous: FrozenSet[str] = radarr_library['index'] or frozenset()
+        radarr_index: Optional[FrozenSet[str]] = sync_radarr_index(runtime.get_client())
+        if radarr_index is None:
+            return None
+        # Library sync runs first - seen index is loaded here if scan hasn't yet
+        db: Optional[Database] = runtime.get_db()
+        seen: Optional[SeenIndex] = runtime.get_seen(db) if db is not None else runtime.seen
+        if seen is not None:
+            seen.update([imdbid for imdbid in radarr_index if imdbid not in seen])
+            seen.save()
+        return len(radarr_index ^ previous)
+
+    def scan_imdb() -> Optional[int]:
+        db: Optional[Database] = runtime.get_db()
+        if db is None:
+            return None
+        return main(runtime.get_client(), db, runtime.get_seen(db))
+
+    def resolve_tmdb() -> Optional[int]:
+        db: Optional[Database] = runtime.get_db()
+        if db is None:
+            return None
+        return add_tmdb_pending(runtime.get_client(), db, runtime.get_seen(db))
+
+    # Radarr library goes first - first scan uses fresh index
+    return [Job('radarr_library', sync_radarr,
+                get_env_int('AUTORADARR_RADARR_INTERVAL', 15 * 60)),
+            Job('imdb_popular', scan_imdb,
+                get_env_int('AUTORADARR_IMDB_INTERVAL', 60 * 60)),
+            Job('tmdb_resolution', resolve_tmdb,
+                get_env_int('AUTORADARR_TMDB_INTERVAL', 30 * 60))]
+
+
+def run_daemon() -> None:
+    start_metrics_server()
+    runtime: Runtime = Runtime()
+    try:
+        Scheduler(make_jobs(runtime)).run_forever()
+    finally:
+        runtime.close()
+
+
+class StackSampler(object):
+    ''' Thread sampling stacks of all other threads every interval seconds.
+
+        Stacks are counted in collapsed format of flamegraph.pl and
+        speedscope: thread;outer (file);...;inner (file) count.
+
+    '''
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval: float = interval
+        self.stacks: 'Counter[str]' = Counter()
+        self.stopped: threading.Event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='autoradarr-sampler',
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self) -> None:
+        own: int = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            self.sample(own)
+
+    def sample(self, skip: int = 0) -> None:
+        names: Dict[Optional[int], str] = {thread.ident: thread.name
+                                           for thread in threading.enumerate()}
+        for ident, top in sys._current_frames().items():
+            if ident == skip:
+                continue
+            frames: List[str] = []
+            frame: Optional[FrameType] = top
+            while frame is not None:
+                frames.append('{0} ({1})'.format(frame.f_code.co_name,
+                                                 os.path.basename(frame.f_code.co_filename)))
+                frame = frame.f_back
+            frames.append(names.get(ident, str(ident)))
+            self.stacks[';'.join(reversed(frames))] += 1
+
+    def write(self, path: str) -> None:
+        with open(path, 'w') as out:
+            for stack, count in sorted(self.stacks.items()):
+                out.write('{0} {1}\n'.format(stack, count))
+
+
+class RunProfiler(object):
+    ''' Context manager profiling one run into directory.
+
+        Writes autoradarr-<utc time>.pstats (cProfile of calling thread,
+        'python -m pstats' or snakeviz), .collapsed (stacks of all threads
+        sampled every env AUTORADARR_PROFILE_INTERVAL seconds, default 0.01)
+        and .tracemalloc.txt (env AUTORADARR_PROFILE_TOP allocating lines,
+        default 25).
+
+    '''
+
+    def __init__(self,
+                 directory: str,
+                 interval: float = -1,
+                 top: int = -1,
+                 clock: Any = datetime.datetime.utcnow) -> None:
+        if interval < 0:
+            interval = get_env_float('AUTORADARR_PROFILE_INTERVAL', 0.01)
+        self.top: int = top if top >= 0 else get_env_int('AUTORADARR_PROFILE_TOP', 25)
+        prefix: str = os.path.join(directory, clock().strftime('autoradarr-%Y%m%dT%H%M%S'))
+        self.directory: str = directory
+        self.paths: Dict[str, str] = {'pstats': prefix + '.pstats',
+                                      'collapsed': prefix + '.collapsed',
+                                      'tracemalloc': prefix + '.tracemalloc.txt'}
+        self.profile: cProfile.Profile = cProfile.Profile()
+        self.sampler: StackSampler = StackSampler(interval)
+        self.tracing: bool = False
+
+    def __enter__(self) -> 'RunProfiler':
+        os.makedirs(self.directory, exist_ok=True)
+        # Don't stop tracemalloc started by somebody else
+        self.tracing = not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+        self.sampler.start()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.profile.disable()
+        self.sampler.stop()
+        snapshot: tracemalloc.Snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if self.tracing:
+            tracemalloc.stop()
+
+        self.profile.dump_stats(self.paths['pstats'])
+        self.sampler.write(self.paths['collapsed'])
+        self.write_allocations(snapshot, current, peak)
+        log.info('Profile of run has been written into %s', ', '.join(self.paths.values()))
+
+    def write_allocations(self, snapshot: tracemalloc.Snapshot, current: int, peak: int) -> None:
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ])
+        with open(self.paths['tracemalloc'], 'w') as out:
+            out.write('Traced memory: current {0:.1f} KiB, peak {1:.1f} KiB\n'.format(
+                current / 1024, peak / 1024))
+            out.write('Top {0} allocating lines:\n'.format(self.top))
+            for number, stat in enumerate(snapshot.statistics('lineno')[:self.top], 1):
+                frame: tracemalloc.Frame = stat.traceback[0]
+                out.write('#{0} {1}:{2}: {3:.1f} KiB in {4} blocks\n'.format(
+                    number, frame.filename, frame.lineno, stat.size / 1024, stat.count))
+                line: str = linecache.getline(frame.filename, frame.lineno).strip()
+                if line:
+                    out.write('    {0}\n'.format(line))
+
+
+def profile_run(directory: str) -> Optional[int]:
+    ''' One main() run with clients of daemon under RunProfiler '''
+
+    runtime: Runtime = Runtime()
+    with RunProfiler(directory):
+        try:
+            db: Optional[Database] = runtime.get_db()
+            if db is None:
+                return None
+            return main(runtime.get_client(), db, runtime.get_seen(db))
+        finally:
+            runtime.close()
+
+
+def cli(argv: Optional[List[str]] = None) -> int:
+    ''' Run daemon, or one profiled run with --profile DIR (env AUTORADARR_PROFILE) '''
+
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        prog='autoradarr', description='Auto scan for new films in imdb and add into Radarr')
+    parser.add_argument('--profile', metavar='DIR',
+                        default=os.environ.get('AUTORADARR_PROFILE', ''),
+                        help='run main() once, write cProfile stats, sampled stacks '
+                             'and top allocations into DIR')
+    args: argparse.Namespace = parser.parse_args(argv)
+
+    setup_logging()
+    if args.profile:
+        return 0 if profile_run(args.profile) is not None else 1
+    run_daemon()
+    return 0
+
+
 if __name__ == '__main__':
-    while True:
-        main()
-        print('--- Autoradarr has been entered in sleep mode at {}'.format(datetime.datetime.utcnow()))
-        # day * hour * min * sec
-        # time.sleep(1 * 24 * 60 * 60)
-        time.sleep(1 * 60 * 60)
+    sys.exit(cli())
 
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+''' Offline benchmark of main() and filter stages against local stand-in
+    servers of imdb-api.com, TMDB and Radarr (see fake_servers.py).
+
+    python benchmarks/bench_pipeline.py [--popular 100] [--library 50000]
+        [--latency 0.005] [--error-rate 0] [--repeats 3] [--mongo URI] [--json]
+        [--budget benchmarks/budget.json]
+
+    DB is mongomock unless --mongo mongodb://... of local mongod is given.
+    Mongomock is not thread-safe, so with it DB stages run in one worker.
+    Reports wall time, HTTP calls by route and peak memory (tracemalloc).
+    With --budget exits with 1 if any stage is slower or makes more calls
+    than budget allows (CI), budget's args must match given ones.
+
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+import mongomock
+import pymongo
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import autoradarr.autoradarr as autoradarr  # noqa: E402
+from fake_servers import FakeServer, make_servers  # noqa: E402
+
+
+def make_db(mongo: str) -> Any:
+    ''' Empty autoradarr DB with indexes '''
+
+    client: Any = pymongo.MongoClient(mongo) if mongo else mongomock.MongoClient()
+    client.drop_database('autoradarr_bench')
+    db: Any = client['autoradarr_bench']
+    autoradarr.ensure_db_indexes(db)
+    return db
+
+
+def measure(name: str,
+            case: Callable[[Any], Any],
+            args: Any,
+            servers: 'Dict[str, FakeServer]') -> 'Dict[str, Any]':
+    ''' Run case(db) on fresh DB and caches repeats times, keep best wall time '''
+
+    best: float = 0
+    peak: int = 0
+    calls: Dict[str, int] = {}
+    for _ in range(args.repeats):
+        db: Any = make_db(args.mongo)
+        autoradarr.get_db = lambda *params: db
+        autoradarr.radarr_library.update({'index': None, 'loaded': 0.0, 'instances': {}})
+        for server in servers.values():
+            server.calls.clear()
+
+        tracemalloc.start()
+        start: float = time.perf_counter()
+        # Keep report readable if logging is set up
+        with contextlib.redirect_stdout(io.StringIO()):
+            case(db)
+        wall: float = time.perf_counter() - start
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+        best = wall if not best else min(best, wall)
+        calls = {server_name + '.' + route: count
+                 for server_name, server in servers.items()
+                 for route, count in sorted(server.calls.items())}
+
+    return {'name': name, 'wall_ms': round(best * 1000, 2),
+            'peak_kb': round(peak / 1024, 1), 'calls': calls}
+
+
+def make_cases(popular: 'List[Dict[str, str]]') -> 'Dict[str, Callable[[Any], Any]]':
+    ''' Stages in order of main() pipeline, every one on same popular list '''
+
+    def stage(func: Callable[..., Any]) -> Callable[[Any], Any]:
+        return lambda db: func(autoradarr.make_http_client(), db)
+
+    def regular(client: Any, db: Any) -> Any:
+        return autoradarr.filter_regular_result(popular, 'imDbRating', 'imDbRatingCount',
+                                                'year')
+
+    def in_db(client: Any, db: Any) -> Any:
+        return autoradarr.filter_in_db(db, regular(client, db), 'id')
+
+    def in_radarr(client: Any, db: Any) -> Any:
+        return autoradarr.filter_in_radarr(client, db, regular(client, db), 'id', 'title')
+
+    def by_detail(client: Any, db: Any) -> Any:
+        return autoradarr.filter_by_detail(client, db, regular(client, db))
+
+    def to_radarr(client: Any, db: Any) -> Any:
+        films: Any = autoradarr.convert_imdb_in_radarr(by_detail(client, db))
+        return autoradarr.add_to_radarr(client, db, [films])
+
+    return {
+        'filter_regular_result': stage(regular),
+        'filter_in_db': stage(in_db),
+        'filter_in_radarr': stage(in_radarr),
+        'filter_by_detail': stage(by_detail),
+        'add_to_radarr': stage(to_radarr),
+        'main': lambda db: autoradarr.main(),
+    }
+
+
+def check_budget(report: 'List[Dict[str, Any]]', budget: 'Dict[str, Any]') -> 'List[str]':
+    ''' Return violations of budget {"stages": {name: {"wall_ms": max,
+        "calls": {route: max}}}} '''
+
+    violations: List[str] = []
+    for row in report:
+        limits: Dict[str, Any] = budget['stages'].get(row['name'], {})
+        if 'wall_ms' in limits and row['wall_ms'] > limits['wall_ms']:
+            violations.append('{0}: {1} ms > {2} ms'.format(row['name'], row['wall_ms'],
+                                                            limits['wall_ms']))
+        for route, count in row['calls'].items():
+            limit: int = limits.get('calls', {}).get(route, 0)
+            if count > limit:
+                violations.append('{0}: {1} {2} calls > {3}'.format(row['name'], count,
+                                                                    route, limit))
+    return violations
+
+
+def main() -> None:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--popular', type=int, default=100, help='films in popular list')
+    parser.add_argument('--library', type=int, default=10000, help='movies in Radarr')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds per request')
+    parser.add_argument('--error-rate', type=float, default=0, help='part of 500 answers')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--mongo', default='', help='URI of local mongod, else mongomock')
+    parser.add_argument('--json', action='store_true', help='print report as json')
+    parser.add_argument('--budget', default='', help='json of max wall time and calls')
+    args: argparse.Namespace = parser.parse_args()
+
+    budget: Dict[str, Any] = {}
+    if args.budget:
+        with open(args.budget) as budget_file:
+            budget = json.load(budget_file)
+        other: Dict[str, Any] = {name: value for name, value in budget['args'].items()
+                                 if getattr(args, name) != value}
+        if other:
+            sys.exit('Budget is measured with other args: {0}'.format(other))
+
+    servers: Dict[str, FakeServer] = make_servers(args.popular, args.library,
+                                                  library_overlap=args.popular // 10,
+                                                  latency=args.latency,
+                                                  error_rate=args.error_rate)
+    for server in servers.values():
+        server.start()
+    os.environ.update({
+        'IMDB_API_URL': servers['imdb'].url, 'IMDB_APIKEY': 'bench',
+        'TMDB_API_URL': servers['tmdb'].url, 'TMDB_APIKEY': 'bench',
+        'RADARR_URL': servers['radarr'].url, 'RADARR_APIKEY': 'bench',
+        'RADARR_ROOT_ANIMATIONS': '/animations', 'RADARR_ROOT_OTHER': '/movies',
+        'RADARR_DEFAULT_QUALITY': '1',
+        # Retries of fake errors without backoff sleeps
+        'AUTORADARR_HTTP_BACKOFF': '0',
+    })
+    if not args.mongo:
+        for workers in ('AUTORADARR_DETAIL_WORKERS', 'AUTORADARR_TMDB_WORKERS'):
+            os.environ.setdefault(workers, '1')
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        popular: List[Dict[str, str]] = autoradarr.get_imdb_list(
+            autoradarr.make_http_client(), 'popular') or []
+    report: List[Dict[str, Any]] = []
+    try:
+        for name, case in make_cases(popular).items():
+            report.append(measure(name, case, args, servers))
+    finally:
+        for server in servers.values():
+            server.stop()
+
+    violations: List[str] = check_budget(report, budget) if budget else []
+    if args.json:
+        print(json.dumps({'args': vars(args), 'stages': report, 'violations': violations},
+                         indent=2))
+    else:
+        print_report(report, args)
+    if violations:
+        sys.exit('Over budget:\n' + '\n'.join(violations))
+
+
+def print_report(report: 'List[Dict[str, Any]]', args: argparse.Namespace) -> None:
+    print('{0} popular films, {1} movies in Radarr, latency {2} s, error rate {3}, '
+          'best of {4} runs'.format(args.popular, args.library, args.latency,
+                                    args.error_rate, args.repeats))
+    for row in report:
+        print('{0:<24} {1:10.2f} ms {2:10.1f} KiB  {3}'.format(
+            row['name'], row['wall_ms'], row['peak_kb'],
+            ', '.join('{0}={1}'.format(*call) for call in row['calls'].items() if call[1])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+''' Benchmark of filter_regular_result: legacy per-film loop against
+    compiled RegularFilter on raw dicts and on Film records.
+
+    python benchmarks/bench_regular_filter.py [films] [repeats]
+
+'''
+import datetime
+import random
+import sys
+import timeit
+from typing import Any, Dict, List
+
+from autoradarr.autoradarr import Film, RegularFilter
+
+
+def legacy_filter(newfilms: Any,
+                  rating_field: str,
+                  rating_count_field: str,
+                  year_field: str,
+                  current_year: int = 0) -> Any:
+    ''' filter_regular_result before RegularFilter '''
+
+    year: int = current_year
+    if not year:
+        year = datetime.datetime.utcnow().year
+
+    notfiltred_films: Any = []
+    for item in newfilms:
+        removeflag: bool = False
+        if (rating_field not in item) or \
+           (not item[rating_field]) or \
+           (float(item[rating_field]) < 6.5):
+            removeflag = True
+        if (rating_count_field not in item) or \
+           (not item[rating_count_field]) or \
+           (int(item[rating_count_field]) < 5000):
+            removeflag = True
+        try:
+            if (year_field not in item) or \
+               (not item[year_field]) or \
+               (int(item[year_field]) < year - 1):
+                removeflag = True
+        # Year format incorrect - next film
+        except ValueError:
+            continue
+        if not removeflag:
+            notfiltred_films.append(item)
+
+    return notfiltred_films
+
+
+def make_films(count: int, year: int) -> 'List[Dict[str, str]]':
+    ''' Films like MostPopularMovies/Top250 items, some fields empty '''
+
+    rnd: random.Random = random.Random(count)
+    films: List[Dict[str, str]] = []
+    for index in range(count):
+        film: Dict[str, str] = {
+            'id': 'tt{0}'.format(index),
+            'year': str(rnd.randint(year - 30, year)),
+            'imDbRating': '{0:.1f}'.format(rnd.uniform(3, 9.5)),
+            'imDbRatingCount': str(rnd.randint(0, 500000)),
+        }
+        if index % 17 == 0:
+            film['imDbRating'] = ''
+        if index % 23 == 0:
+            film['imDbRatingCount'] = ''
+        films.append(film)
+    return films
+
+
+def main() -> None:
+    count: int = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeats: int = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    year: int = datetime.datetime.utcnow().year
+    films: List[Dict[str, str]] = make_films(count, year)
+
+    regular_filter: RegularFilter = RegularFilter('imDbRating', 'imDbRatingCount', 'year',
+                                                  6.5, 5000, year - 1)
+    assert regular_filter(films) == legacy_filter(films, 'imDbRating', 'imDbRatingCount',
+                                                  'year', year)
+    records: List[Film] = [Film.from_imdb(film) for film in films]
+    assert [film.id for film in regular_filter(records)] == \
+        [film['id'] for film in regular_filter(films)]
+
+    cases: Dict[str, Any] = {
+        'legacy loop': lambda: legacy_filter(films, 'imDbRating', 'imDbRatingCount',
+                                             'year', year),
+        'RegularFilter': lambda: regular_filter(films),
+        'RegularFilter, Film': lambda: regular_filter(records),
+    }
+
+    print('{0} films, best of {1} runs'.format(count, repeats))
+    legacy: float = 0
+    for name, case in cases.items():
+        best: float = min(timeit.repeat(case, number=1, repeat=repeats))
+        legacy = legacy or best
+        print('{0:<24} {1:8.2f} ms  x{2:.2f}'.format(name, best * 1000, legacy / best))
+
+
+if __name__ == '__main__':
+    main()
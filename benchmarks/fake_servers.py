@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+''' Local stand-in servers of imdb-api.com, TMDB and Radarr for benchmarks.
+
+    Every server answers after latency seconds, fails with 500 in
+    error_rate part of requests and counts calls by route.
+
+'''
+import datetime
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Any, Callable, Dict, List, Optional, Pattern, Tuple
+
+GENRES: List[str] = ['Action', 'Adventure', 'Sci-Fi', 'Animation', 'Comedy', 'Drama',
+                     'Crime', 'Thriller', 'Horror', 'Romance']
+
+# (method, route name, path regex, handler(match, body) -> (status, json))
+Route = Tuple[str, str, Pattern[str], Callable[[Any, Any], Tuple[int, Any]]]
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeServer(object):
+    ''' HTTP server on 127.0.0.1 (random port) answering by routes '''
+
+    def __init__(self,
+                 name: str,
+                 routes: 'List[Route]',
+                 latency: float = 0,
+                 error_rate: float = 0,
+                 seed: int = 0) -> None:
+        self.name: str = name
+        self.routes: List[Route] = routes
+        self.latency: float = latency
+        self.error_rate: float = error_rate
+        self.random: random.Random = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.lock: threading.Lock = threading.Lock()
+        self.httpd: Optional[ThreadingServer] = None
+
+    @property
+    def url(self) -> str:
+        assert self.httpd is not None
+        return 'http://127.0.0.1:{0}'.format(self.httpd.server_address[1])
+
+    def start(self) -> 'FakeServer':
+        server: FakeServer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                server.handle(self, 'GET')
+
+            def do_POST(self) -> None:
+                server.handle(self, 'POST')
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        self.httpd = ThreadingServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+    def handle(self, request: BaseHTTPRequestHandler, method: str) -> None:
+        body: Any = None
+        length: int = int(request.headers.get('Content-Length') or 0)
+        if length:
+            body = json.loads(request.rfile.read(length))
+        path: str = request.path.split('?')[0]
+
+        for route_method, name, pattern, handler in self.routes:
+            match: Any = pattern.fullmatch(path)
+            if route_method != method or not match:
+                continue
+            with self.lock:
+                self.calls[name] += 1
+                failed: bool = self.random.random() < self.error_rate
+            if self.latency:
+                time.sleep(self.latency)
+            if failed:
+                self.answer(request, 500, {'error': 'Fake error'})
+            else:
+                self.answer(request, *handler(match, body))
+            return
+        self.answer(request, 404, {'error': 'Unknown route'})
+
+    @staticmethod
+    def answer(request: BaseHTTPRequestHandler, status: int, data: Any) -> None:
+        payload: bytes = data if isinstance(data, bytes) else json.dumps(data).encode()
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(payload)))
+        request.end_headers()
+        request.wfile.write(payload)
+
+
+def imdbid(index: int) -> str:
+    return 'tt{0:07d}'.format(1000000 + index)
+
+
+def make_popular(count: int, seed: int = 0) -> 'List[Dict[str, str]]':
+    ''' MostPopularMovies items, about half of them pass regular filter '''
+
+    rnd: random.Random = random.Random(seed)
+    year: int = datetime.datetime.utcnow().year
+    films: List[Dict[str, str]] = []
+    for index in range(count):
+        title: str = 'Film {0}'.format(index)
+        film_year: str = str(rnd.choice([year, year, year - 1, year - 5]))
+        films.append({
+            'id': imdbid(index), 'rank': str(index + 1), 'title': title,
+            'fullTitle': '{0} ({1})'.format(title, film_year), 'year': film_year,
+            'imDbRating': '{0:.1f}'.format(rnd.uniform(5, 9)),
+            'imDbRatingCount': str(rnd.randint(1000, 300000)),
+        })
+    return films
+
+
+def make_library(size: int, overlap: int) -> bytes:
+    ''' Radarr /api/v3/movie payload, first overlap films of popular list included '''
+
+    movies: List[Dict[str, Any]] = []
+    for index in range(size):
+        number: int = index if index < overlap else 5000000 + index
+        movies.append({
+            'id': index + 1, 'title': 'Movie {0}'.format(number), 'imdbId': imdbid(number),
+            'tmdbId': number + 1, 'year': 2000 + index % 22, 'hasFile': index % 3 == 0,
+            'path': '/movies/Movie {0}'.format(number), 'monitored': True,
+            'images': [{'coverType': 'poster',
+                        'url': '/MediaCover/{0}/poster.jpg'.format(index + 1)}],
+            'ratings': {'votes': index * 7 % 100000, 'value': index % 90 / 10},
+            'overview': 'Overview of movie {0}. '.format(number) * 4,
+        })
+    return json.dumps(movies).encode()
+
+
+def make_servers(popular_size: int = 100,
+                 library_size: int = 1000,
+                 library_overlap: int = 10,
+                 latency: float = 0,
+                 error_rate: float = 0) -> 'Dict[str, FakeServer]':
+    ''' Return not started stand-ins of imdb-api.com, TMDB and Radarr '''
+
+    popular: List[Dict[str, str]] = make_popular(popular_size)
+    library: bytes = make_library(library_size, library_overlap)
+
+    def title(match: Any, body: Any) -> Tuple[int, Any]:
+        index: int = int(match.group(1)[2:]) - 1000000
+        genres: List[str] = [GENRES[index % len(GENRES)], GENRES[index * 7 % len(GENRES)]]
+        return 200, {'id': match.group(1), 'genres': ', '.join(dict.fromkeys(genres)),
+                     'plot': 'Plot. ' * 50}
+
+    def find(match: Any, body: Any) -> Tuple[int, Any]:
+        index: int = int(match.group(1)[2:]) - 1000000
+        return 200, {'movie_results': [{'id': index + 1}] if index % 10 else []}
+
+    def lookup(match: Any, body: Any) -> Tuple[int, Any]:
+        return 404, {}
+
+    imdb: FakeServer = FakeServer('imdb', [
+        ('GET', 'popular', re.compile(r'/ru/API/MostPopularMovies/[^/]+'),
+         lambda match, body: (200, {'items': popular, 'errorMessage': ''})),
+        ('GET', 'top250', re.compile(r'/ru/API/Top250Movies/[^/]+'),
+         lambda match, body: (200, {'items': popular[:250], 'errorMessage': ''})),
+        ('GET', 'title', re.compile(r'/ru/API/Title/[^/]+/(tt\d+)'), title),
+    ], latency, error_rate, seed=1)
+    tmdb: FakeServer = FakeServer('tmdb', [
+        ('GET', 'find', re.compile(r'/3/find/(tt\d+)'), find),
+    ], latency, error_rate, seed=2)
+    radarr: FakeServer = FakeServer('radarr', [
+        ('GET', 'library', re.compile(r'/api/v3/movie'), lambda match, body: (200, library)),
+        ('POST', 'add', re.compile(r'/api/v3/movie'), lambda match, body: (201, body)),
+        ('POST', 'import', re.compile(r'/api/v3/movie/import'), lambda match, body: (200, body)),
+        ('GET', 'lookup', re.compile(r'/api/v3/movie/lookup/imdb'), lookup),
+    ], latency, error_rate, seed=3)
+    return {'imdb': imdb, 'tmdb': tmdb, 'radarr': radarr}
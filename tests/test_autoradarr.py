@@ -1,26 +1,92 @@
 # -*- coding: utf-8 -*-
+import datetime
+import io
+import json
+import logging
 import os
+import pstats
+import re
+import socket
+import threading
+import time
 
 import mongomock
 import pymongo
 import pytest
 import requests
 from autoradarr.autoradarr import (
+    acceptance_score,
+    add_tmdb_pending,
+    add_to_radarr,
+    cli,
     convert_imdb_in_radarr,
+    diff_snapshot,
+    ensure_db_indexes,
+    fetch_imdb_details,
+    Film,
+    fetch_provider,
+    FolderFormat,
     filter_by_detail,
     filter_in_db,
     filter_in_radarr,
     filter_regular_result,
+    films_near_thresholds,
     get_db,
+    cache_stats,
     get_imdb_data,
+    get_imdb_details,
+    get_new_films,
     get_radarr_data,
+    get_radarr_imdbid_list,
+    get_radarr_index,
+    get_radarr_instances,
     get_tmdbid_by_imdbid,
+    host_slot,
+    iter_imdb_films,
+    iter_json_array,
+    iter_providers_batches,
+    iter_providers_films,
+    Job,
+    JitterRetry,
+    log,
+    MarkBuffer,
     main,
+    Metrics,
+    metrics,
+    make_http_client,
+    make_jobs,
     mark_filtred_in_db,
     necessary_fields_for_radarr,
+    normalize_filepath,
+    parse_log_levels,
+    Provider,
+    providers,
+    radarr_library,
+    RadarrInstance,
+    record_ratings,
+    RegularFilter,
+    RequestBudget,
+    RunProfiler,
+    Runtime,
+    resolve_tmdbids,
+    Scheduler,
+    sync_radarr_index,
+    SeenIndex,
     set_root_folders_by_genres,
+    setup_logging,
+    StageTimer,
+    start_metrics_server,
+    StackSampler,
+    stop_logging,
 )
 
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
 db_host = os.environ.get('AUTORADARR_DB_HOST')
 DB_NAME = 'autoradarr'
 db_user = os.environ.get('AUTORADARR_DB_USERNAME')
@@ -54,6 +120,17 @@ def test_get_db_fail():
     assert get_db(db_host, DB_NAME, db_user, 'bad_password') is None
 
 
+def test_mongo_client_closed_on_fail(mocker):
+    db_client = mocker.patch('autoradarr.autoradarr.pymongo.MongoClient').return_value
+    for error in (pymongo.errors.ServerSelectionTimeoutError('down'),
+                  pymongo.errors.OperationFailure('auth failed')):
+        db_client.server_info.side_effect = error
+        db_client.close.reset_mock()
+        assert get_db('localhost', DB_NAME, 'user', 'password') is None
+        # Failed connect doesn't leave client with its threads
+        db_client.close.assert_called_once_with()
+
+
 @pytest.mark.parametrize((('newfilms'), ('expected')), [
     (
         [
@@ -86,6 +163,42 @@ def test_filter_regular_result(newfilms, expected):
                                              2021)
 
 
+def test_regular_filter():
+    regular_filter = RegularFilter('imDbRating', 'imDbRatingCount', 'year', 6.5, 5000, 2020)
+    newfilms = [
+        {'year': '2020', 'imDbRating': '6.5', 'imDbRatingCount': '27165'},
+        {'year': '2021', 'imDbRating': 7.3, 'imDbRatingCount': 5000},
+        {'year': '2019', 'imDbRating': '6.5', 'imDbRatingCount': '5000'},
+        {'year': '2021', 'imDbRating': '', 'imDbRatingCount': '5000'},
+        {'year': '2021', 'imDbRating': '7.3', 'imDbRatingCount': None},
+        {'year': '20x1', 'imDbRating': '7.3', 'imDbRatingCount': '5000'},
+        {'imDbRating': '7.3', 'imDbRatingCount': '5000'},
+    ]
+    assert regular_filter.mask(newfilms) == [True, True, False, False, False, False, False]
+    assert regular_filter(newfilms) == newfilms[:2]
+    assert regular_filter([]) == []
+
+    with pytest.raises(ValueError):
+        regular_filter([{'year': '2021', 'imDbRating': 'N/A', 'imDbRatingCount': '5000'}])
+    with pytest.raises(ValueError):
+        regular_filter([{'year': '2021', 'imDbRating': '7', 'imDbRatingCount': '5.5'}])
+
+
+def test_iter_json_array():
+    items = [{'imdbId': 'tt180', 'title': 'Фильм "1"'}, 12345, [1, {'a': None}], 'tt', 1.5]
+    payload = (' [ ' + ' ,\n'.join(json.dumps(item, ensure_ascii=False) for item in items) +
+               ' ] ').encode()
+    # Every split of bytes, incl. split of utf-8 chars and numbers
+    for size in (1, 2, 3, 7, len(payload)):
+        chunks = [payload[start:start + size] for start in range(0, len(payload), size)]
+        assert list(iter_json_array(chunks)) == items
+    assert list(iter_json_array([b'[]'])) == []
+
+    for broken in (b'{"imdbId": "tt1"}', b'[{"imdbId": "tt1"}', b'[{"imdbId": "tt1"', b''):
+        with pytest.raises(ValueError):
+            list(iter_json_array([broken]))
+
+
 @pytest.mark.parametrize((('film_in_db'), ('newfilms'), ('expected')), [
     (
         [{'imdbId': 'tt7979580'}],    # film in db
@@ -123,6 +236,31 @@ def test_filter_in_db(newfilms, film_in_db, expected):
     assert filter_in_db(db, newfilms, 'id') == expected
 
 
+def test_ensure_db_indexes():
+    db_client = mongomock.MongoClient()
+    db = db_client.db
+    db.films.insert_many([{'imdbId': 'tt180'}, {'imdbId': 'tt170'}])
+    assert ensure_db_indexes(db)
+    assert db.films.index_information()['imdbId_1']['unique']
+    assert db.imdb_details.index_information()['cached_1']['expireAfterSeconds']
+    with pytest.raises(pymongo.errors.DuplicateKeyError):
+        db.films.insert_one({'imdbId': 'tt180'})
+
+
+def test_ensure_db_indexes_fail():
+    db_client = mongomock.MongoClient()
+    db = db_client.db
+    db.films.insert_many([{'imdbId': 'tt180'}, {'imdbId': 'tt180'}])
+    assert not ensure_db_indexes(db)
+    # Duplicates keep non-unique index, other indexes are created
+    assert not db.films.index_information()['imdbId_1'].get('unique')
+    assert 'added_1' in db.films.index_information()
+    assert db.tmdb_ids.index_information()['imdbId_1']['unique']
+    assert db.tmdb_pending.index_information()['queued_1']['expireAfterSeconds']
+    assert 'month_1_last.c_1' in db.rating_history.index_information()
+    assert db.imdb_details.index_information()['cached_1']['expireAfterSeconds']
+
+
 def test_get_imdb_data_from_site():
     ''' Test 'details' param from 'imdb-api.com' '''
 
@@ -138,12 +276,53 @@ def test_get_imdb_data_mock(requests_mock):
     assert get_imdb_data(requests.session(), 'popular').text == 'tt7979580'
 
 
+def test_get_imdb_data_url(requests_mock, monkeypatch):
+    ''' Stand-in server by IMDB_API_URL '''
+
+    monkeypatch.setenv('IMDB_API_URL', 'http://127.0.0.1:8000')
+    url = 'http://127.0.0.1:8000/ru/API/MostPopularMovies/' + os.environ.get('IMDB_APIKEY')
+    requests_mock.get(url, text='tt7979580', status_code=200)
+    assert get_imdb_data(requests.session(), 'popular').text == 'tt7979580'
+
+
 def test_get_imdb_data_fail(requests_mock):
     url = 'https://imdb-api.com/ru/API/MostPopularMovies/' + os.environ.get('IMDB_APIKEY')
     requests_mock.get(url, text='tt7979580', status_code=300)
     assert get_imdb_data(requests.session(), 'popular') is None
 
 
+def test_http_client_conditional_get(requests_mock):
+    url = 'https://imdb-api.com/ru/API/MostPopularMovies/key'
+    requests_mock.get(url, [{'json': {'items': []}, 'headers': {'ETag': '"v1"'}},
+                            {'status_code': 304},
+                            {'json': {'items': [1]}, 'headers': {'ETag': '"v2"'}}])
+    client = make_http_client()
+    assert client.get(url).json() == {'items': []}
+    assert requests_mock.last_request.timeout == client.timeout
+    assert 'If-None-Match' not in requests_mock.last_request.headers
+
+    r = client.get(url, headers={'User-Agent': 'Mozilla/5.0'})
+    assert r.status_code == 200
+    assert r.json() == {'items': []}
+    assert requests_mock.last_request.headers['If-None-Match'] == '"v1"'
+    assert requests_mock.last_request.headers['User-Agent'] == 'Mozilla/5.0'
+
+    assert client.get(url).json() == {'items': [1]}
+    assert client.conditional[url].headers['ETag'] == '"v2"'
+
+
+def test_http_client_retry():
+    client = make_http_client()
+    retry = client.get_adapter('https://imdb-api.com').max_retries
+    assert isinstance(retry, JitterRetry)
+    assert retry.total == 3
+    assert 503 in retry.status_forcelist
+    retry = retry.increment(method='GET', url='/')
+    retry = retry.increment(method='GET', url='/')
+    for _ in range(10):
+        assert 0 <= retry.get_backoff_time() <= 1
+
+
 def test_get_radarr_data_get_movie(requests_mock):
     url = os.environ.get('RADARR_URL') + '/api/v3/movie?apiKey=' + \
         os.environ.get('RADARR_APIKEY')
@@ -171,6 +350,16 @@ def test_get_radarr_data_fail(requests_mock):
                            api_json={'a': 'b'}) is None
 
 
+def test_get_radarr_index(requests_mock):
+    url = os.environ.get('RADARR_URL') + '/api/v3/movie?apiKey=' + \
+        os.environ.get('RADARR_APIKEY')
+    requests_mock.get(url, json=[{'imdbId': 'tt180'}, {'title': 'No imdbId'},
+                                 {'imdbId': ''}, {'imdbId': 'tt190'}])
+    imdbid_list = get_radarr_imdbid_list(get_radarr_data(requests.session(), 'get_movie'))
+    assert imdbid_list == ['tt180', {'imdbId': '0'}, 'tt190']
+    assert get_radarr_index(imdbid_list) == frozenset({'tt180', 'tt190'})
+
+
 @pytest.mark.parametrize((('film_in_db'),
                           ('imdbid'),
                           ('title'),
@@ -227,6 +416,125 @@ def test_mark_filtred_in_db(film_in_db, imdbid, title, persist_in_radarr, expect
             assert film['filtred'] == 1
 
 
+def test_mark_buffer():
+    db_client = mongomock.MongoClient()
+    db = db_client.db
+    db.films.insert_one({'imdbId': 'tt180', 'originalTitle': 'Old', 'filtred': 1})
+    buffer = MarkBuffer(db)
+    assert mark_filtred_in_db(db, 'tt180', 'New', 1, buffer)
+    assert mark_filtred_in_db(db, 'tt170', 'Title', 1, buffer)
+    assert mark_filtred_in_db(db, 'tt170', 'Title twice', 0, buffer)
+    assert len(buffer) == 2
+    assert db.films.find_one({'imdbId': 'tt170'}) is None   # Not flushed yet
+
+    assert buffer.flush() == 1
+    assert len(buffer) == 0
+    assert buffer.flush() == 0
+    assert db.films.count_documents({}) == 2
+    assert db.films.find_one({'imdbId': 'tt180'})['originalTitle'] == 'Old'
+    film = db.films.find_one({'imdbId': 'tt170'})
+    assert film['originalTitle'] == 'Title'
+    assert film['persistInRadarr'] == 1
+    assert film['added']
+
+
+def test_mark_buffer_background():
+    db = mongomock.MongoClient().db
+    seen = SeenIndex(os.devnull + '.missing')
+    buffer = MarkBuffer(db, seen)
+    buffer.add('tt180', 'Title')
+    # Seen after mark has been written
+    assert 'tt180' not in seen
+    buffer.flush_background()
+    assert len(buffer) == 0
+    buffer.add('tt170', 'Title2', 1)
+    assert buffer.flush() == 2
+    assert buffer.executor is None
+    assert db.films.count_documents({}) == 2
+    assert 'tt180' in seen and 'tt170' in seen
+
+
+def test_mark_buffer_write_fail(mocker):
+    db = mongomock.MongoClient().db
+    seen = SeenIndex(os.devnull + '.missing')
+    buffer = MarkBuffer(db, seen)
+    bulk_write = mocker.patch.object(db.films, 'bulk_write',
+                                     side_effect=pymongo.errors.AutoReconnect('down'))
+    mocker.patch.object(db, 'get_collection', return_value=db.films)
+    buffer.add('tt180', 'Title')
+    buffer.flush_background()
+    assert buffer.flush() == 0
+    assert 'tt180' not in seen
+
+    # Only films of successful writes are seen
+    bulk_write.side_effect = pymongo.errors.BulkWriteError(
+        {'nUpserted': 1, 'writeErrors': [{'index': 1, 'errmsg': 'fail'}]})
+    buffer.add('tt170', 'Title2')
+    buffer.add('tt190', 'Title3')
+    assert buffer.flush() == 1
+    assert 'tt170' in seen
+    assert 'tt190' not in seen
+
+
+def test_seen_index(tmp_path):
+    path = str(tmp_path / 'seen.idx')
+    seen = SeenIndex(path)
+    assert len(seen) == 0
+    assert 'tt180' not in seen
+    assert not seen.save()
+
+    seen.update(['tt0000180', 'tt10000170', 'tt180', 'bad'])
+    assert 'tt180' in seen
+    assert 'bad' in seen
+    assert seen.save()
+    assert os.path.getsize(path) == 2 * 4
+    assert seen.added == set()
+    assert 'tt180' in seen
+    assert 'tt10000170' in seen
+    assert 'tt170' not in seen
+
+    # Incremental update - merged into file
+    seen.update(['tt170', 'tt180'])
+    assert seen.save()
+    seen.close()
+
+    loaded = SeenIndex(path)
+    assert len(loaded) == 3
+    assert all(imdbid in loaded for imdbid in ('tt170', 'tt180', 'tt10000170'))
+    assert 'bad' not in loaded
+    assert 'tt190' not in loaded
+    loaded.close()
+
+    # Broken file is ignored
+    with open(path, 'ab') as broken:
+        broken.write(b'x')
+    assert len(SeenIndex(path)) == 0
+
+
+def test_filter_imdb_films_seen(mocker, tmp_path):
+    mocker.patch('autoradarr.autoradarr.load_radarr_index', return_value=frozenset(['tt3']))
+    mocker.patch('autoradarr.autoradarr.filter_by_detail',
+                 side_effect=lambda client, db, films, buffer: films)
+    filter_in_db = mocker.patch('autoradarr.autoradarr.filter_in_db')
+    year = str(datetime.datetime.utcnow().year)
+    newfilms = [{'id': 'tt{0}'.format(index), 'title': str(index), 'year': year,
+                 'imDbRating': '7', 'imDbRatingCount': '9000'} for index in range(5)]
+    db = mongomock.MongoClient().db
+    seen = SeenIndex(str(tmp_path / 'seen.idx'))
+    seen.update(['tt1'])
+    buffer = MarkBuffer(db, seen)
+
+    films = [film['id'] for chunk in iter_imdb_films(requests.session(), db, newfilms, buffer,
+                                                     chunk_size=2, seen=seen)
+             for film in chunk]
+    assert films == ['tt0', 'tt2', 'tt4']
+    assert not filter_in_db.called
+    buffer.flush()
+    # Radarr film is seen after its mark has been written
+    assert 'tt3' in seen
+    assert db.films.find_one({'imdbId': 'tt3'})['persistInRadarr'] == 1
+
+
 def test_filter_in_radarr(mocker):
     mocker.patch('autoradarr.autoradarr.get_radarr_data', return_value=True)
     # imdbid_list in filter_in_radarr:
@@ -288,6 +596,26 @@ def test_set_root_folders_by_genres_fail():
         set_root_folders_by_genres({'fullTitle': ' %^$&%  Ё  '}, ['Action'])
 
 
+@pytest.mark.parametrize('title', [
+    'Normal Title', 'Mortal Kombat: Legends', 'Amélie', ' -Title_ ', 'Ёлки', '%/Title\t/_',
+])
+def test_folder_format_default(title):
+    folder_format = FolderFormat('{Movie Title} ({Release Year})')
+    film = {'title': title, 'year': '2021'}
+    expected = normalize_filepath(title + ' (2021)')
+    assert folder_format(film) == expected
+    film['fullTitle'] = title + ' (2021)'
+    assert folder_format(film) == expected
+
+
+def test_folder_format():
+    folder_format = FolderFormat('{Movie Title}: {Release Year} [{ImdbId}]')
+    film = {'title': 'Title', 'year': '2021', 'id': 'tt180', 'fullTitle': 'Title (2021)'}
+    assert folder_format(film) == 'Title - 2021 tt180'
+    with pytest.raises(Exception, match='Unknown token in folder format: {Movie Year}'):
+        FolderFormat('{Movie Title} {Movie Year}')
+
+
 def test_filter_by_detail(requests_mock):
     url1 = 'https://imdb-api.com/ru/API/Title/' + os.environ.get('IMDB_APIKEY') + '/tt7979580'
     requests_mock.get(url1, json={'genres': 'Action, Adventure'})
@@ -306,6 +634,7 @@ def test_filter_by_detail(requests_mock):
     assert len(result) == 2
     assert result[0]['id'] == 'tt7979580'
     assert result[1]['id'] == 'tt170'
+    assert result[1]['genres'] == ['Action', 'Drama']
 
     # mark_filtred_in_db
     assert db.films.find_one({'imdbId': 'tt190'})['imdbId'] == 'tt190'
@@ -321,6 +650,141 @@ def test_filter_by_detail_fail(mocker):
     assert filter_by_detail(requests.session(), db, newfilms) == []
 
 
+def test_request_timeouts(requests_mock):
+    url = 'https://imdb-api.com/ru/API/Title/' + os.environ.get('IMDB_APIKEY') + '/{0}'
+    requests_mock.get(url.format('tt180'), json={'genres': 'Action'})
+    requests_mock.get(url.format('tt170'), exc=requests.exceptions.ReadTimeout)
+    requests_mock.get(url.format('tt190'), exc=requests.exceptions.ConnectionError)
+    newfilms = [{'id': imdbid, 'title': imdbid, 'imDbRating': '7', 'fullTitle': imdbid}
+                for imdbid in ('tt180', 'tt170', 'tt190')]
+    db = mongomock.MongoClient().db
+    # Films without answer are skipped till next scan
+    assert [film['id'] for film in filter_by_detail(requests.session(), db, newfilms)] == \
+        ['tt180']
+    assert db.films.count_documents({}) == 0
+
+    requests_mock.get(re.compile('https://api.themoviedb.org/3/find/'),
+                      exc=requests.exceptions.ReadTimeout)
+    assert get_tmdbid_by_imdbid(requests.session(), 'tt180') == 0
+    requests_mock.get(re.compile(os.environ.get('RADARR_URL')),
+                      exc=requests.exceptions.ConnectTimeout)
+    assert get_radarr_data(requests.session(), 'lookup_imdb', 'tt180') is None
+    assert get_radarr_data(requests.session(), 'get_movie') is None
+
+
+def test_fetch_imdb_details(requests_mock):
+    url = 'https://imdb-api.com/ru/API/Title/' + os.environ.get('IMDB_APIKEY') + '/'
+    requests_mock.get(url + 'tt5', status_code=404)
+
+    imdbids = ['tt{0}'.format(index) for index in range(20)]
+    for imdbid in imdbids:
+        requests_mock.get(url + imdbid, json={'id': imdbid, 'genres': imdbid})
+    requests_mock.get(url + 'tt5', status_code=404)
+    db_client = mongomock.MongoClient()
+    db = db_client.db
+
+    result = fetch_imdb_details(requests.session(), db, imdbids, 8)
+    assert result[5] is None
+    del result[5]
+    del imdbids[5]
+    assert [film_details['genres'] for film_details in result] == imdbids
+
+
+def test_get_imdb_details_cache(requests_mock):
+    url = 'https://imdb-api.com/ru/API/Title/' + os.environ.get('IMDB_APIKEY') + '/tt180'
+    requests_mock.get(url, json={'id': 'tt180', 'genres': 'Action, Comedy', 'plot': 'Long'})
+    db_client = mongomock.MongoClient()
+    db = db_client.db
+    stats = dict(cache_stats.get('imdb_details', {'hit': 0, 'miss': 0}))
+
+    assert get_imdb_details(requests.session(), db, 'tt180') == {'genres': 'Action, Comedy'}
+    assert get_imdb_details(requests.session(), db, 'tt180') == {'genres': 'Action, Comedy'}
+    assert requests_mock.call_count == 1
+    assert cache_stats['imdb_details']['hit'] == stats['hit'] + 1
+    assert cache_stats['imdb_details']['miss'] == stats['miss'] + 1
+    cached = db.imdb_details.find_one({'imdbId': 'tt180'})
+    assert 'plot' not in cached
+    assert cached['cached']
+
+    # Stale cache
+    db.imdb_details.update_one({'imdbId': 'tt180'},
+                               {'$set': {'cached': datetime.datetime(2000, 1, 1)}})
+    assert get_imdb_details(requests.session(), db, 'tt180') == {'genres': 'Action, Comedy'}
+    assert requests_mock.call_count == 2
+
+
+def test_request_budget():
+    db = mongomock.MongoClient().db
+    now = [datetime.datetime(2021, 5, 1)]
+    budget = RequestBudget(db, 'imdb-api.com', 2, clock=lambda: now[0])
+    assert budget.available() == 2
+    assert budget.take()
+    assert budget.take()
+    assert not budget.take()
+
+    # Spent tokens persist in DB
+    budget = RequestBudget(db, 'imdb-api.com', 2, clock=lambda: now[0])
+    assert not budget.take()
+    now[0] += datetime.timedelta(hours=12)
+    assert budget.available() == 1
+    assert budget.take()
+    assert not budget.take()
+
+
+def test_imdb_quota(requests_mock, mocker):
+    mocker.patch.dict(os.environ, {'AUTORADARR_IMDB_DAILY_QUOTA': '1'})
+    url = 'https://imdb-api.com/ru/API/Title/' + os.environ.get('IMDB_APIKEY') + '/'
+    requests_mock.get(url + 'tt1', json={'id': 'tt1', 'genres': 'Action'})
+    requests_mock.get(url + 'tt2', json={'id': 'tt2', 'genres': 'Comedy'})
+    db = mongomock.MongoClient().db
+    year = str(datetime.datetime.utcnow().year)
+    newfilms = [
+        {'id': 'tt2', 'title': 'Less votes', 'fullTitle': 'Less votes', 'year': year,
+         'imDbRating': '7.0', 'imDbRatingCount': '6000'},
+        {'id': 'tt1', 'title': 'Popular', 'fullTitle': 'Popular', 'year': year,
+         'imDbRating': '7.0', 'imDbRatingCount': '600000'},
+    ]
+    mocker.patch('autoradarr.autoradarr.load_radarr_index', return_value=frozenset())
+
+    # Only one detail call - most promising film gets it
+    films = [film for chunk in iter_imdb_films(requests.session(), db, newfilms, chunk_size=1)
+             for film in chunk]
+    assert [film['id'] for film in films] == ['tt1']
+    assert requests_mock.call_count == 1
+    # Skipped film is not marked - next scan checks it
+    assert db.films.find_one({'imdbId': 'tt2'}) is None
+    assert acceptance_score(newfilms[1]) > acceptance_score(newfilms[0])
+
+
+def test_get_imdb_details_fail(requests_mock):
+    url = 'https://imdb-api.com/ru/API/Title/' + os.environ.get('IMDB_APIKEY') + '/tt180'
+    requests_mock.get(url, json={'errorMessage': 'Maximum usage', 'genres': None})
+    db_client = mongomock.MongoClient()
+    db = db_client.db
+    assert get_imdb_details(requests.session(), db, 'tt180') is None
+    assert db.imdb_details.find_one({'imdbId': 'tt180'}) is None
+
+
+def test_filter_by_detail_workers(mocker, requests_mock):
+    url = 'https://imdb-api.com/ru/API/Title/' + os.environ.get('IMDB_APIKEY') + '/'
+    requests_mock.get(url + 'tt180', json={'genres': 'Comedy'})
+    requests_mock.get(url + 'tt170', status_code=500)
+    requests_mock.get(url + 'tt190', json={'genres': 'Action'})
+    newfilms = [{'id': 'tt180', 'imDbRating': '7', 'title': 'Title1', 'fullTitle': '1'},
+                {'id': 'tt170', 'imDbRating': '7', 'title': 'Title2', 'fullTitle': '2'},
+                {'id': 'tt190', 'imDbRating': '7', 'title': 'Title3', 'fullTitle': '3'}]
+    db_client = mongomock.MongoClient()
+    db = db_client.db
+    result = filter_by_detail(requests.session(), db, newfilms, workers=3)
+    assert [film['id'] for film in result] == ['tt180', 'tt190']
+    assert db.films.count_documents({}) == 0
+
+
+def test_host_slot():
+    assert host_slot('https://imdb-api.com/a') is host_slot('https://imdb-api.com/b?c=d')
+    assert host_slot('https://imdb-api.com/a') is not host_slot('https://api.themoviedb.org/a')
+
+
 @pytest.mark.parametrize((('newfilms'), ('expected')), [
     (
         [
@@ -359,6 +823,38 @@ def test_get_tmdbid_by_imdbid_fail():
     assert get_tmdbid_by_imdbid(requests.session(), 'tt70') == 0
 
 
+def test_resolve_tmdbids(requests_mock):
+    url = 'https://api.themoviedb.org/3/find/{0}?api_key=' + os.environ.get('TMDB_APIKEY') + \
+        '&language=en-US&external_source=imdb_id'
+    requests_mock.get(url.format('tt180'), json={'movie_results': [{'id': 180}]})
+    requests_mock.get(url.format('tt170'), json={'movie_results': []})
+    db_client = mongomock.MongoClient()
+    db = db_client.db
+    db.tmdb_ids.insert_one({'imdbId': 'tt190', 'tmdbId': 190})
+
+    expected = {'tt180': 180, 'tt170': 0, 'tt190': 190}
+    assert resolve_tmdbids(requests.session(), db, ['tt180', 'tt170', 'tt190']) == expected
+    assert requests_mock.call_count == 2
+    assert db.tmdb_ids.find_one({'imdbId': 'tt180'})['tmdbId'] == 180
+    assert db.tmdb_ids.find_one({'imdbId': 'tt170'}) is None
+
+    # tt180 from cache, not found tt170 again from TMDB
+    assert resolve_tmdbids(requests.session(), db, ['tt180', 'tt170']) == {'tt180': 180,
+                                                                           'tt170': 0}
+    assert requests_mock.call_count == 3
+
+
+def test_resolve_tmdbids_by_radarr(mocker, requests_mock):
+    mocker.patch.dict(os.environ, {'AUTORADARR_TMDB_RESOLVER': 'radarr'})
+    url = os.environ.get('RADARR_URL') + '/api/v3/movie/lookup/imdb?imdbId=tt180&apiKey=' + \
+        os.environ.get('RADARR_APIKEY')
+    requests_mock.get(url, json={'imdbId': 'tt180', 'tmdbId': 180})
+    db_client = mongomock.MongoClient()
+    db = db_client.db
+    assert resolve_tmdbids(requests.session(), db, ['tt180']) == {'tt180': 180}
+    assert requests_mock.call_count == 1
+
+
 def test_necessary_fields_for_radarr():
     film = {}
     film['folderName'] = '/folder'
@@ -372,6 +868,598 @@ def test_necessary_fields_for_radarr():
     assert necessary_fields_for_radarr(requests.session(), film) == excepted
 
 
+def test_iter_providers_films(mocker):
+    released = threading.Event()
+
+    def slow(client):
+        released.wait(5)
+        return [{'id': 'tt1'}]
+
+    def fail(client):
+        raise Exception('Provider is down')
+
+    mocker.patch.dict(providers, {
+        'first': Provider('first', lambda client: [{'id': 'tt180'}, {'id': 'tt170'}]),
+        'second': Provider('second', lambda client: [{'imdb': 'tt170', 'name': 'Title2'},
+                                                     {'imdb': 'tt190', 'name': 'Title3'}],
+                           {'id': 'imdb', 'title': 'name'}),
+        'slow': Provider('slow', slow),
+        'fail': Provider('fail', fail),
+        'empty': Provider('empty', lambda client: None),
+    })
+    names = ['slow', 'first', 'second', 'fail', 'empty', 'unknown']
+    failed = set()
+    films = list(iter_providers_films(requests.session(), names, timeout=0.5, failed=failed))
+    released.set()
+    assert sorted(film['id'] for film in films) == ['tt170', 'tt180', 'tt190']
+    assert failed == {'slow', 'fail', 'empty', 'unknown'}
+    # Provider's fields are mapped into Film records
+    assert all(type(film) is Film for film in films)
+    assert [film.title for film in films if film.id == 'tt190'] == ['Title3']
+
+
+def test_fetch_provider_not_parsed(mocker):
+    db = mongomock.MongoClient().db
+    year = str(datetime.datetime.utcnow().year)
+    provider = Provider('odd', lambda client: [
+        {'id': 'tt180', 'year': year, 'imDbRating': 'N/A', 'imDbRatingCount': '9000'},
+        {'id': 'tt170', 'year': year, 'imDbRating': '7.0', 'imDbRatingCount': 'N/A'},
+        {'id': 'tt190', 'year': year, 'imDbRating': '7.0', 'imDbRatingCount': '9000'}])
+    mocker.patch.dict(providers, {'odd': provider})
+    failed = set()
+    batches = list(iter_providers_batches(requests.session(), ['odd'], db=db, failed=failed))
+    # Incorrect values are 0 in every stage, not a failure of provider
+    assert failed == set()
+    assert [[film.id for film in batch] for batch in batches] == [['tt180', 'tt170', 'tt190']]
+    assert batches[0][0].rating == 0
+    assert [doc['imdbId'] for doc in db.rating_history.find()] == ['tt190']
+    assert db.snapshots.find_one({'_id': 'odd'})['films']['tt180'] == [0, 9000]
+    # Same payload, passed film has been marked
+    db.films.insert_one({'imdbId': 'tt190'})
+    assert list(iter_providers_batches(requests.session(), ['odd'], db=db)) == []
+
+
+def test_iter_providers_slow_consumer(mocker):
+    released = threading.Event()
+
+    def slow(client):
+        released.wait(5)
+        return [{'id': 'tt1'}]
+
+    mocker.patch.dict(providers, {
+        'fast': Provider('fast', lambda client: [{'id': 'tt180'}, {'id': 'tt170'}]),
+        'done': Provider('done', lambda client: [{'id': 'tt190'}]),
+        'slow': Provider('slow', slow),
+    })
+    failed = set()
+    batches = []
+    for batch in iter_providers_batches(requests.session(), ['fast', 'done', 'slow'],
+                                        timeout=0.2, failed=failed):
+        batches.append(sorted(film['id'] for film in batch))
+        # Downstream work longer than timeout doesn't drop answered providers
+        time.sleep(0.3)
+    released.set()
+    assert sorted(batches) == [['tt170', 'tt180'], ['tt190']]
+    assert failed == {'slow'}
+
+
+def test_get_new_films_batches(mocker):
+    released = threading.Event()
+
+    def slow(client):
+        released.wait(5)
+        return []
+
+    year = str(datetime.datetime.utcnow().year)
+    mocker.patch.dict(os.environ, {'AUTORADARR_PROVIDERS': 'fast,slow'})
+    mocker.patch.dict(providers, {
+        'fast': Provider('fast', lambda client: [
+            {'id': 'tt180', 'title': 'Film', 'fullTitle': 'Film', 'year': year,
+             'imDbRating': '7.5', 'imDbRatingCount': '10000'}]),
+        'slow': Provider('slow', slow),
+    })
+    mocker.patch('autoradarr.autoradarr.load_radarr_index', return_value=frozenset())
+    mocker.patch('autoradarr.autoradarr.filter_by_detail',
+                 side_effect=lambda client, db, films, buffer: [
+                     set_root_folders_by_genres(film, ['Action']) for film in films])
+    chunks = get_new_films(requests.session(), mongomock.MongoClient().db)
+    start = time.monotonic()
+    # Films of fast provider don't wait for slow one
+    assert [film['imdbId'] for film in next(chunks)] == ['tt180']
+    assert time.monotonic() - start < 2
+    released.set()
+    assert list(chunks) == []
+
+
+def test_add_to_radarr(mocker, requests_mock):
+    url = os.environ.get('RADARR_URL') + '/api/v3/movie?apiKey=' + \
+        os.environ.get('RADARR_APIKEY')
+    requests_mock.post(url, [{'status_code': 201}, {'status_code': 400}, {'status_code': 201}])
+    db_client = mongomock.MongoClient()
+    db = db_client.db
+    mocker.patch('autoradarr.autoradarr.resolve_tmdbids',
+                 return_value={'tt180': 180, 'tt170': 170, 'tt190': 190})
+    newfilms = [{'imdbId': imdbid, 'originalTitle': imdbid, 'folderName': '/f/' + imdbid}
+                for imdbid in ('tt180', 'tt170', 'tt190')]
+    assert add_to_radarr(requests.session(), db, [newfilms]) == 2
+    assert requests_mock.call_count == 3
+    assert db.films.count_documents({}) == 2
+
+
+def test_add_to_radarr_bulk(mocker, requests_mock):
+    mocker.patch.dict(os.environ, {'AUTORADARR_RADARR_BULK': '1',
+                                   'AUTORADARR_RADARR_BULK_SIZE': '2'})
+    url = os.environ.get('RADARR_URL') + '/api/v3/movie{0}?apiKey=' + \
+        os.environ.get('RADARR_APIKEY')
+    # First chunk - tt170 is not confirmed, second chunk failed
+    requests_mock.post(url.format('/import'), [{'json': [{'imdbId': 'tt180'}]},
+                                               {'status_code': 500}])
+    requests_mock.post(url.format(''), status_code=201)
+    db_client = mongomock.MongoClient()
+    db = db_client.db
+    mocker.patch('autoradarr.autoradarr.resolve_tmdbids',
+                 return_value={'tt180': 180, 'tt170': 170, 'tt190': 190})
+    newfilms = [{'imdbId': imdbid, 'originalTitle': imdbid, 'folderName': '/f/' + imdbid}
+                for imdbid in ('tt180', 'tt170', 'tt190')]
+    assert add_to_radarr(requests.session(), db, [newfilms]) == 2
+    assert requests_mock.call_count == 3
+    assert requests_mock.last_request.json()['imdbId'] == 'tt190'
+    assert {film['imdbId'] for film in db.films.find()} == {'tt180', 'tt190'}
+
+
+def test_add_to_radarr_max_adds(mocker):
+    mocker.patch('autoradarr.autoradarr.add_chunk_to_radarr',
+                 side_effect=lambda client, db, chunk, buffer: len(chunk))
+    requested = []
+
+    def newfilms():
+        for chunk in (['tt1', 'tt2'], ['tt3', 'tt4'], ['tt5']):
+            requested.append(chunk)
+            yield chunk
+
+    db_client = mongomock.MongoClient()
+    assert add_to_radarr(requests.session(), db_client.db, newfilms(), max_adds=3) == 3
+    assert len(requested) == 2    # Last chunk has not been filtered
+    assert add_to_radarr(requests.session(), db_client.db, newfilms(), max_adds=0) == 5
+
+
+def test_filter_imdb_films_stream(mocker):
+    mocker.patch('autoradarr.autoradarr.get_radarr_data', return_value=True)
+    radarr = mocker.patch('autoradarr.autoradarr.get_radarr_imdbid_list',
+                          return_value=['tt3'])
+    mocker.patch('autoradarr.autoradarr.filter_by_detail',
+                 side_effect=lambda client, db, films, buffer: films)
+    year = str(datetime.datetime.utcnow().year)
+    newfilms = [{'id': 'tt{0}'.format(index), 'title': str(index), 'year': year,
+                 'imDbRating': '7', 'imDbRatingCount': '9000'} for index in range(5)]
+    newfilms.append({'id': 'tt9', 'title': 'Old', 'year': '1990',
+                     'imDbRating': '7', 'imDbRatingCount': '9000'})
+    db_client = mongomock.MongoClient()
+    db = db_client.db
+    db.films.insert_one({'imdbId': 'tt1'})
+
+    chunks = iter_imdb_films(requests.session(), db, newfilms, MarkBuffer(db), chunk_size=2)
+    assert [film['id'] for film in next(chunks)] == ['tt0']
+    assert radarr.call_count == 1
+    assert [[film['id'] for film in chunk] for chunk in chunks] == [['tt2'], ['tt4']]
+    assert radarr.call_count == 1
+    assert db.films.find_one({'imdbId': 'tt3'})['persistInRadarr'] == 1
+
+
+def test_add_tmdb_pending_fail(requests_mock):
+    db = mongomock.MongoClient().db
+    db.tmdb_pending.insert_one({'imdbId': 'tt180', 'film': {
+        'imdbId': 'tt180', 'originalTitle': 'tt180', 'folderName': '/f/tt180'}})
+    requests_mock.get(re.compile('https://api.themoviedb.org/3/find/'), status_code=503)
+    # TMDB is down - job backs off
+    assert add_tmdb_pending(requests.session(), db) is None
+    requests_mock.get(re.compile('https://api.themoviedb.org/3/find/'),
+                      json={'movie_results': []})
+    assert add_tmdb_pending(requests.session(), db) == 0
+    assert db.tmdb_pending.count_documents({}) == 1
+
+
+def test_add_tmdb_pending(mocker, tmp_path):
+    db_client = mongomock.MongoClient()
+    db = db_client.db
+    newfilms = [{'imdbId': imdbid, 'originalTitle': imdbid, 'folderName': '/f/' + imdbid}
+                for imdbid in ('tt180', 'tt170')]
+    mocker.patch('autoradarr.autoradarr.resolve_tmdbids',
+                 return_value={'tt180': 0, 'tt170': 0})
+    post = mocker.patch('autoradarr.autoradarr.post_to_radarr', return_value=[])
+    assert add_to_radarr(requests.session(), db, [newfilms]) == 0
+    assert post.call_args[0][1] == []
+    assert db.tmdb_pending.count_documents({}) == 2
+    assert add_tmdb_pending(requests.session(), db) == 0
+
+    mocker.patch('autoradarr.autoradarr.resolve_tmdbids',
+                 return_value={'tt180': 180, 'tt170': 0})
+    post.side_effect = lambda client, films, workers, instance: films
+    seen = SeenIndex(str(tmp_path / 'seen.idx'))
+    assert add_tmdb_pending(requests.session(), db, seen) == 1
+    assert post.call_args[0][1][0]['tmdbId'] == 180
+    assert 'tt180' in seen
+    assert db.films.find_one({'imdbId': 'tt180'})
+    assert [film['imdbId'] for film in db.tmdb_pending.find()] == ['tt170']
+
+
+def test_job_schedule(mocker):
+    mocker.patch('autoradarr.autoradarr.random.uniform', side_effect=lambda a, b: 1)
+    job = Job('test', None, 100)
+    job.schedule(0, 0)
+    assert (job.interval, job.next_run) == (150, 150)
+    job.schedule(0, 3)
+    assert (job.interval, job.next_run) == (75, 75)
+    job.schedule(0, 3)
+    job.schedule(0, 3)
+    assert job.interval == 25  # min_interval
+    job.schedule(0, None)
+    job.schedule(0, None)
+    assert job.next_run == 100  # 25 * 2 ** 2
+    assert job.interval == 25
+    for _ in range(10):
+        job.schedule(0, None)
+    assert job.next_run == 800  # max_interval
+    job.schedule(0, 0)
+    assert job.errors == 0
+
+
+def test_scheduler():
+    now = [0]
+    runs = []
+
+    def produce(name, produced):
+        def func():
+            runs.append(name)
+            if produced is None:
+                raise Exception('Source is down')
+            return produced
+        return func
+
+    jobs = [Job('fast', produce('fast', 1), 10, jitter=0),
+            Job('slow', produce('slow', None), 100, jitter=0)]
+    scheduler = Scheduler(jobs, clock=lambda: now[0])
+    assert scheduler.run_pending() == ['fast', 'slow']
+    assert [job.next_run for job in jobs] == [5, 200]
+    now[0] = 5
+    assert scheduler.run_pending() == ['fast']
+    now[0] = 200
+    assert scheduler.run_pending() == ['fast', 'slow']
+    assert jobs[1].next_run == 200 + 400
+    assert runs == ['fast', 'slow', 'fast', 'fast', 'slow']
+
+    # Job is running already - skip it
+    jobs[0].lock.acquire()
+    now[0] = 1000
+    assert jobs[0].run(lambda: now[0]) is None
+    assert runs[-1] == 'slow'
+
+
+def test_scheduler_slow_job():
+    now = [0]
+
+    def scan():
+        # Run takes longer than interval
+        now[0] += 1200
+        return 0
+
+    job = Job('slow', scan, 900, jitter=0)
+    scheduler = Scheduler([job], clock=lambda: now[0])
+    assert scheduler.run_pending() == ['slow']
+    # Next run is counted from the end of run
+    assert job.next_run == 1200 + 900 * 1.5
+    assert scheduler.run_pending() == []
+
+
+def test_metrics_render():
+    registry = Metrics(buckets=(0.1, 1))
+    registry.inc('autoradarr_http_requests_total', host='radarr', code=201)
+    registry.inc('autoradarr_http_requests_total', host='radarr', code=201)
+    registry.observe('autoradarr_stage_seconds', 0.05, stage='filter_in_db')
+    registry.observe('autoradarr_stage_seconds', 5, stage='filter_in_db')
+    assert registry.get('autoradarr_http_requests_total', host='radarr', code=201) == 2
+    assert registry.get('autoradarr_stage_seconds', stage='filter_in_db') == 2
+
+    cache_stats['metrics_test'] = {'hit': 3, 'miss': 1}
+    try:
+        text = registry.render()
+    finally:
+        del cache_stats['metrics_test']
+    assert '# TYPE autoradarr_stage_seconds histogram' in text
+    assert 'autoradarr_http_requests_total{code="201",host="radarr"} 2' in text
+    assert 'autoradarr_stage_seconds_bucket{stage="filter_in_db",le="0.1"} 1' in text
+    assert 'autoradarr_stage_seconds_bucket{stage="filter_in_db",le="1.0"} 1' in text
+    assert 'autoradarr_stage_seconds_bucket{stage="filter_in_db",le="+Inf"} 2' in text
+    assert 'autoradarr_stage_seconds_count{stage="filter_in_db"} 2' in text
+    assert 'autoradarr_cache_hit_ratio{cache="metrics_test"} 0.75' in text
+
+
+def test_stage_timer():
+    metrics.reset()
+    with StageTimer('test_stage', [1, 2, 3]) as stage:
+        assert stage.out([1]) == [1]
+    with pytest.raises(ValueError):
+        with StageTimer('test_stage'):
+            raise ValueError
+    assert metrics.get('autoradarr_stage_calls_total', stage='test_stage') == 2
+    assert metrics.get('autoradarr_stage_seconds', stage='test_stage') == 2
+    assert metrics.get('autoradarr_stage_errors_total', stage='test_stage') == 1
+    assert metrics.get('autoradarr_stage_films_total', stage='test_stage', direction='in') == 3
+    assert metrics.get('autoradarr_stage_films_total', stage='test_stage', direction='out') == 1
+
+
+def test_metrics_server(requests_mock, monkeypatch):
+    assert start_metrics_server(0) is None
+
+    monkeypatch.setenv('AUTORADARR_METRICS_ADDR', '127.0.0.1')
+    server = start_metrics_server(get_free_port())
+    requests_mock.real_http = True
+    url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+    try:
+        # Requests of HttpClient are measured too
+        client = make_http_client()
+        requests_mock.get('https://imdb-api.com/', status_code=200)
+        client.get('https://imdb-api.com/')
+        r = requests.get(url + '/metrics')
+        assert r.status_code == 200
+        assert 'autoradarr_http_requests_total{code="200",host="imdb-api.com",method="GET"}' \
+            in r.text
+        assert requests.get(url + '/').status_code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_parse_log_levels():
+    assert parse_log_levels('autoradarr.imdb=debug, autoradarr.db=WARNING,bad,x=NOPE') == \
+        {'autoradarr.imdb': logging.DEBUG, 'autoradarr.db': logging.WARNING}
+    assert parse_log_levels('') == {}
+
+
+def test_setup_logging(monkeypatch):
+    monkeypatch.setenv('AUTORADARR_LOG_LEVEL', 'warning')
+    monkeypatch.setenv('AUTORADARR_LOG_LEVELS', 'autoradarr.imdb=DEBUG')
+    stream = io.StringIO()
+    setup_logging(stream)
+    try:
+        logging.getLogger('autoradarr.imdb').debug('Getting detail of film %s...', 'tt1',
+                                                   extra={'imdbId': 'tt1'})
+        logging.getLogger('autoradarr.db').info('Hidden')
+        logging.getLogger('autoradarr.db').error('Shown')
+    finally:
+        stop_logging()
+        for handler in list(log.handlers):
+            log.removeHandler(handler)
+        log.propagate = True
+        log.setLevel(logging.NOTSET)
+        logging.getLogger('autoradarr.imdb').setLevel(logging.NOTSET)
+
+    entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [entry['message'] for entry in entries] == ['Getting detail of film tt1...', 'Shown']
+    assert entries[0]['level'] == 'DEBUG'
+    assert entries[0]['logger'] == 'autoradarr.imdb'
+    assert entries[0]['imdbId'] == 'tt1'
+    assert entries[1]['level'] == 'ERROR'
+
+
+def test_runtime(mocker):
+    dbs = [mongomock.MongoClient()['autoradarr'], mongomock.MongoClient()['autoradarr']]
+    get_db_mock = mocker.patch('autoradarr.autoradarr.get_db', side_effect=dbs)
+    now = [0]
+    runtime = Runtime(clock=lambda: now[0])
+
+    db = runtime.get_db()
+    assert db is dbs[0]
+    # Checked recently - no ping
+    ping = mocker.patch.object(db, 'command', side_effect=pymongo.errors.AutoReconnect)
+    assert runtime.get_db() is db
+    assert not ping.called
+
+    # Ping fails - reconnect
+    now[0] = 100
+    close = mocker.patch.object(db.client, 'close')
+    assert runtime.get_db() is dbs[1]
+    assert ping.called
+    assert close.called
+    assert get_db_mock.call_count == 2
+
+    client = runtime.get_client()
+    assert runtime.get_client() is client
+    client.failures = 5
+    assert runtime.get_client() is not client
+    runtime.close()
+    assert runtime.db is None
+    assert runtime.client is None
+
+
+def test_diff_snapshot():
+    db = mongomock.MongoClient().db
+    year = str(datetime.datetime.utcnow().year)
+    items = [
+        {'id': 'tt1', 'year': year, 'imDbRating': '7.0', 'imDbRatingCount': '6000'},
+        {'id': 'tt2', 'year': year, 'imDbRating': '6.0', 'imDbRatingCount': '6000'},
+        {'id': 'tt3', 'year': year, 'imDbRating': '7.0', 'imDbRatingCount': '100'},
+    ]
+    films = [Film.from_imdb(item) for item in items]
+    assert diff_snapshot(db, 'imdb_popular', films, 3600) == films
+    # Same payload - passed film is sent till it has been marked in DB
+    assert [film.id for film in diff_snapshot(
+        db, 'imdb_popular', [Film.from_imdb(item) for item in items], 3600)] == ['tt1']
+    db.films.insert_one({'imdbId': 'tt1'})
+    assert diff_snapshot(db, 'imdb_popular', [Film.from_imdb(item) for item in items],
+                         3600) == []
+
+    # tt1 changed but was passed already, tt2 passed rating, tt3 still low count, tt4 is new
+    films[0]['imDbRatingCount'] = 7000
+    films[1]['imDbRating'] = 6.6
+    films[2]['imDbRatingCount'] = 200
+    films.append(Film('tt4', '', year=int(year), rating=5.0, rating_count=10))
+    assert [film.id for film in diff_snapshot(db, 'imdb_popular', films, 3600)] == \
+        ['tt2', 'tt4']
+    assert db.snapshots.find_one({'_id': 'imdb_popular'})['films']['tt1'] == [7.0, 7000]
+    db.films.insert_one({'imdbId': 'tt2'})
+
+    # Snapshot of older version keeps strings
+    db.snapshots.update_one({'_id': 'imdb_popular'},
+                            {'$set': {'films.tt3': ['6.0', '200'], 'fingerprint': ''}})
+    films[2]['imDbRatingCount'] = 9000
+    assert [film.id for film in diff_snapshot(db, 'imdb_popular', films, 3600)] == ['tt3']
+    # Waits for tmdbId
+    db.tmdb_pending.insert_one({'imdbId': 'tt3'})
+
+    # Full scan is due
+    db.snapshots.update_one({'_id': 'imdb_popular'},
+                            {'$set': {'full_scan': datetime.datetime(2000, 1, 1)}})
+    assert diff_snapshot(db, 'imdb_popular', films, 3600) == films
+    assert diff_snapshot(db, 'imdb_popular', films, 3600) == []
+
+
+def test_rating_history_fail(mocker):
+    db = mongomock.MongoClient().db
+    rating_history = db.rating_history
+    mocker.patch.object(rating_history, 'bulk_write',
+                        side_effect=pymongo.errors.AutoReconnect('down'))
+    collection = db.get_collection
+    mocker.patch.object(db, 'get_collection', side_effect=lambda name: rating_history
+                        if name == 'rating_history' else collection(name))
+    provider = Provider('one', lambda client: [{'id': 'tt180', 'imDbRating': '7.0',
+                                                'imDbRatingCount': '9000'}])
+    # History is not written, provider's films go on
+    assert [film.id for film in fetch_provider(provider, requests.session(), db)] == ['tt180']
+    assert db.snapshots.find_one({'_id': 'one'})
+
+
+def test_diff_snapshot_detail_fail(mocker, requests_mock):
+    year = str(datetime.datetime.utcnow().year)
+    item = {'id': 'tt180', 'title': 'Film', 'fullTitle': 'Film', 'year': year,
+            'imDbRating': '7.5', 'imDbRatingCount': '10000'}
+    mocker.patch.dict(os.environ, {'AUTORADARR_PROVIDERS': 'one'})
+    mocker.patch.dict(providers, {'one': Provider('one', lambda client: [dict(item)])})
+    mocker.patch('autoradarr.autoradarr.load_radarr_index', return_value=frozenset())
+    url = 'https://imdb-api.com/ru/API/Title/' + os.environ.get('IMDB_APIKEY') + '/tt180'
+    requests_mock.get(url, [{'exc': requests.exceptions.ReadTimeout},
+                            {'json': {'id': 'tt180', 'genres': 'Action'}}])
+    db = mongomock.MongoClient().db
+
+    # Detail request has timed out - film is not marked
+    assert list(get_new_films(requests.session(), db)) == []
+    assert db.films.find_one({'imdbId': 'tt180'}) is None
+    # Next run with slightly changed votes sends it again
+    item['imDbRatingCount'] = '10100'
+    assert [film['imdbId'] for chunk in get_new_films(requests.session(), db)
+            for film in chunk] == ['tt180']
+    # Added into Radarr - marked film is not sent again
+    mark_filtred_in_db(db, 'tt180', 'Film', 1)
+    item['imDbRatingCount'] = '10200'
+    assert list(get_new_films(requests.session(), db)) == []
+
+
+def test_rating_history():
+    db = mongomock.MongoClient().db
+    ensure_db_indexes(db)
+    start = datetime.datetime(2021, 4, 30, 12)
+    for day in range(3):
+        films = [Film.from_imdb(item) for item in [
+            # Votes grow 1000 per day
+            {'id': 'tt1', 'imDbRating': '7.1', 'imDbRatingCount': str(2000 + day * 1000)},
+            {'id': 'tt2', 'imDbRating': '6.2', 'imDbRatingCount': '9000'},
+            {'id': 'tt3', 'imDbRating': '7.0', 'imDbRatingCount': '9000'},
+            {'id': 'tt4', 'imDbRating': '5.0', 'imDbRatingCount': '9000'},
+            {'id': 'tt5', 'imDbRating': '', 'imDbRatingCount': ''},
+        ]]
+        assert record_ratings(db, films, start + datetime.timedelta(days=day)) == 4
+
+    # April and May buckets
+    docs = list(db.rating_history.find({'imdbId': 'tt1'}).sort('month', 1))
+    assert [doc['month'] for doc in docs] == [datetime.datetime(2021, 4, 1),
+                                              datetime.datetime(2021, 5, 1)]
+    assert docs[1]['t'] == [12 * 60, 24 * 60 + 12 * 60]
+    assert docs[1]['r'] == [71, 71]
+    assert docs[1]['c'] == [3000, 4000]
+    assert docs[1]['last'] == {'t': 24 * 60 + 12 * 60, 'r': 71, 'c': 4000}
+    assert docs[0]['last'] == {'t': 29 * 24 * 60 + 12 * 60, 'r': 71, 'c': 2000}
+    assert any(index['key'] == [('month', 1), ('last.c', 1)]
+               for index in db.rating_history.index_information().values())
+
+    near = films_near_thresholds(db, now=start + datetime.timedelta(days=3))
+    assert [film['imdbId'] for film in near] == ['tt1', 'tt2']
+    assert near[0]['countPerDay'] == 1000
+    assert near[0]['etaDays'] == 1
+    assert near[1]['etaDays'] is None
+
+    # Latest observation decides: tt2 dropped below margin, tt4 came near
+    record_ratings(db, [Film('tt2', '', rating=5.0, rating_count=9000),
+                        Film('tt4', '', rating=6.4, rating_count=9000)],
+                   start + datetime.timedelta(days=3))
+    near = films_near_thresholds(db, now=start + datetime.timedelta(days=4))
+    assert [film['imdbId'] for film in near] == ['tt1', 'tt4']
+
+
+def test_film():
+    film = Film.from_imdb({'id': 'tt1', 'title': 'Title', 'fullTitle': 'Title (2021)',
+                           'year': '2021', 'imDbRating': '7.5', 'imDbRatingCount': '9000',
+                           'image': 'http://image'})
+    assert (film.year, film.rating, film.rating_count) == (2021, 7.5, 9000)
+    assert film['imDbRating'] == 7.5
+    assert film['imdbId'] == film['id'] == 'tt1'
+    assert film.get('image') is None
+    with pytest.raises(AttributeError):
+        film.image = 'http://image'
+
+    film = set_root_folders_by_genres(film, ['Animation'])
+    assert film['folderName'] == os.environ.get('RADARR_ROOT_ANIMATIONS') + '/Title (2021)'
+    assert convert_imdb_in_radarr([film]) == [{
+        'originalTitle': 'Title', 'imdbId': 'tt1', 'year': 2021,
+        'folderName': film.folder_name, 'rootFolderPath': film.root_folder}]
+
+    empty = Film.from_imdb({'id': 'tt2', 'year': 'bad', 'imDbRating': ''})
+    assert (empty.year, empty.rating, empty.rating_count) == (0, 0, 0)
+    assert filter_regular_result([film, empty], 'imDbRating', 'imDbRatingCount', 'year',
+                                 2021) == [film]
+
+
+def test_runtime_seen(mocker, tmp_path):
+    db = mongomock.MongoClient().db
+    db.films.insert_many([{'imdbId': 'tt180'}, {'imdbId': 'tt170'}])
+    runtime = Runtime()
+    assert runtime.get_seen(db) is None
+
+    mocker.patch.dict(os.environ, {'AUTORADARR_SEEN_INDEX': str(tmp_path / 'seen.idx')})
+    seen = runtime.get_seen(db)
+    assert 'tt180' in seen
+    assert runtime.get_seen(db) is seen
+    seen.update(['tt190'])
+    runtime.close()
+    # Built once - loaded from file later
+    db.films.drop()
+    seen = Runtime().get_seen(db)
+    assert all(imdbid in seen for imdbid in ('tt170', 'tt180', 'tt190'))
+    seen.close()
+
+    # Marks written after last save are added on load, older ones are not read
+    db.films.insert_many([{'imdbId': 'tt160', 'added': datetime.datetime.utcnow()},
+                          {'imdbId': 'tt150', 'added': datetime.datetime(2000, 1, 1)}])
+    seen = Runtime().get_seen(db)
+    assert 'tt160' in seen
+    assert 'tt150' not in seen
+    seen.close()
+
+
+def test_sync_radarr_job_seen(mocker, tmp_path):
+    db = mongomock.MongoClient().db
+    mocker.patch.dict(os.environ, {'AUTORADARR_SEEN_INDEX': str(tmp_path / 'seen.idx')})
+    mocker.patch.dict(radarr_library, {'index': None, 'loaded': 0.0, 'instances': {}})
+    mocker.patch('autoradarr.autoradarr.sync_radarr_index', return_value=frozenset(['tt180']))
+    runtime = Runtime()
+    mocker.patch.object(runtime, 'get_db', return_value=db)
+    sync_radarr = make_jobs(runtime)[0]
+    assert sync_radarr.name == 'radarr_library'
+    # First sync goes before first scan - seen index is loaded by it
+    assert sync_radarr.func() == 1
+    assert 'tt180' in runtime.seen
+    runtime.seen.close()
+
+
 def test_main_pass(mocker):
     newfilms = [
         {'fullTitle': 'Mortal Kombat (2021)'},
@@ -385,3 +1473,192 @@ def test_main_pass(mocker):
 def test_main_db_fail(mocker):
     mocker.patch('autoradarr.autoradarr.get_db', return_value=None)
     assert main() is None
+
+
+def test_main_providers_fail(mocker):
+    mocker.patch.dict(os.environ, {'AUTORADARR_PROVIDERS': 'down, empty'})
+    mocker.patch.dict(providers, {'down': Provider('down', lambda client: None),
+                                  'empty': Provider('empty', lambda client: None)})
+    db = mongomock.MongoClient().db
+    # Backoff of job - all providers failed
+    assert main(requests.session(), db) is None
+    # Provider answered without new films - just empty run
+    providers['empty'].fetch = lambda client: []
+    assert main(requests.session(), db) == 0
+
+
+def test_stack_sampler():
+    def waiting_worker(event):
+        event.wait(5)
+
+    event = threading.Event()
+    worker = threading.Thread(target=waiting_worker, args=(event,), name='worker')
+    worker.start()
+    sampler = StackSampler()
+    try:
+        sampler.sample()
+        sampler.sample()
+    finally:
+        event.set()
+        worker.join()
+    stacks = [stack for stack in sampler.stacks if stack.startswith('worker;')]
+    assert len(stacks) == 1
+    assert 'waiting_worker (test_autoradarr.py);wait (threading.py)' in stacks[0]
+    assert sampler.stacks[stacks[0]] == 2
+
+
+def test_run_profiler(tmp_path):
+    def busy_run():
+        return [str(number) * 10 for number in range(20000)]
+
+    profiler = RunProfiler(str(tmp_path / 'profile'), interval=0.001, top=5,
+                           clock=lambda: datetime.datetime(2021, 5, 1, 12))
+    with profiler:
+        films = busy_run()
+    assert len(films) == 20000
+    assert profiler.paths['pstats'] == str(tmp_path / 'profile' /
+                                           'autoradarr-20210501T120000.pstats')
+
+    stats = pstats.Stats(profiler.paths['pstats'])
+    assert any(func[2] == 'busy_run' for func in stats.stats)
+    with open(profiler.paths['collapsed']) as collapsed:
+        for line in collapsed:
+            stack, count = line.rsplit(' ', 1)
+            assert ';' in stack and int(count) > 0
+    with open(profiler.paths['tracemalloc']) as report:
+        lines = report.read().splitlines()
+    assert lines[0].startswith('Traced memory: current')
+    assert lines[1] == 'Top 5 allocating lines:'
+    assert lines[2].startswith('#1 ')
+
+
+def test_cli_profile(mocker, tmp_path):
+    mocker.patch('autoradarr.autoradarr.setup_logging')
+    run_daemon = mocker.patch('autoradarr.autoradarr.run_daemon')
+    profile_run = mocker.patch('autoradarr.autoradarr.profile_run', side_effect=[3, None])
+    assert cli(['--profile', str(tmp_path)]) == 0
+    profile_run.assert_called_once_with(str(tmp_path))
+    mocker.patch.dict(os.environ, {'AUTORADARR_PROFILE': 'env_dir'})
+    assert cli([]) == 1
+    profile_run.assert_called_with('env_dir')
+    assert not run_daemon.called
+
+    mocker.patch.dict(os.environ, {'AUTORADARR_PROFILE': ''})
+    assert cli([]) == 0
+    assert run_daemon.called
+
+
+RADARR_INSTANCES = json.dumps([
+    {'name': 'hd', 'url': 'http://hd/', 'apikey': 'k1'},
+    {'name': '4k', 'url': 'http://uhd', 'apikey': 'k2', 'quality': 7,
+     'genres': ['Action', 'Sci-Fi'], 'root_folders': ['/other'],
+     'root_folder_map': {'/other': '/uhd'}},
+])
+
+
+def test_radarr_instances(mocker):
+    default = get_radarr_instances()
+    assert [(instance.name, instance.url) for instance in default] == [('radarr', '')]
+    client = requests.session()
+    assert default[0].get_client(client) is client
+
+    mocker.patch.dict(os.environ, {'RADARR_INSTANCES': RADARR_INSTANCES})
+    hd, uhd = get_radarr_instances()
+    assert isinstance(uhd, RadarrInstance)
+    assert get_radarr_instances()[1] is uhd
+    assert (hd.name, hd.url, uhd.quality) == ('hd', 'http://hd', 7)
+    assert hd.get_client(client) is not client
+    assert hd.get_client(client) is hd.get_client(client)
+    assert hd.get_client(client) is not uhd.get_client(client)
+
+    film = {'imdbId': 'tt1', 'genres': ['Drama', 'Action'], 'rootFolderPath': '/other',
+            'folderName': '/other/Film (2021)', 'path': '/other/Film (2021)',
+            'qualityProfileId': 1}
+    assert hd.accepts(film) and uhd.accepts(film)
+    assert not uhd.accepts(dict(film, genres=['Drama']))
+    assert not uhd.accepts(dict(film, rootFolderPath='/anim'))
+    assert hd.prepare(film) == film
+    assert uhd.prepare(film) == dict(film, rootFolderPath='/uhd', folderName='/uhd/Film (2021)',
+                                     path='/uhd/Film (2021)', qualityProfileId=7)
+    assert film['rootFolderPath'] == '/other'
+    assert convert_imdb_in_radarr([{'id': 'tt1', 'title': 'Film', 'year': '2021',
+                                    'folderName': '/other/Film', 'rootFolderPath': '/other',
+                                    'genres': ['Action']}])[0]['genres'] == ['Action']
+    hd.close()
+    assert hd.client is None
+
+    for config in ('{', '[{"name": "hd"}]', '[]',
+                   '[{"name": "a", "url": "u", "apikey": "k"}, '
+                   '{"name": "a", "url": "u2", "apikey": "k"}]'):
+        mocker.patch.dict(os.environ, {'RADARR_INSTANCES': config})
+        with pytest.raises(Exception, match='RADARR_INSTANCES'):
+            get_radarr_instances()
+
+
+def test_sync_radarr_index_instances(mocker, requests_mock):
+    mocker.patch.dict(os.environ, {'RADARR_INSTANCES': RADARR_INSTANCES})
+    mocker.patch.dict(radarr_library, {'index': None, 'loaded': 0.0, 'instances': {}})
+    requests_mock.get('http://hd/api/v3/movie?apiKey=k1',
+                      json=[{'imdbId': 'tt1'}, {'imdbId': 'tt2'}])
+    requests_mock.get('http://uhd/api/v3/movie?apiKey=k2', json=[{'imdbId': 'tt2'}])
+    assert sync_radarr_index(requests.session()) == frozenset(['tt2'])
+    assert radarr_library['instances'] == {'hd': frozenset(['tt1', 'tt2']),
+                                           '4k': frozenset(['tt2'])}
+
+    # Unavailable instance keeps previous library
+    requests_mock.get('http://uhd/api/v3/movie?apiKey=k2', status_code=500)
+    requests_mock.get('http://hd/api/v3/movie?apiKey=k1',
+                      json=[{'imdbId': 'tt1'}, {'imdbId': 'tt2'}, {'imdbId': 'tt3'}])
+    assert sync_radarr_index(requests.session()) == frozenset(['tt2'])
+    assert radarr_library['instances']['hd'] == frozenset(['tt1', 'tt2', 'tt3'])
+
+    requests_mock.get('http://hd/api/v3/movie?apiKey=k1', status_code=500)
+    assert sync_radarr_index(requests.session()) is None
+    assert radarr_library['index'] == frozenset(['tt2'])
+
+
+def test_radarr_default_quality(mocker, requests_mock):
+    mocker.patch.dict(os.environ, {'RADARR_INSTANCES': RADARR_INSTANCES})
+    del os.environ['RADARR_DEFAULT_QUALITY']
+    # hd instance has no quality
+    with pytest.raises(Exception, match='RADARR_DEFAULT_QUALITY'):
+        get_radarr_instances()
+
+    os.environ['RADARR_INSTANCES'] = json.dumps([
+        {'name': 'hd', 'url': 'http://hd/', 'apikey': 'k1', 'quality': 4}])
+    mocker.patch.dict(radarr_library, {'index': frozenset(), 'loaded': 0.0,
+                                       'instances': {'hd': frozenset()}})
+    mocker.patch('autoradarr.autoradarr.resolve_tmdbids', return_value={'tt180': 180})
+    hd = requests_mock.post('http://hd/api/v3/movie?apiKey=k1', status_code=201)
+    newfilms = [{'imdbId': 'tt180', 'originalTitle': 'Film', 'folderName': '/other/Film',
+                 'rootFolderPath': '/other'}]
+    assert add_to_radarr(requests.session(), mongomock.MongoClient().db, [newfilms]) == 1
+    assert hd.last_request.json()['qualityProfileId'] == 4
+
+
+def test_add_to_radarr_instances(mocker, requests_mock):
+    mocker.patch.dict(os.environ, {'RADARR_INSTANCES': RADARR_INSTANCES})
+    # 4k instance has tt170 already
+    mocker.patch.dict(radarr_library, {'index': frozenset(), 'loaded': 0.0,
+                                       'instances': {'hd': frozenset(),
+                                                     '4k': frozenset(['tt170'])}})
+    mocker.patch('autoradarr.autoradarr.resolve_tmdbids',
+                 return_value={'tt180': 180, 'tt170': 170, 'tt190': 190, 'tt160': 160})
+    hd = requests_mock.post('http://hd/api/v3/movie?apiKey=k1', status_code=201)
+    uhd = requests_mock.post('http://uhd/api/v3/movie?apiKey=k2',
+                             [{'status_code': 500}, {'status_code': 500}])
+    newfilms = [{'imdbId': imdbid, 'originalTitle': imdbid, 'folderName': root + '/' + imdbid,
+                 'rootFolderPath': root, 'genres': genres}
+                for imdbid, root, genres in (('tt180', '/other', ['Action']),
+                                             ('tt170', '/other', ['Sci-Fi']),
+                                             ('tt190', '/anim', ['Animation']),
+                                             ('tt160', '/other', ['Comedy']))]
+    db = mongomock.MongoClient().db
+    assert add_to_radarr(requests.session(), db, [newfilms]) == 4
+    assert hd.call_count == 4
+    # Only Action / Sci-Fi films of /other missing in 4k library
+    assert uhd.call_count == 1
+    film = uhd.last_request.json()
+    assert (film['imdbId'], film['path'], film['qualityProfileId']) == ('tt180', '/uhd/tt180', 7)
+    # tt180 failed in 4k - next scan tries it again
+    assert {film['imdbId'] for film in db.films.find()} == {'tt170', 'tt190', 'tt160'}